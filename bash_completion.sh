@@ -8,7 +8,7 @@ _qpy()
     cur="${COMP_WORDS[COMP_CWORD]}"
     prev="${COMP_WORDS[COMP_CWORD-1]}"
 
-    opts="sub check ctrlQueue kill restart finish notes status config clean tutorial"
+    opts="sub check ctrlQueue kill restart finish notes status stats config clean tutorial"
 
     jobID="__job_ID__"
     pattern="__pattern__"
@@ -62,6 +62,10 @@ _qpy()
                     echo "Show the multiuser status."
                     ;;
                 # ==========
+                stats)
+                    echo "Show counters and latencies of qpy-master."
+                    ;;
+                # ==========
                 restart)
                     echo "Restart qpy-master."
                     ;;
@@ -133,6 +137,14 @@ _qpy()
 	    compopt +o nospace
 	    return 0;;
 
+	# ==========
+	stats)
+
+	    COMPREPLY=( $(compgen -W ": ${noArg}") )
+
+	    compopt +o nospace
+	    return 0;;
+
 	# ==========
 	kill)
 
@@ -9,6 +9,7 @@ import qpy_system as qpysys
 import qpy_constants as qpyconst
 try:
     import qpy_communication as qpycomm
+    qpycomm.multiuser_conn_info()
 except AssertionError as e:
     sys.exit(str(e) + "\nContact the system administrator.")
 import qpy_control_jobs as qpyctrl
@@ -27,6 +28,12 @@ if (not(os.path.isdir(qpysys.scripts_dir))):
 if (not(os.path.isdir(qpysys.notes_dir))):
     os.makedirs(qpysys.notes_dir)
 
+if (not(os.path.isdir(qpysys.job_status_dir))):
+    os.makedirs(qpysys.job_status_dir)
+
+if (not(os.path.isdir(qpysys.job_pgid_dir))):
+    os.makedirs(qpysys.job_pgid_dir)
+
 if (os.path.isfile(qpysys.master_conn_file + '_port')):
     sys.exit('A connection file was found. '
              + 'Is there a qpy-master instance running?')
@@ -43,21 +50,20 @@ config.logger.info("Starting qpy-master")
 multiuser_alive = threading.Event()
 multiuser_alive.clear()
 
-check_run = qpyctrl.CheckRun(jobs, multiuser_alive, config)
-check_run.start()
-
-jobs_killer = qpyctrl.JobsKiller(jobs, multiuser_alive, config)
-jobs_killer.start()
-
 try:
     multiuser_handler = MultiuserHandler(jobs, multiuser_alive, config)
 except qpyError:
     config.logger.error('Exception at MultiuserHandler', exc_info=True)
 
-multiuser_handler.start()
-    
-
 sub_ctrl = qpyctrl.Submission(jobs, multiuser_handler, config)
+
+check_run = qpyctrl.CheckRun(jobs, multiuser_alive, config, sub_ctrl)
+check_run.start()
+
+jobs_killer = qpyctrl.JobsKiller(jobs, multiuser_alive, config, sub_ctrl)
+jobs_killer.start()
+
+multiuser_handler.start()
 sub_ctrl.start()
 
 try:
@@ -67,6 +73,7 @@ except:
 
 config.logger.info("Finishing qpy-master")
 sub_ctrl.finish.set()
+sub_ctrl.wake.set()
 check_run.finish.set()
 jobs_killer.to_kill.put('kill')
 qpycomm.message_transfer((qpyconst.FROM_MULTI_FINISH, ()),
@@ -75,3 +82,5 @@ qpycomm.message_transfer((qpyconst.FROM_MULTI_FINISH, ()),
                          multiuser_handler.conn_key)
 os.remove(qpysys.master_conn_file + '_port')
 os.remove(qpysys.master_conn_file + '_conn_key')
+qpycomm.ssh_pool.close_all()
+qpycomm.multiuser_channel.close()
@@ -11,10 +11,13 @@ import os
 
 import qpy_system as qpysys
 import qpy_logging as qpylog
+import qpy_communication as qpycomm
 import qpy_nodes_management as qpynodes
 import qpy_users_management as qpyusers
+import qpy_metrics as qpymetrics
+import qpy_constants as qpyconst
 from qpy_exceptions import qpyConnectionError
-from qpy_multiuser_interaction import handle_client
+from qpy_multiuser_interaction import handle_client, update_metrics
 
 if (not(os.path.isdir(qpysys.qpy_multiuser_dir))):
     os.makedirs(qpysys.qpy_multiuser_dir)
@@ -22,7 +25,7 @@ os.chmod(qpysys.qpy_multiuser_dir, 0o700)
 
 try:
     logger = qpylog.configure_logger(qpysys.multiuser_log_file,
-                                     qpylog.logging.DEBUG)
+                                     qpylog.logging.INFO)
     logger.info('Starting main thread of qpy-multiuser')
     nodes = qpynodes.NodesCollection()
     nodes.load_from_file(qpysys.nodes_file)
@@ -32,6 +35,12 @@ try:
     logger.info('Users loaded')
     check_nodes = qpynodes.CheckNodes(nodes)
     check_nodes.start()
+    metrics_exporter = qpymetrics.PrometheusExporter(
+        qpymetrics.metrics,
+        qpysys.multiuser_metrics_file,
+        qpyconst.MULTIUSER_METRICS_INTERVAL,
+        update=lambda: update_metrics(users, nodes))
+    metrics_exporter.start()
 except:
     qpylog.logging.exception('Exception before handle_client')
 else:
@@ -44,3 +53,5 @@ else:
         qpylog.logging.exception('Exception at handle_client')
 logger.info('Finishing main thread of qpy-multiuser')
 check_nodes.finish.set()
+metrics_exporter.finish.set()
+qpycomm.ssh_pool.close_all()
@@ -17,10 +17,7 @@ import sys
 import re
 
 import qpy_system as qpysys
-try:
-    import qpy_communication as qpycomm
-except AssertionError as e:
-    sys.exit(str(e) + "\nContact the system administrator.")
+import qpy_communication as qpycomm
 import qpy_useful_cosmetics as qpyutil
 from qpy_parser import parse_qpy_cmd_line
 
@@ -8,20 +8,40 @@ import os
 import sys
 import time
 import random
+import threading
+import socket
+import itertools
 import subprocess
 from multiprocessing import connection, AuthenticationError, TimeoutError
 from socket import error as socketError
-try:
-    import paramiko
-    is_paramiko = True
-    # Check version??
-except ImportError:
-    is_paramiko = False
 
 import qpy_system as qpysys
+import qpy_constants as qpyconst
+import qpy_metrics as qpymetrics
 from qpy_exceptions import qpyUnknownError, qpyKeyError, qpyConnectionError
 
 
+# paramiko (with cryptography) is slow to import and only node_exec
+# needs it, thus it is imported at the first use (see _import_paramiko).
+# None while not tried yet:
+paramiko = None
+is_paramiko = None
+
+
+def _import_paramiko():
+    """Import paramiko, if not imported yet, and return is_paramiko"""
+    global paramiko, is_paramiko
+    if is_paramiko is None:
+        try:
+            import paramiko
+            # Check version??
+        except ImportError:
+            is_paramiko = False
+        else:
+            is_paramiko = True
+    return is_paramiko
+
+
 def write_conn_files(f_name,
                      address,
                      port,
@@ -62,7 +82,8 @@ def establish_Listener_connection(address,
                                   port_min,
                                   port_max,
                                   port=None,
-                                  conn_key=None):
+                                  conn_key=None,
+                                  authenticate=True):
     """Create a Listener connection
 
     Arguments:
@@ -75,12 +96,20 @@ def establish_Listener_connection(address,
                        connection. If None, randomly generates one
     conn_key (str)     (optional, default = None) The key of the
                        connection. If None, randomly generates one
+    authenticate (bool) (optional, default = True) If False, the
+                       Listener does not authenticate the connections
+                       in accept, and authenticate_client must be called
+                       for each accepted connection
     
     Behaviour:
     If port is passed as argument, it uses this port for the connection.
     Otherwise generates a random port, in the interval (port_min, port_max).
     Similar behaviour for conn_key, but without a max/min.
     
+    The authentication in accept waits, without timeout, for the
+    answer of the client. With authenticate=False this can be done
+    after accept, in another thread and with a timeout.
+    
     Return:
     The tuple (List_master, port, key)
     where List_master is the Listener object
@@ -95,12 +124,14 @@ def establish_Listener_connection(address,
         random.seed()
         # TODO: use module secrets
         conn_key = os.urandom(30)
+    authkey = conn_key if authenticate else None
     if port is None:
         while True:
             port = random.randint(port_min, port_max)
             try:
                 List_master = connection.Listener((address, port),
-                                                  authkey=conn_key)
+                                                  backlog=qpyconst.LISTEN_BACKLOG,
+                                                  authkey=authkey)
                 break
             except socketError:
                 pass
@@ -111,7 +142,8 @@ def establish_Listener_connection(address,
     else:
         try:
             List_master = connection.Listener((address, port),
-                                              authkey=conn_key)
+                                              backlog=qpyconst.LISTEN_BACKLOG,
+                                              authkey=authkey)
         except socketError:
             raise qpyConnectionError('Error when creating listener: '
                                      + str(sys.exc_info()[1]))
@@ -122,6 +154,57 @@ def establish_Listener_connection(address,
     return List_master, port, conn_key
 
 
+class _PolledConnection(object):
+    """A connection whose recv_bytes gives up after timeout seconds"""
+    __slots__ = ('conn', 'timeout')
+
+    def __init__(self, conn, timeout):
+        """Initialise the class."""
+        self.conn = conn
+        self.timeout = timeout
+
+    def send_bytes(self, buf):
+        self.conn.send_bytes(buf)
+
+    def recv_bytes(self, maxlength=None):
+        if not self.conn.poll(self.timeout):
+            raise TimeoutError('No answer from the client')
+        return self.conn.recv_bytes(maxlength)
+
+
+def authenticate_client(client, conn_key, timeout):
+    """Authenticate a connection accepted without authentication
+    
+    Arguments:
+    client (Connection)   A connection returned by the accept of a
+                          Listener created with authenticate=False
+                          (see establish_Listener_connection)
+    conn_key (bytes)      The key of the connection
+    timeout (float)       The time, in seconds, to wait for each
+                          answer of the client
+    
+    Behaviour:
+    This is the same authentication made by Listener.accept.
+    
+    Raise:
+    AuthenticationError if the client has not the key
+    TimeoutError if the client does not answer in time
+    OSError or EOFError if the connection fails
+    """
+    polled = _PolledConnection(client, timeout)
+    connection.deliver_challenge(polled, conn_key)
+    connection.answer_challenge(polled, conn_key)
+
+
+def wake_up_listener(address, port):
+    """Make a connection to the Listener at (address, port) and close it
+    
+    This just makes accept return, for example to finish the loop that
+    waits for connections. The connection is not authenticated.
+    """
+    socket.create_connection((address, port), timeout=5.0).close()
+
+
 def message_transfer(msg,
                      address,
                      port,
@@ -156,6 +239,7 @@ def message_transfer(msg,
     def my_init_timeout():
         return time.time() + timeout
     connection._init_timeout = my_init_timeout
+    start = time.monotonic()
     try:
         conn = connection.Client((address, port), authkey=key)
     except ConnectionRefusedError:
@@ -171,15 +255,163 @@ def message_transfer(msg,
     conn.send(msg)
     back_msg = conn.recv()
     conn.close()
+    qpymetrics.metrics.add('message_transfer', time.monotonic() - start)
     return back_msg
 
 
+def _is_active(ssh):
+    """Return True if the paramiko.SSHClient ssh is still connected."""
+    transport = ssh.get_transport()
+    return transport is not None and transport.is_active()
+
+
+class SSHSessionPool(object):
+    """Persistent SSH sessions to the nodes.
+    
+    Attributes:
+    max_idle (float)    (default = 300.0) Sessions that have not been
+                        used for this amount of seconds are closed
+    lock (RLock)        To use when dealing with the sessions
+    
+    Behaviour:
+    This class keeps one authenticated paramiko.SSHClient for each
+    pair (node, pKey_file), that is reused by all commands (and all
+    threads) executed on that node, instead of making a new connection
+    (and a new handshake) for every command. paramiko allows several
+    channels over the same transport, so the sessions can be used
+    by several threads at the same time.
+    
+    Sessions whose transport is no longer active are reconnected when
+    requested, and idle sessions are closed whenever a new session
+    is requested.
+    
+    See also:
+    node_exec
+    """
+    __slots__ = (
+        'max_idle',
+        'lock',
+        '_sessions',
+        '_keys')
+
+    def __init__(self, max_idle=300.0):
+        """Initialise the class."""
+        self.max_idle = max_idle
+        self.lock = threading.RLock()
+        self._sessions = {}
+        self._keys = {}
+
+    def _connect(self, node, pKey_file, timeout=None):
+        """Return a new connected paramiko.SSHClient.
+        
+        Raise:
+        qpyConnectionError if there is a problem in the SSH connection
+        """
+        if pKey_file is None:
+            k = None
+        else:
+            try:
+                k = self._keys[pKey_file]
+            except KeyError:
+                k = paramiko.RSAKey.from_private_key_file(pKey_file)
+                self._keys[pKey_file] = k
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(node, pkey=k, timeout=timeout,
+                        banner_timeout=timeout, auth_timeout=timeout)
+        except paramiko.BadHostKeyException:
+            raise qpyConnectionError(
+                "SSH error: server's host key could not be verified")
+        except paramiko.AuthenticationException:
+            raise qpyConnectionError("SSH error: authentication failed")
+        except socketError:
+            raise qpyConnectionError(
+                "socket error: The node is probably unreachable")
+        except:
+            raise qpyUnknownError("Unexpected exception after ssh.connect",
+                                  sys.exc_info())
+        return ssh
+
+    def get(self, node, pKey_file=None, timeout=None):
+        """Return an active paramiko.SSHClient to node.
+        
+        Arguments:
+        node (str)          The node
+        pKey_file (str)     (optional, default = None) The private key file
+        timeout (float)     (optional, default = None) Timeout, in seconds,
+                            for a new connection
+        
+        Behaviour:
+        The connection itself is made without holding the lock,
+        such that an unreachable node does not hold the sessions
+        to the other nodes.
+        
+        Raise:
+        qpyConnectionError if there is a problem in the SSH connection
+        """
+        key = (node, pKey_file)
+        now = time.time()
+        with self.lock:
+            self.evict_idle(now)
+            session = self._sessions.get(key)
+            if session is not None:
+                if _is_active(session[0]):
+                    session[1] = now
+                    return session[0]
+                del self._sessions[key]
+                session[0].close()
+        ssh = self._connect(node, pKey_file, timeout)
+        with self.lock:
+            session = self._sessions.get(key)
+            if session is not None and _is_active(session[0]):
+                ssh.close()
+                session[1] = now
+                return session[0]
+            self._sessions[key] = [ssh, now]
+        return ssh
+
+    def discard(self, node, ssh, pKey_file=None):
+        """Close the failed session ssh, and forget it if still stored
+        
+        Another thread might have already replaced the session to node
+        by a new one, that is in use and thus kept.
+        """
+        key = (node, pKey_file)
+        with self.lock:
+            session = self._sessions.get(key)
+            if session is not None and session[0] is ssh:
+                del self._sessions[key]
+        ssh.close()
+
+    def evict_idle(self, now=None):
+        """Close the sessions that have been idle for too long."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            to_evict = [k for k, (ssh, last_used) in self._sessions.items()
+                        if now - last_used > self.max_idle]
+            for k in to_evict:
+                self._sessions.pop(k)[0].close()
+
+    def close_all(self):
+        """Close all sessions."""
+        with self.lock:
+            for ssh, last_used in self._sessions.values():
+                ssh.close()
+            self._sessions = {}
+
+
+ssh_pool = SSHSessionPool()
+
+
 def node_exec(node,
               command,
               get_outerr=True,
               mode="paramiko",
               pKey_file=None,
-              localhost_popen_shell=False):
+              localhost_popen_shell=False,
+              timeout=None):
     """ Execute a command by ssh
     
     Arguments:
@@ -199,15 +431,45 @@ def node_exec(node,
                        Value for the argument shell of
                        subprocess.Popen used when node is
                        localhost.
+    timeout (float)    (optional, default = None)
+                       If not None, gives up the connection and
+                       the reading of stdout and stderr after this
+                       amount of seconds.
+    
+    Behaviour:
+    In the "paramiko" mode, the SSH sessions are kept open and
+    reused (see SSHSessionPool). If the command cannot be sent
+    over an existing session, a new connection is tried once.
+    If get_outerr is False, the command is started in the
+    background on the node, and this function returns as soon
+    as the node reports the PID of the new process.
     
     Return:
     The tuple (stdout, stderr), if the optional argument get_outerr
-    is set to True
+    is set to True.
+    The PID of the started process if get_outerr is False, in the
+    "paramiko" mode or for localhost (None otherwise).
+    
+    The duration of each call is recorded in qpymetrics.metrics,
+    as "ssh <node>".
     
     Raise:
     qpyConnectionError if there is a problem in the SSH connection
     qpyKeyError if mode is unknown
     """
+    with qpymetrics.metrics.timer('ssh ' + node):
+        return _node_exec(node, command, get_outerr, mode, pKey_file,
+                          localhost_popen_shell, timeout)
+
+
+def _node_exec(node,
+               command,
+               get_outerr,
+               mode,
+               pKey_file,
+               localhost_popen_shell,
+               timeout):
+    """Execute a command by ssh, see node_exec."""
     if node == 'localhost':
         # Just to make it work with localhost as node:
         if isinstance(command, str) and not localhost_popen_shell:
@@ -216,48 +478,57 @@ def node_exec(node,
             ssh = subprocess.Popen(command, shell=localhost_popen_shell,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
-            std_outerr = ssh.communicate()
+            try:
+                std_outerr = ssh.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                ssh.kill()
+                ssh.communicate()
+                raise qpyConnectionError("Timeout when executing command")
             return (std_outerr[0].decode('utf-8'),
                     std_outerr[1].decode('utf-8'))
         else:
             ssh = subprocess.Popen(command, shell=localhost_popen_shell)
-            return
-    elif mode == "paramiko" and is_paramiko:
+            return ssh.pid
+    elif mode == "paramiko" and _import_paramiko():
         if isinstance(command, list):
             command = ' '.join(command)
-        if pKey_file is not None:
-            k = paramiko.RSAKey.from_private_key_file(pKey_file)
-        else:
-            k = None
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            ssh.connect(node, pkey=k)
-        except paramiko.BadHostKeyException:
-            raise qpyConnectionError(
-                "SSH error: server's host key could not be verified")
-        except paramiko.AuthenticationException:
-            raise qpyConnectionError("SSH error: authentication failed")
-        except socketError:
-            raise qpyConnectionError(
-                "socket error: The node is probably unreachable")
-        except:
-            raise qpyUnknownError("Unexpected exception after ssh.connect",
-                                  sys.exc_info())
+        if not get_outerr:
+            command = ('( ' + command + ' ) < /dev/null > /dev/null 2>&1 &'
+                       + ' echo $!')
+        for attempt in range(2):
+            ssh = ssh_pool.get(node, pKey_file, timeout)
+            try:
+                stdin, stdout, stderr = ssh.exec_command(command,
+                                                         timeout=timeout)
+            except (paramiko.SSHException, socketError, EOFError):
+                ssh_pool.discard(node, ssh, pKey_file)
+                if attempt > 0:
+                    raise qpyConnectionError(
+                        "SSH error: command could not be sent to " + node)
+            else:
+                break
         if get_outerr:
-            stdin, stdout, stderr = ssh.exec_command(command)
-            out = stdout.read()
-            err = stderr.read()
-            stdin.flush()
-            stdout.close()
-            stderr.close()
-            ssh.close()
+            try:
+                out = stdout.read()
+                err = stderr.read()
+            except socketError:
+                raise qpyConnectionError(
+                    "SSH error: timeout when reading the output from " + node)
+            finally:
+                stdin.close()
+                stdout.close()
+                stderr.close()
             return out.decode('utf-8'), err.decode('utf-8')
         else:
-            ssh.exec_command(command)
-            time.sleep(1.)
-            ssh.close()
-            return
+            stdout.channel.settimeout(30.)
+            try:
+                pid = int(stdout.readline())
+            except (socketError, ValueError):
+                raise qpyConnectionError(
+                    "SSH error: the command was not started on " + node)
+            finally:
+                stdout.channel.close()
+            return pid
     elif mode == "popen":
         if isinstance(command, str):
             command = command.split()
@@ -265,7 +536,12 @@ def node_exec(node,
             ssh = subprocess.Popen(['ssh', node] + command, shell=False,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE)
-            std_outerr = ssh.communicate()
+            try:
+                std_outerr = ssh.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                ssh.kill()
+                ssh.communicate()
+                raise qpyConnectionError("Timeout when executing command")
             return std_outerr
         else:
             ssh = subprocess.Popen(['ssh', node] + command, shell=False)
@@ -274,12 +550,177 @@ def node_exec(node,
         raise qpyKeyError(f"Unknown mode for node_exec: {mode}; is_paramiko={is_paramiko}")
 
 
-multiuser_address = read_address_file(qpysys.multiuser_conn_file)
-try:
-    multiuser_port, multiuser_key = read_conn_files(
-        qpysys.multiuser_conn_file)
-except IOError:
-    assert (qpysys.qpy_instance != 'qpy-master.py'
-            and qpysys.qpy_instance != 'qpy'), \
-            'Failed when reading multiuser information.'
-    multiuser_port = multiuser_key = None
+class MultiuserChannel(object):
+    """A persistent connection to qpy-multiuser
+    
+    Attributes:
+    lock (RLock)        To use when dealing with the connection
+    
+    Behaviour:
+    Instead of a new connection (and a new authentication) for each
+    message, as in message_transfer, this class keeps a single
+    authenticated connection to qpy-multiuser, that is shared by
+    all threads.
+    The connection starts with the message
+    (qpyconst.MULTIUSER_CHANNEL, ()), and qpy-multiuser keeps it open
+    to serve requests. Every request is sent as (request_id, msg) and
+    the answer comes back as (request_id, msg_back). A thread reads
+    the answers and delivers them to the threads that are waiting for
+    them, in any order.
+    
+    The connection is made when the first request is sent, with
+    the connection information of multiuser_conn_info,
+    and is remade if it is found broken when sending a request.
+    TCP keepalive is enabled on the socket, so that a connection
+    to a dead qpy-multiuser is eventually detected.
+    """
+    __slots__ = ('lock', '_conn', '_pending', '_request_ids')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._conn = None
+        self._pending = {}
+        self._request_ids = itertools.count(1)
+
+    def _connect(self, timeout):
+        """Connect to qpy-multiuser and start the reading thread
+        
+        Raise:
+        qpyConnectionError if the connection is not established.
+        """
+        def my_init_timeout():
+            return time.time() + timeout
+        connection._init_timeout = my_init_timeout
+        try:
+            address, port, key = multiuser_conn_info()
+            conn = connection.Client((address, port), authkey=key)
+            conn.send((qpyconst.MULTIUSER_CHANNEL, ()))
+        except AuthenticationError:
+            raise qpyConnectionError(
+                "Connection failed due to Authentication Error.")
+        except (OSError, EOFError, TimeoutError) as exc:
+            raise qpyConnectionError(
+                "Connection to qpy-multiuser failed: " + str(exc))
+        with socket.fromfd(conn.fileno(),
+                           socket.AF_INET,
+                           socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._conn = conn
+        threading.Thread(target=self._read,
+                         args=(conn,),
+                         name='multiuser_channel',
+                         daemon=True).start()
+
+    def _read(self, conn):
+        """Receive the answers from conn and deliver them"""
+        while True:
+            try:
+                request_id, msg_back = conn.recv()
+            except (OSError, EOFError):
+                break
+            with self.lock:
+                waiting = self._pending.pop(request_id, None)
+            if waiting is not None:
+                waiting[1] = msg_back
+                waiting[0].set()
+        with self.lock:
+            if self._conn is conn:
+                self._conn = None
+                conn.close()
+            # Who is still waiting will not get an answer
+            for request_id in list(self._pending):
+                if self._pending[request_id][2] is conn:
+                    self._pending.pop(request_id)[0].set()
+
+    def request(self, msg, timeout=5.0):
+        """Send msg to qpy-multiuser and return its answer
+        
+        Arguments:
+        msg (tuple)        The message, (action_type, arguments)
+        timeout (float)    (optional, default = 5.0)
+                           The waiting time in seconds, for the
+                           connection and for the answer
+        
+        Raise:
+        qpyConnectionError if there is no answer from qpy-multiuser.
+        """
+        request_id = next(self._request_ids)
+        answer = threading.Event()
+        start = time.monotonic()
+        for attempt in range(2):
+            with self.lock:
+                if self._conn is None:
+                    self._connect(timeout)
+                conn = self._conn
+                waiting = [answer, None, conn]
+                self._pending[request_id] = waiting
+                try:
+                    conn.send((request_id, msg))
+                except (OSError, ValueError):
+                    self._pending.pop(request_id, None)
+                    self._conn = None
+                    conn.close()
+                    if attempt > 0:
+                        raise qpyConnectionError(
+                            "Message could not be sent to qpy-multiuser.")
+                else:
+                    break
+        if not answer.wait(timeout):
+            with self.lock:
+                self._pending.pop(request_id, None)
+            raise qpyConnectionError("No answer from qpy-multiuser.")
+        if waiting[1] is None:
+            raise qpyConnectionError("Connection to qpy-multiuser was lost.")
+        qpymetrics.metrics.add('multiuser request', time.monotonic() - start)
+        return waiting[1]
+
+    def close(self):
+        """Close the connection"""
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def multiuser_conn_info():
+    """Return the connection information of qpy-multiuser
+    
+    Behaviour:
+    The files are read only at the first call, and the information
+    is kept in the module attributes multiuser_address, multiuser_port
+    and multiuser_key (port and key are None if the files do not exist
+    and this is not qpy-master). Accessing these attributes before
+    the first call makes this call (see __getattr__).
+    
+    Return:
+    The tuple (address, port, key)
+    
+    Raise:
+    AssertionError if qpy-master can not read the information
+    """
+    global multiuser_address, multiuser_port, multiuser_key
+    try:
+        return multiuser_address, multiuser_port, multiuser_key
+    except NameError:
+        pass
+    address = read_address_file(qpysys.multiuser_conn_file)
+    try:
+        port, key = read_conn_files(qpysys.multiuser_conn_file)
+    except IOError:
+        assert (qpysys.qpy_instance != 'qpy-master.py'
+                and qpysys.qpy_instance != 'qpy'), \
+                'Failed when reading multiuser information.'
+        port = key = None
+    multiuser_address, multiuser_port, multiuser_key = address, port, key
+    return address, port, key
+
+
+def __getattr__(name):
+    """Read the connection information of qpy-multiuser at the first use"""
+    if name in ('multiuser_address', 'multiuser_port', 'multiuser_key'):
+        multiuser_conn_info()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+multiuser_channel = MultiuserChannel()
@@ -32,6 +32,9 @@ class Configurations(object):
                                    paused between each check
     sleep_time_check_run (int)     (default = 10) Time that check_run is
                                    paused between each check
+    sub_batch_size (int)           (default = 20) Maximum number of jobs
+                                   requested to qpy-multiuser in each
+                                   submission cycle
     source_these_files (list)      (default = ['~/.bash_profile'])
                                    files to be sourced in every job run
     ssh_p_key_file                 (default = None)
@@ -60,6 +63,7 @@ class Configurations(object):
         'or_attr',
         'sleep_time_sub_ctrl',
         'sleep_time_check_run',
+        'sub_batch_size',
         'source_these_files',
         'ssh_p_key_file',
         'logger_level',
@@ -87,11 +91,13 @@ class Configurations(object):
         self.or_attr = []
         self.sleep_time_sub_ctrl = 1
         self.sleep_time_check_run = 10
+        self.sub_batch_size = 20
         self.source_these_files = []
         self.ssh_p_key_file = None
-        self.logger_level = 'debug'  # 'warning'
-        self.logger = qpylog.configure_logger(qpysys.master_log_file,
-                                              qpylog.logging.DEBUG)
+        self.logger_level = 'warning'
+        self.logger = qpylog.configure_logger(
+            qpysys.master_log_file,
+            qpylog.parse_level(self.logger_level))
         if os.path.isfile(self.config_file):
             f = open(self.config_file, 'r')
             for l in f:
@@ -230,27 +236,12 @@ class Configurations(object):
             msg = "Messages were cleaned."
 
         elif k == 'loggerLevel':
-            if v in ['debug', 'DEBUG']:
-                vnew = qpylog.logging.DEBUG
-            elif v in ['info', 'INFO']:
-                vnew = qpylog.logging.INFO
-            elif v in ['warning', 'WARNING']:
-                vnew = qpylog.logging.WARNING
-            elif v in ['error', 'ERROR']:
-                vnew = qpylog.logging.ERROR
-            elif v in ['critical', 'CRITICAL']:
-                vnew = qpylog.logging.CRITICAL
-            else:
-                try:
-                    vnew = int(v)
-                except:
-                    vnew = None
-            if vnew is not None:
-                self.logger_level = v
-                self.logger.setLevel(vnew)
-                msg = 'Logger level set to ' + v
-            else:
-                raise qpyValueError('Unknown logging level: ' + v)
+            try:
+                self.logger.setLevel(qpylog.parse_level(v))
+            except ValueError:
+                raise qpyValueError('Unknown logging level: ' + str(v))
+            self.logger_level = v
+            msg = 'Logger level set to ' + v
 
         elif k == 'colour' or k == 'use_colour':
             try:
@@ -289,6 +280,18 @@ class Configurations(object):
                 msg = ("sleepTimeCheckRun set to " +
                        str(self.sleep_time_check_run) + '.')
 
+        elif k == 'subBatchSize':
+            try:
+                self.sub_batch_size = int(v)
+                if self.sub_batch_size < 1:
+                    raise ValueError
+            except:
+                raise qpyValueError(
+                    "Value for subBatchSize must be a positive integer.")
+            else:
+                msg = ("subBatchSize set to " +
+                       str(self.sub_batch_size) + '.')
+
         elif k == 'sourceTheseFiles':
             if isinstance(v, list):
                 self.source_these_files = v
@@ -329,6 +332,7 @@ class Configurations(object):
                 + str(self.colour_scheme[4]) + '\n')
         f.write('sleepTimeSubCtrl ' + str(self.sleep_time_sub_ctrl) + '\n')
         f.write('sleepTimeCheckRun ' + str(self.sleep_time_check_run) + '\n')
+        f.write('subBatchSize ' + str(self.sub_batch_size) + '\n')
         f.write('sourceTheseFiles ')
         for i in self.source_these_files:
             f.write(i + ' ')
@@ -348,6 +352,8 @@ class Configurations(object):
                 + str(self.sleep_time_sub_ctrl) + '\n')
         msg += ('Sleeping time in check run: '
                 + str(self.sleep_time_check_run) + '\n')
+        msg += ('Maximum number of jobs per submission cycle: '
+                + str(self.sub_batch_size) + '\n')
         if self.default_attr:
             msg += ('Default node attributes: '
                     + ' '.join(self.default_attr) + '\n')
@@ -9,9 +9,14 @@ MULTIUSER_FINISH         = 5
 MULTIUSER_START          = 6
 MULTIUSER_SAVE_MESSAGES  = 7
 MULTIUSER_TUTORIAL       = 8
+MULTIUSER_METRICS        = 9
+MULTIUSER_LOGGING        = 10
+MULTIUSER_TRACES         = 11
 MULTIUSER_USER           = -1
 MULTIUSER_REQ_CORE       = -2
 MULTIUSER_REMOVE_JOB     = -3
+MULTIUSER_REQ_CORES      = -4
+MULTIUSER_CHANNEL        = -5
 
 MULTIUSER_REQUEST_NAMES = ['',
                            'load nodes',
@@ -22,7 +27,12 @@ MULTIUSER_REQUEST_NAMES = ['',
                            'start',
                            'save messages',
                            'tutorial',
+                           'metrics',
+                           'logging',
+                           'traces',
                            # =============
+                           'persistent connection (hidden option)',
+                           'request several cores (hidden option)',
                            'remove job (hidden option)',
                            'request core (hidden option)',
                            'user (hidden option)']
@@ -40,6 +50,7 @@ JOBTYPE_STATUS    = 10
 JOBTYPE_RESTART   = 11
 JOBTYPE_CTRLQUEUE = 12
 JOBTYPE_NOTE      = 13
+JOBTYPE_STATS     = 14
 
 FROM_MULTI_CUR_JOBS = 1
 FROM_MULTI_FINISH = 2
@@ -67,6 +78,21 @@ POSSIBLE_COLOURS = ['yellow',
 
 JOB_FMT_PATTERN_DEF = '%j (%s):%c (on %n; wd: %d)\n'
 
+JOURNAL_MIN_COMPACTION = 1000
+
+CHECK_STATUS_INTERVAL = 0.5
+
+KILLER_MAX_WORKERS = 16
+
+MASTER_N_WORKERS = 4
+MASTER_RECV_TIMEOUT = 10.0
+
+MULTIUSER_N_WORKERS = 8
+MULTIUSER_RECV_TIMEOUT = 10.0
+MULTIUSER_METRICS_INTERVAL = 60.0
+# Connections waiting for accept (the default of Listener is 1)
+LISTEN_BACKLOG = 16
+
 KEYWORDS = {
     'sub': (JOBTYPE_SUB,
             'Submits a job. Arguments: the job command'),
@@ -89,7 +115,9 @@ KEYWORDS = {
     'ctrlQueue': (JOBTYPE_CTRLQUEUE,
                   'Fine control over the queue. Arguments: see tutorial'),
     'notes': (JOBTYPE_NOTE,
-              'Adds and reads notes. Arguments: ID and the note')
+              'Adds and reads notes. Arguments: ID and the note'),
+    'stats': (JOBTYPE_STATS,
+              'Shows counters and latencies of qpy-master. No arguments')
 }
 
 MULTIUSER_KEYWORDS = {
@@ -111,6 +139,15 @@ MULTIUSER_KEYWORDS = {
     'tutorial': (MULTIUSER_TUTORIAL,
                  'Opens the qpy administrator tutorial. ' +
                  'Arguments: optional: a pattern'),
+    'metrics': (MULTIUSER_METRICS,
+                'Shows request rates, rejections and latencies. ' +
+                'No arguments'),
+    'logging': (MULTIUSER_LOGGING,
+                'Sets the log level and the debug traces. ' +
+                'Arguments: optional: level <level>, ' +
+                'sample <fraction>, buffer <size>'),
+    'traces': (MULTIUSER_TRACES,
+               'Shows the debug traces kept in memory. No arguments'),
     '__user': (MULTIUSER_USER,
                'Adds user. Arguments: user_name'),
     '__req_core': (MULTIUSER_REQ_CORE,
@@ -119,6 +156,10 @@ MULTIUSER_KEYWORDS = {
     '__remove_job': (MULTIUSER_REMOVE_JOB,
                      'Removes a job: ' +
                      'Arguments: user_name, job_ID, queue_size'),
+    '__req_cores': (MULTIUSER_REQ_CORES,
+                    'Requires cores for several jobs: ' +
+                    'Arguments: user_name, queue_size, and a list of' +
+                    ' (jobID, n_cores, mem, node_attr)'),
 }
 
 PORT_MIN_MULTI  = 10000
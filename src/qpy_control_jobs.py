@@ -5,13 +5,45 @@ import os
 import sys
 import threading
 from datetime import datetime
-from time import sleep
-from queue import Queue
+from time import time, monotonic
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
 
 import qpy_system as qpysys
 import qpy_constants as qpyconst
 import qpy_communication as qpycomm
 import qpy_nodes_management as qpynodes
+import qpy_metrics as qpymetrics
+
+
+def _kill_on_node(node, jobs, config):
+    """Kill jobs, that are all running on node, in a single command.
+    
+    Return:
+    True if the command was executed, False otherwise
+    """
+    args = []
+    for job in jobs:
+        pgid = job.pgid()
+        args.append(str(job.ID) if pgid is None else
+                    str(job.ID) + ':' + str(pgid))
+    command = ('python3 '
+               + qpysys.source_dir + '/qpy_job_killer.py '
+               + ' '.join(args))
+    config.logger.info('Killing jobs %s on %s',
+                       [job.ID for job in jobs], node)
+    try:
+        (std_out, std_err) = qpycomm.node_exec(
+            node.address,
+            command,
+            pKey_file=config.ssh_p_key_file)
+    except Exception as e:
+        config.logger.warning('Exception when killing jobs:\n%s', e)
+        return False
+    config.logger.debug('stdout of killing jobs:\n%r\n'
+                        'stderr of killing jobs:\n%r',
+                        std_out, std_err)
+    return True
 
 
 class CheckRun(threading.Thread):
@@ -21,67 +53,141 @@ class CheckRun(threading.Thread):
     jobs (Job_Collection)      All jobs being handled by qpy-master
     multiuser_alive (Event)    It is set if the multiuser is alive
     config (Configurations)    qpy configurations
+    sub_ctrl (Submission)      The submission control
     finish (Event)             Set this Event to terminate this Thread
     
     Behaviour:
-    This thread makes regular checks on the running jobs
-    to see if they have been finished.
+    This thread checks if the running jobs have been finished.
     If so, the job is changed from running to done
-    and a message is sent to qpy-multiuser.
+    and a message is sent to qpy-multiuser. The submission is then
+    resumed (see Submission.resume), as cores have been freed.
     
-    This is done at each config.sleep_time_check_run seconds.
+    When a job finishes, it writes its exit status in a file in
+    the (global) job_status_dir (see Job.run). This directory is
+    checked at each qpyconst.CHECK_STATUS_INTERVAL seconds.
+    As a fallback, for jobs that could not write such file, the
+    processes running on the nodes are checked at each
+    config.sleep_time_check_run seconds.
     """
 
     __slots__ = (
         'jobs',
         'multiuser_alive',
         'config',
+        'sub_ctrl',
         'finish')
     
-    def __init__(self, jobs, multiuser_alive, config):
+    def __init__(self, jobs, multiuser_alive, config, sub_ctrl):
         """Initiate the class.
 
         Arguments:
         jobs (Job_Collection)       All jobs being handled by qpy-master
         multiuser_alive (Event)     It is set if the multiuser is alive
         config (Configurations)     qpy configurations
+        sub_ctrl (Submission)       The submission control
         """
         self.jobs = jobs
         self.multiuser_alive = multiuser_alive
         self.config = config
+        self.sub_ctrl = sub_ctrl
         threading.Thread.__init__(self)
         self.finish = threading.Event()
 
+    def _end_job(self, job):
+        """Change job from running to done.
+        
+        The job must have been claimed (see JobCollection.claim_running).
+        """
+        multiuser_down = job.end_running(qpyconst.JOB_ST_DONE,
+                                         len(self.jobs.queue),
+                                         self.config)
+        if multiuser_down:
+            self.multiuser_alive.clear()
+        else:
+            self.multiuser_alive.set()
+        self.jobs.mv(job, self.jobs.running, self.jobs.done)
+        qpymetrics.metrics.count('jobs done')
+        self.config.logger.info('Job %s changed to done.', job.ID)
+
+    def _check_status_files(self):
+        """Finish the jobs that wrote their status files.
+        
+        Return:
+        A list with the jobs that have been finished.
+        """
+        finished_jobs = []
+        with os.scandir(qpysys.job_status_dir) as status_files:
+            for status_file in status_files:
+                try:
+                    jobID = int(status_file.name[4:-7])
+                except ValueError:
+                    continue
+                job = self.jobs.running.get(jobID)
+                if job is None:
+                    if self.jobs.queue.get(jobID) is None:
+                        os.remove(status_file.path)
+                    continue
+                if not self.jobs.claim_running(job):
+                    # Being killed: the file is removed afterwards
+                    continue
+                try:
+                    end_time = status_file.stat().st_mtime
+                    with open(status_file.path, 'r') as f:
+                        exit_status = f.read().strip()
+                    os.remove(status_file.path)
+                    self.config.logger.info('Job %s exited with status %s.',
+                                            jobID, exit_status)
+                    qpymetrics.metrics.add('end detection lag',
+                                           time() - end_time)
+                    self._end_job(job)
+                    finished_jobs.append(job)
+                finally:
+                    self.jobs.release(job)
+        return finished_jobs
+
+    def _check_processes(self):
+        """Finish the jobs whose processes are not running in the nodes.
+        
+        Return:
+        A list with the jobs that have been finished.
+        """
+        finished_jobs = []
+        nodes_down, all_running_jobs = self.jobs.fetch_running_jobs()
+        with self.jobs.lock:
+            jobs_to_check = list(self.jobs.running)
+        self.config.logger.debug('nodes_down:\n%s', nodes_down)
+        self.config.logger.debug('all_running_jobs:\n%s', all_running_jobs)
+        self.config.logger.debug('jobs_to_check:\n%s', jobs_to_check)
+        for job in jobs_to_check:
+            if (job.node not in nodes_down
+                and job.ID not in all_running_jobs
+                    and self.jobs.claim_running(job)):
+                try:
+                    qpymetrics.metrics.count('jobs ended without status file')
+                    self._end_job(job)
+                    finished_jobs.append(job)
+                finally:
+                    self.jobs.release(job)
+        return finished_jobs
+
     def run(self):
         """Check if the jobs are running, see class documentation."""
+        last_check_processes = 0.0
         while not self.finish.is_set():
-            i = 0
-            jobs_modification = False
-            nodes_down, all_running_jobs = self.jobs.fetch_running_jobs()
-            with self.jobs.lock:
-                jobs_to_check = list(self.jobs.running)
-            self.config.logger.debug('nodes_down:\n%s', nodes_down)
-            self.config.logger.debug('all_running_jobs:\n%s', all_running_jobs)
-            self.config.logger.debug('jobs_to_check:\n%s', jobs_to_check)
-            for job in jobs_to_check:
-                if (job.node not in nodes_down
-                    and job.ID not in all_running_jobs
-                        and job.status == qpyconst.JOB_ST_RUNNING):
-                    multiuser_down = job.end_running(qpyconst.JOB_ST_DONE,
-                                                     len(self.jobs.queue),
-                                                     self.config)
-                    if multiuser_down:
-                        self.multiuser_alive.clear()
-                    else:
-                        self.multiuser_alive.set()
-                    jobs_modification = True
-                    self.jobs.mv(job, self.jobs.running, self.jobs.done)
-                    self.skip_job_sub = 0
-                    self.config.logger.info('Job %s changed to done.', job.ID)
-            if jobs_modification:
-                self.jobs.write_all_jobs()
-                jobs_modification = False
-            sleep(self.config.sleep_time_check_run)
+            try:
+                finished_jobs = self._check_status_files()
+            except OSError:
+                self.config.logger.warning('Exception when checking '
+                                           'the status files', exc_info=True)
+                finished_jobs = []
+            if (time() - last_check_processes
+                    >= self.config.sleep_time_check_run):
+                finished_jobs.extend(self._check_processes())
+                last_check_processes = time()
+            if finished_jobs:
+                self.jobs.record(*finished_jobs)
+                self.sub_ctrl.resume()
+            self.finish.wait(qpyconst.CHECK_STATUS_INTERVAL)
 
 
 class JobsKiller(threading.Thread):
@@ -91,12 +197,17 @@ class JobsKiller(threading.Thread):
     jobs (Job_Collection)      All jobs being handled by qpy-master
     multiuser_alive (Event)    It is set if the multiuser is alive
     config (Configurations)    qpy configurations
+    sub_ctrl (Submission)      The submission control
     to_kill (Queue)            It receives the jobs to kill
     
     Behaviour:
     This thread waits for jobs to be killed, passed
     by the Queue to_kill. These have to be a JOB instance or the
     string "kill". In this later case, the thread is terminated.
+    The jobs are claimed (see JobCollection.claim_running) when taken
+    from to_kill, such that CheckRun does not end them while they
+    are being killed. After killing jobs the submission is resumed
+    (see Submission.resume), as cores have been freed.
 
     TODO:
     When we qpy kill all, not all of them are killed, and
@@ -107,57 +218,97 @@ class JobsKiller(threading.Thread):
         'jobs',
         'multiuser_alive',
         'config',
+        'sub_ctrl',
         'to_kill')
     
-    def __init__(self, jobs, multiuser_alive, config):
+    def __init__(self, jobs, multiuser_alive, config, sub_ctrl):
         """Initiate the class.
 
         Arguments:
         jobs (Job_Collection)      All jobs being handled by qpy-master
         multiuser_alive (Event)    It is set if the multiuser is alive
         config (Configurations)    qpy configurations
+        sub_ctrl (Submission)      The submission control
         """
         self.jobs = jobs
         self.multiuser_alive = multiuser_alive
         self.config = config
+        self.sub_ctrl = sub_ctrl
         threading.Thread.__init__(self)
         self.to_kill = Queue()
 
     def run(self):
-        """Kill jobs, see class documentation."""
-        while True:
-            job = self.to_kill.get()
-            if isinstance(job, str):
-                if job == 'kill':
+        """Kill jobs, see class documentation.
+        
+        All jobs waiting in to_kill are taken at once and grouped
+        by node. The jobs of each node are killed by a single execution
+        of qpy_job_killer.py, and the nodes are handled in parallel.
+        """
+        finish = False
+        while not finish:
+            batch = [self.to_kill.get()]
+            while True:
+                try:
+                    batch.append(self.to_kill.get_nowait())
+                except Empty:
                     break
-            command = ('python3 '
-                       + qpysys.source_dir + '/qpy_job_killer.py '
-                       + str(job.ID))
-            self.config.logger.info('Killing job %s on %s', job.ID, job.node)
-            try:
-                if job.status != qpyconst.JOB_ST_RUNNING:
-                    raise Exception('Job status is not running.')
-                (std_out, std_err) = qpycomm.node_exec(
-                    job.node.address,
-                    command,
-                    pKey_file=self.config.ssh_p_key_file)
-                self.config.logger.debug('stdout of killing job:\n%r\n'
-                                         'stderr of killing job:\n%r',
-                                         std_out, std_err)
-            except Exception as e:
-                self.config.logger.warning('Exception when killing job:\n%s', e)
-                self.to_kill.put(job)
-            else:
-                multiuser_down = job.end_running(qpyconst.JOB_ST_KILLED,
-                                                 len(self.jobs.queue),
-                                                 self.config)
-                if multiuser_down:
-                    self.multiuser_alive.clear()
-                else:
-                    self.multiuser_alive.set()
-                self.jobs.mv(job, self.jobs.running, self.jobs.killed)
-                self.jobs.write_all_jobs()
-                self.config.logger.info('Job %s changed to killed.', job.ID)
+            per_node = {}
+            for job in batch:
+                if isinstance(job, str):
+                    if job == 'kill':
+                        finish = True
+                    continue
+                if not self.jobs.claim_running(job):
+                    self.config.logger.warning(
+                        'Job %s is not running or is already ending:'
+                        ' not killed.', job.ID)
+                    continue
+                per_node.setdefault(job.node.name, (job.node, []))[1].append(
+                    job)
+            if not per_node:
+                continue
+            with ThreadPoolExecutor(
+                    max_workers=min(len(per_node),
+                                    qpyconst.KILLER_MAX_WORKERS)) as executor:
+                killed = {executor.submit(_kill_on_node,
+                                          node, jobs, self.config): jobs
+                          for node, jobs in per_node.values()}
+            killed_jobs = []
+            for future, jobs in killed.items():
+                kill_done = future.result()
+                for job in jobs:
+                    if not kill_done:
+                        self.jobs.release(job)
+                        self.to_kill.put(job)
+                        continue
+                    try:
+                        self._end_job(job)
+                        killed_jobs.append(job)
+                    except Exception:
+                        self.config.logger.error(
+                            'Exception when ending killed job %s', job.ID,
+                            exc_info=True)
+                    finally:
+                        self.jobs.release(job)
+            if killed_jobs:
+                self.jobs.record(*killed_jobs)
+                self.sub_ctrl.resume()
+
+    def _end_job(self, job):
+        """Change job from running to killed.
+        
+        The job must have been claimed (see JobCollection.claim_running).
+        """
+        multiuser_down = job.end_running(qpyconst.JOB_ST_KILLED,
+                                         len(self.jobs.queue),
+                                         self.config)
+        if multiuser_down:
+            self.multiuser_alive.clear()
+        else:
+            self.multiuser_alive.set()
+        self.jobs.mv(job, self.jobs.running, self.jobs.killed)
+        qpymetrics.metrics.count('jobs killed')
+        self.config.logger.info('Job %s changed to killed.', job.ID)
 
 
 class Submission(threading.Thread):
@@ -168,24 +319,39 @@ class Submission(threading.Thread):
     muHandler (MULTIUSER_HANDLER)  The multiuser_handler
     config (Configurations)        qpy configurations
     finish (Event)                 Set this Event to terminate this Thread
-    skip_jobs_submission (int)     Skip the submission by this amount of cicles
+    wake (Event)                   Set this Event to start a cycle now
+    skip_until (float)             The submission is skipped until this
+                                   time (of time.monotonic), see _skip
     submit_jobs (bool)             Jobs are submitted only if True
     
     Behaviour:
     This thread looks the jobs.queue and try to submit tje jobs,
-    asking for a node to qpy-multiuser and making the submission if
-    a node is given.
+    asking for nodes to qpy-multiuser and making the submission of
+    the jobs that received a node.
+    
+    At each cycle, up to config.sub_batch_size jobs from the head of
+    the queue are sent in a single request to qpy-multiuser, and the
+    jobs that receive a node are started concurrently.
 
-    Each cycle is done at each config.sleep_time_sub_ctrl seconds.
+    Each cycle is done at each config.sleep_time_sub_ctrl seconds, or
+    as soon as wake is set (for example, when a job is submitted), thus
+    new jobs do not wait for the full interval.
+    
+    If qpy-multiuser is down or gives no node, the submission is skipped
+    for 30 times config.sleep_time_sub_ctrl, however many times wake
+    is set. Events that free cores or continue the queue end this
+    earlier, by resume.
     """
 
     __slots__ = (
-        'jobs'
-        'muHandler'
-        'config'
-        'finish'
-        'skip_job_sub'
-        'submit_jobs')
+        'jobs',
+        'muHandler',
+        'config',
+        'finish',
+        'wake',
+        'skip_until',
+        'submit_jobs',
+        '_resumed')
 
     def __init__(self, jobs, muHandler, config):
         """Initiate the class.
@@ -200,42 +366,136 @@ class Submission(threading.Thread):
         self.config = config
         threading.Thread.__init__(self)
         self.finish = threading.Event()
-        self.skip_job_sub = 0
+        self.wake = threading.Event()
+        self.skip_until = 0.0
         self.submit_jobs = True
+        self._resumed = False
+
+    def _skip(self):
+        """Skip the submission for 30 cycles, unless resumed in this cycle."""
+        if not self._resumed:
+            self.skip_until = (monotonic()
+                               + 30 * self.config.sleep_time_sub_ctrl)
+
+    def _skipping(self):
+        """Return True if the submission is being skipped."""
+        return monotonic() < self.skip_until
+
+    def resume(self):
+        """Start a cycle now, even if the submission is being skipped.
+        
+        Call this when cores are freed, for example when jobs end or
+        are killed, or when the queue is continued.
+        """
+        self._resumed = True
+        self.skip_until = 0.0
+        self.wake.set()
+
+    def _start_job(self, job):
+        """Start a job that already has a node; return True if successful."""
+        self.config.logger.debug('Submitting job in %r', job.node)
+        try:
+            job.run(self.config)
+        except:
+            self.config.logger.error(
+                "Exception in when submitting job",
+                exc_info=True)
+            multiuser_down = job.end_running(qpyconst.JOB_ST_QUEUE,
+                                             len(self.jobs.queue),
+                                             self.config)
+            job.node = None
+            if multiuser_down:
+                self.muHandler.multiuser_alive.clear()
+            else:
+                self.muHandler.multiuser_alive.set()
+            return False
+        return True
+
+    def _abort_start(self, job):
+        """Kill a job removed from the queue while it was being started.
+        
+        Its process is killed and its cores are given back to
+        qpy-multiuser; the job stays in undone.
+        """
+        self.config.logger.info('Job %s was removed from the queue while'
+                                ' being started: killing it.', job.ID)
+        _kill_on_node(job.node, [job], self.config)
+        multiuser_down = job.end_running(qpyconst.JOB_ST_UNDONE,
+                                         len(self.jobs.queue),
+                                         self.config)
+        if multiuser_down:
+            self.muHandler.multiuser_alive.clear()
+        else:
+            self.muHandler.multiuser_alive.set()
+
+    def _start_jobs(self, to_start):
+        """Start jobs that already have a node, concurrently.
+        
+        Behaviour:
+        The started jobs are moved from queue to running under the
+        jobs lock. A job that is no longer in the queue was removed
+        (qpy kill, see JobCollection.unqueue) while being started: it
+        is killed and its cores are released (see _abort_start).
+        
+        Return:
+        The list of jobs moved to running.
+        """
+        with ThreadPoolExecutor(max_workers=len(to_start)) as executor:
+            started = list(executor.map(self._start_job, to_start))
+        moved = []
+        removed = []
+        with self.jobs.lock:
+            for job, job_started in zip(to_start, started):
+                if job not in self.jobs.queue:
+                    removed.append((job, job_started))
+                elif job_started:
+                    self.jobs.remove(job, self.jobs.Q)
+                    self.jobs.mv(job, self.jobs.queue, self.jobs.running)
+                    moved.append(job)
+        for job, job_started in removed:
+            try:
+                if job_started:
+                    self._abort_start(job)
+                else:
+                    job.status = qpyconst.JOB_ST_UNDONE
+            except Exception:
+                self.config.logger.error(
+                    'Exception when aborting the start of job %s', job.ID,
+                    exc_info=True)
+        if moved or removed:
+            self.jobs.record(*moved, *[job for job, _ in removed])
+        return moved
 
     def run(self):
         """Submit the jobs, see class documentation."""
-        jobs_modification = False
         if not self.muHandler.multiuser_alive.is_set():
-            self.skip_job_sub = 30
-        i_next_job = -1
+            self._skip()
+        i_first_job = 0
         while not self.finish.is_set():
+            # Cleared before the cycle: a wake during the cycle is
+            # not lost, and the next cycle starts right away
+            self._resumed = False
+            self.wake.clear()
             if ((not self.muHandler.multiuser_alive.is_set())
-                    and self.skip_job_sub == 0):
+                    and not self._skipping()):
                 self.muHandler.add_to_multiuser()
                 if not self.muHandler.multiuser_alive.is_set():
-                    self.skip_job_sub = 30
-            if self.submit_jobs and self.skip_job_sub == 0:
-                if len(self.jobs.Q) != 0:
-                    i_next_job = (i_next_job
-                                  if abs(i_next_job) <= len(self.jobs.Q) else
-                                  -1)
-                    next_jobID = self.jobs.Q[i_next_job].ID
-                    next_Ncores = self.jobs.Q[i_next_job].n_cores
-                    next_mem = self.jobs.Q[i_next_job].mem
-                    next_node_attr = self.jobs.Q[i_next_job].node_attr
+                    self._skip()
+            if self.submit_jobs and not self._skipping():
+                batch = self.jobs.Q_head(i_first_job,
+                                         self.config.sub_batch_size)
+                if not batch and i_first_job > 0:
+                    i_first_job = 0
+                    batch = self.jobs.Q_head(i_first_job,
+                                             self.config.sub_batch_size)
+                if batch:
                     try:
-                        msg_back = qpycomm.message_transfer(
-                            (qpyconst.MULTIUSER_REQ_CORE,
+                        msg_back = qpycomm.multiuser_channel.request(
+                            (qpyconst.MULTIUSER_REQ_CORES,
                              (qpysys.user,
-                              next_jobID,
-                              next_Ncores,
-                              next_mem,
                               len(self.jobs.queue),
-                              next_node_attr)),
-                            qpycomm.multiuser_address,
-                            qpycomm.multiuser_port,
-                            qpycomm.multiuser_key)
+                              [(job.ID, job.n_cores, job.mem, job.node_attr)
+                               for job in batch])))
                     except:
                         self.muHandler.multiuser_alive.clear()
                         self.config.messages.add(
@@ -245,47 +505,30 @@ class Submission(threading.Thread):
                         self.config.logger.error(
                             'Exception in SUB_CTRL message transfer',
                             exc_info=True)
-                        self.skip_job_sub = 30
+                        self._skip()
                     else:
-                        status, allocated_node = msg_back
+                        status, results = msg_back
                         self.muHandler.multiuser_alive.set()
                         self.config.logger.info('Message from multiuser:\n%s',
                                                 msg_back)
-                        if status == 0:
-                            job = self.jobs.Q[i_next_job]
-                            job.node = self.jobs.add_node(allocated_node)
-                            self.config.logger.debug('Submitting job in %r',
-                                                     job.node)
-                            try:
-                                job.run(self.config)
-                            except:
-                                self.config.logger.error(
-                                    "Exception in when submitting job",
-                                    exc_info=True)
-                                multiuser_down = job.end_running(qpyconst.JOB_ST_QUEUE,
-                                                                 len(self.jobs.queue),
-                                                                 self.config)
-                                job.node = None
-                                if multiuser_down:
-                                    self.muHandler.multiuser_alive.clear()
-                                else:
-                                    self.muHandler.multiuser_alive.set()
-                            else:
-                                job = self.jobs.Q_pop(i_next_job)
-                                self.jobs.mv(job,
-                                             self.jobs.queue,
-                                             self.jobs.running)
-                                jobs_modification = True
-                        elif status == 1 and abs(i_next_job) < len(self.jobs.Q):
-                            i_next_job -= 1
+                        if status != 0:
+                            i_first_job = 0
+                            self._skip()
                         else:
-                            i_next_job = -1
-                            self.skip_job_sub = 30
-                if jobs_modification:
-                    self.jobs.write_all_jobs()
-                    jobs_modification = False
+                            to_start = []
+                            for job, (job_status, allocated_node) in zip(
+                                    batch, results):
+                                if job_status == 0:
+                                    job.node = self.jobs.add_node(
+                                        allocated_node)
+                                    to_start.append(job)
+                            if to_start:
+                                self._start_jobs(to_start)
+                            elif i_first_job + len(batch) < len(self.jobs.Q):
+                                i_first_job += len(batch)
+                            else:
+                                i_first_job = 0
+                                self._skip()
             else:
-                if self.skip_job_sub > 0:
-                    self.skip_job_sub -= 1
                 self.config.messages.add("SUB_CTRL: Skipping job submission.")
-            sleep(self.config.sleep_time_sub_ctrl)
+            self.wake.wait(self.config.sleep_time_sub_ctrl)
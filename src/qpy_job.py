@@ -1,13 +1,19 @@
 """ qpy - A job (a code being or to be executed in a node)
 
 """
-from collections import deque
 from datetime import datetime
+from itertools import islice
+from functools import lru_cache
 import threading
+import struct
+import mmap
+import math
 import glob
+import shlex
 import re
 import os
 import sys
+from optparse import OptionParser
 
 import termcolor.termcolor as termcolour
 
@@ -15,11 +21,92 @@ import qpy_system as qpysys
 import qpy_constants as qpyconst
 import qpy_communication as qpycomm
 import qpy_nodes_management as qpynodes
+import qpy_metrics as qpymetrics
+import qpy_useful_cosmetics as qpyutil
 from qpy_parser import ParseError
+from qpy_exceptions import qpyHelpException
 
 
 jobID_pattern = re.compile('export QPY_JOB_ID=([0-9]+);')
 
+# Binary snapshot of the jobs (see _write_snapshot):
+# header: magic, version, number of jobs, number of strings
+_SNAPSHOT_HEADER = struct.Struct('<4sHII')
+_SNAPSHOT_MAGIC = b'QPYJ'
+_SNAPSHOT_VERSION = 1
+# one record per job:
+# ID, status, n_cores, mem, use_script_copy,
+# queue_time, start_time, end_time (epoch, NaN for None),
+# and indices in the string table (-1 for None) of:
+# command, directory, node, node_attr, and cp_script_to_replace
+_SNAPSHOT_JOB = struct.Struct('<qBIdBdddiiiiii')
+_SNAPSHOT_STR_LEN = struct.Struct('<I')
+
+def _str_node(job):
+    try:
+        return str(job.node)
+    except:
+        return 'None'
+
+
+def _fmt_notes(job):
+    notes_file = qpysys.notes_dir + 'notes.' + str(job.ID)
+    try:
+        with open(notes_file, 'r') as f:
+            return '\n' + f.read()
+    except OSError:
+        return ''
+
+
+# The fields of Job.fmt: for each key, the expression that gives the
+# field of the job, as a string
+_JOB_FMT_FIELDS = {
+    'j': 'str(job.ID)',
+    's': 'JOB_STATUS[job.status]',
+    'c': 'job.info[0]',
+    'd': 'job.info[1]',
+    'a': "' '.join(job.node_attr)",
+    'N': 'str(job.n_cores)',
+    'm': 'str(job.mem)',
+    'n': '_str_node(job)',
+    'A': ("(_str_node(job) if (job.node is not None)"
+          " else ('[' + ' '.join(job.node_attr) + ']'))"),
+    'Q': 'str(job.queue_time)',
+    'S': 'str(job.start_time)',
+    'E': 'str(job.end_time)',
+    'R': 'str(job.run_duration_())',
+    'K': '_fmt_notes(job)'}
+_JOB_FMT_KEYS = re.compile('%([' + ''.join(_JOB_FMT_FIELDS) + '])')
+_JOB_FMT_NAMESPACE = {'JOB_STATUS': qpyconst.JOB_STATUS,
+                      '_str_node': _str_node,
+                      '_fmt_notes': _fmt_notes}
+
+
+@lru_cache(maxsize=64)
+def compile_job_fmt(pattern):
+    """Compile a pattern of Job.fmt
+    
+    Arguments:
+    pattern (str)     The pattern, see Job.fmt
+    
+    Return:
+    A function that receives a job and returns it formatted.
+    Only the fields present in the pattern are computed, and
+    the string is built in a single join.
+    """
+    parts = []
+    for i, part in enumerate(_JOB_FMT_KEYS.split(pattern)):
+        if i % 2:
+            parts.append(_JOB_FMT_FIELDS[part])
+        elif part:
+            parts.append(repr(part))
+    return eval('lambda job: '
+                + ("''.join((" + ', '.join(parts) + ',))'
+                   if parts else
+                   "''"),
+                _JOB_FMT_NAMESPACE)
+
+
 class JobId(object):
     """The job ID.
     
@@ -136,6 +223,213 @@ class MultiuserJob(object):
                 + ", mem = " + str(self.mem))
 
 
+class JobOptParser(OptionParser):
+    """A parser for the job options
+    
+    Behaviour:
+    
+    A Job in qpy can be submitted with several options,
+    and the purpose of this class is to handle these options.
+    These options can be passed by command line:
+    
+    $ qpy sub -m 0.1 date
+    
+    where the options are flagged with the -<letter> and --<word>
+    conventions. If the command to be submitted is a script (with its
+    full path), options can be given inside the script, for example:
+    
+    $ cat ./script.sh
+    #QPY mem=0.1
+    sleep
+    $ qpy sub ./script.sh
+    
+    The options inside the script should follow the convention:
+
+    #QPY <key>=<value>; <key>  = <value>
+    #QPY <key> = <value>
+
+    That is: each line has several pairs <key> <value>,
+    separated by semicolon: ";".
+    The pairs <key> <value> should be separated
+    by the equal sign: "=".
+    The number of spaces around the equal and semicolon signs
+    is arbitrary.
+    There are, in general, several possible keys with the same effect
+    
+    The possible options are:
+    
+    ## Number of cores (integer) requested for this job:
+    
+    command line flags:  -n, --cores
+    keys for script:     n_cores, number of cores
+    
+    ## Memory (float) in GB requested for this job:
+    
+    command line flags:  -m, --mem, --memory
+    keys for script:     mem, memory
+    
+    ## Attributes of the nodes for this job. It can be any logical expression
+    of Python, that can have node attributes that will be replaced by a boolean
+    (indicating whether the node has that attribute). If passed by command
+    line, this logical expression can not have spaces.
+
+    command line flags:  -a, --node_attr, --attributes
+    keys for script:     node_attr, node attributes
+
+    ## If flagged (in command line) or set to true in the script,
+    copies the script, such that the original version is submitted
+
+    command line flags: -c, --copyScript
+    keys for script:    copy script, cpScript, cp_script
+    
+    NOTE:
+    Optparse is deprecated.
+    The overwritten
+    functions are somewhat mentioned in the documentation.
+    
+    TODO:
+    replace it by argparse
+    """
+    def exit(self, prog='', message=''):
+        raise ParseError(message)
+    
+    def error(self, message):
+        raise ParseError(message)
+    
+    def print_usage(self):
+        pass
+    
+    def print_version(self):
+        pass
+    
+    def print_help(self):
+        raise qpyHelpException(self.format_help())
+
+    @classmethod
+    def set_parser(cls):
+        """Instantiate a parser and set flags for command line."""
+        parser = cls()
+        parser.add_option("-n", "--cores", dest="cores",
+                          help="set the number of cores", default="1")
+        parser.add_option("-m", "--mem", "--memory", dest="memory",
+                          help="set the memory in GB", default="5")
+        parser.add_option("-a", "--node_attr", "--attributes",
+                          dest="node_attr",
+                          help="set the attributes for node", default='')
+        parser.add_option("-c", "--copyScript", dest="cpScript",
+                          help="script should be copied",
+                          action='store_false')
+        parser.add_option("-o", "--originalScript", dest="orScript",
+                          help="use original script",
+                          action='store_false')
+        parser.disable_interspersed_args()
+        return parser
+
+    def _scanline(self, line, options):
+        """Parse the line for qpy options.
+        
+        Arguments:
+        line (str)       The line to be parsed
+        options (dict)   A dictionary with the options
+        
+        Behaviour:
+        If the line sets some qpy option, put it in options
+        
+        Raise:
+        ParseError   In case there is an error in the syntax
+        """
+        if line[0:5] == '#QPY ':
+            line_split = line[5:].split(';')
+            for kv in line_split:
+                if kv:
+                    try:
+                        k, v = [x.strip() for x in kv.split('=')]
+                    except ValueError:
+                        raise ParseError(
+                            'Invalid syntax for options inside script: ' + kv)
+                    try:
+                        if k in ['number of cores',
+                                 'n_cores']:
+                            options['n_cores'] = int(v)
+                        elif k in ['memory',
+                                   'mem']:
+                            options['mem'] = float(v)
+                        elif k in ['node attributes',
+                                   'node_attr']:
+                            options['node_attr'] = v.split()
+                        elif k in ['copy script',
+                                   'cpScript',
+                                   'cp_script']:
+                            options['use_script_copy'] = (
+                                qpyutil.true_or_false(v))
+                        else:
+                            raise ParseError('Unknown script option: ' + k)
+                    except ValueError:
+                        raise ParseError(
+                            "Invalid value for {0}: {1}.".format(k, v))
+
+    def parse_file(self, file_name, options):
+        """Parse a submission script file for options set in the script.
+        
+        Arguments::
+        file_name (str)     The file name
+        options (dict)      A dictionary with the options that can be set
+        
+        Raise:
+        ParseError   In case there is an error in the syntax
+        
+        See also:
+        _scanline
+        """
+        try:
+            with open(file_name, 'r') as f:
+                for line in f:
+                    self._scanline(line, options)
+        except IOError:
+            pass
+
+    def parse_cmd_line(self, command, options):
+        """Parse the command for options.
+        
+        Arguments:
+        command (str)     The command to be parsed
+        options (dict)    The options to be set
+        
+        Behaviour:
+        Set the options found in the command and return the
+        command free of these options.
+        
+        Return:
+        The command, without the parsed options.
+        
+        Raise:
+        ParseError    if the parse was not successful
+        """
+        try:
+            parsed_opt, command = self.parse_args(command.split())
+            options['n_cores'] = int(parsed_opt.cores)
+            options['mem'] = float(parsed_opt.memory)
+            if parsed_opt.node_attr:
+                options['node_attr'] = parsed_opt.node_attr.split('##')
+            else:
+                options['node_attr'] = []
+            if parsed_opt.cpScript is None and parsed_opt.orScript is None:
+                pass
+            elif (parsed_opt.cpScript is not None
+                  and parsed_opt.orScript is not None):
+                raise ParseError(
+                    "Please, do not supply both cpScript and orScript")
+            elif parsed_opt.cpScript is not None:
+                options['use_script_copy'] = True
+            else:
+                options['use_script_copy'] = False
+        except ValueError:
+            raise ParseError(
+                "Please supply only numbers for memory or"
+                + " number of cores, true or false for cpScript")
+        return ' '.join(command)
+
+
 class Job(object):
     """A job submitted by the user.
     
@@ -269,6 +563,61 @@ class Job(object):
         job_str += '\n'
         return job_str
 
+    @classmethod
+    def from_string(cls, x, config):
+        """Construct a job from a string, as given by str(job)
+        
+        Arguments:
+        x (str)                    The four lines that describe the job
+        config (Configurations)    qpy configurations
+        
+        Behaviour:
+        The attribute node of the returned job is the string that
+        describes the node (see qpynodes.UsersNode), or None. The
+        caller should replace it by the corresponding node.
+        
+        Raise:
+        ValueError, IndexError if the string is not correctly formatted
+        """
+        lines = x.split('\n')
+        line_spl = lines[0].split()
+        # old way.
+        # Remove as soon as everybody has new version working
+        if len(line_spl) == 4:
+            use_script_copy = False
+            cp_script_to_replace = None
+        else:
+            use_script_copy = line_spl[4] == 'true'
+            if len(line_spl) == 5:
+                cp_script_to_replace = None
+            else:
+                cp_script_to_replace = (line_spl[5],
+                                        line_spl[6])
+        node_and_times = lines[1].strip().split('---')
+        if len(node_and_times) == 1:
+            times = ['None', 'None', 'None']
+        else:
+            times = node_and_times[1:]
+        lspl = lines[3].split()
+        new_job = cls(int(line_spl[0]),
+                      [lines[2].strip(), lspl[0]],
+                      config)
+        new_job.status = int(line_spl[1])
+        new_job.n_cores = int(line_spl[2])
+        new_job.mem = float(line_spl[3])
+        new_job.use_script_copy = use_script_copy
+        new_job.cp_script_to_replace = cp_script_to_replace
+        new_job.queue_time, new_job.start_time, new_job.end_time = (
+            None if t == 'None' else datetime.fromisoformat(t)
+            for t in times)
+        if new_job.end_time is not None:
+            new_job.run_duration_()
+        new_job.node = (None
+                        if node_and_times[0] == 'None' else
+                        node_and_times[0])
+        new_job.node_attr = [] if len(lspl) == 1 else lspl[1:]
+        return new_job
+
     def fmt(self, pattern):
         """Format the job in a string according to the pattern.
         
@@ -296,52 +645,55 @@ class Job(object):
         Return:
         A string with the job formatted as described above
         
-        TODO:
-        Call run_duration only if needed. Currently does all the time.
+        Only the fields present in pattern are computed
+        (see compile_job_fmt).
+        """
+        return compile_job_fmt(pattern)(self)
+
+    def status_file(self):
+        """The file where the job writes its exit status when finished."""
+        return qpysys.job_status_dir + 'job_' + str(self.ID) + '.status'
+
+    def pgid_file(self):
+        """The file where the job writes its process group ID when started."""
+        return qpysys.job_pgid_dir + 'job_' + str(self.ID) + '.pgid'
+
+    def pgid(self):
+        """The process group ID of the job, or None if it is not known.
+        
+        Jobs started by older versions of qpy, or whose shell
+        did not write the pgid file yet, have no known pgid.
         """
-        job_str = pattern
         try:
-            str_node = str(self.node)
-        except:
-            str_node = 'None'
-
-        if '%K' in job_str:
-            if os.path.isfile(qpysys.notes_dir + 'notes.' + str(self.ID)):
-                f = open(qpysys.notes_dir + 'notes.' + str(self.ID), 'r')
-                notes = f.read()
-                f.close()
-                job_str = job_str.replace('%K', '\n' + notes)
-            else:
-                job_str = job_str.replace('%K', '')
-
-        for pattern, info in (('%j', str(self.ID)),
-                              ('%s', qpyconst.JOB_STATUS[self.status]),
-                              ('%c', self.info[0]),
-                              ('%d', self.info[1]),
-                              ('%a', ' '.join(self.node_attr)),
-                              ('%N', str(self.n_cores)),
-                              ('%m', str(self.mem)),
-                              ('%n', str_node),
-                              ('%A', str_node if (self.node is not None)
-                               else ('[' + ' '.join(self.node_attr) + ']')),
-                              ('%Q', str(self.queue_time)),
-                              ('%S', str(self.start_time)),
-                              ('%E', str(self.end_time)),
-                              ('%R', str(self.run_duration_()))
-                              ):
-            job_str = job_str.replace(pattern, info)
-        return job_str
+            with open(self.pgid_file(), 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
 
     def run(self, config):
-        """Run the job."""
+        """Run the job.
+        
+        Behaviour:
+        The command is started on self.node, with its stdout and stderr
+        redirected to files in the working directory. When it finishes,
+        the shell writes its exit status in self.status_file().
+        
+        The job runs in its own session (setsid), thus its shell is the
+        leader of a process group that contains all processes of the job.
+        The shell writes this process group ID in self.pgid_file(), used
+        to check (is_running) and kill (qpy_job_killer.py) the job.
+        """
         def out_or_err_name(job, postfix):
             assert(postfix in ['.out', '.err'])
             return ('{dir}/job_{id}{postfix}'.format(dir=job.info[1],
                                                      id=str(job.ID),
                                                      postfix=postfix))
         command = []
+        command.append('echo $$ > {0}'.format(self.pgid_file()))
         command.append('exec > {0}'.format(out_or_err_name(self, '.out')))
         command.append('exec 2> {0}'.format(out_or_err_name(self, '.err')))
+        command.append("trap 'echo $? > {0}' EXIT".format(
+            self.status_file()))
         command.append('export QPY_JOB_ID={0}'.format(self.ID))
         command.append('export QPY_NODE={0}'.format(self.node))
         command.append('export QPY_N_CORES={0}'.format(self.n_cores))
@@ -359,21 +711,28 @@ class Job(object):
                                      1))
         except:
             command.append(self.info[0])
-        command = '; '.join(command)
+        command = 'setsid bash -c ' + shlex.quote('; '.join(command))
         config.logger.info("Sending command:\n%s", command)
         try:
-            qpycomm.node_exec(self.node.address,
-                              command,
-                              get_outerr=False,
-                              pKey_file=config.ssh_p_key_file,
-                              localhost_popen_shell=(
-                                  self.node.address == 'localhost'))
+            pid = qpycomm.node_exec(self.node.address,
+                                    command,
+                                    get_outerr=False,
+                                    pKey_file=config.ssh_p_key_file,
+                                    localhost_popen_shell=(
+                                        self.node.address == 'localhost'))
         except:
             config.logger.error("Exception in run", exc_info=True)
             raise Exception("Exception in run: " + str(sys.exc_info()[1]))
+        config.logger.info("Job %s started on %s with PID %s",
+                           self.ID, self.node, pid)
         self.node.add_job()
         self.start_time = datetime.today()
         self.status = qpyconst.JOB_ST_RUNNING
+        qpymetrics.metrics.count('jobs started')
+        if self.queue_time is not None:
+            qpymetrics.metrics.add(
+                'submit to start',
+                (self.start_time - self.queue_time).total_seconds())
 
     def is_running(self, config):
         """Check if the job is running.
@@ -387,11 +746,23 @@ class Job(object):
         Raise:
         Exceptions from the SSH connection if the
         connection to the node is not successful.
+        
+        Behaviour:
+        If the process group of the job is known, this is just a
+        kill -0 to it. Otherwise the output of ps is searched for the job.
         """
-        command = 'ps -fu ' + qpysys.sys_user
-        (std_out, std_err) = qpycomm.node_exec(self.node.address,
-                                               command,
-                                               pKey_file=config.ssh_p_key_file)
+        pgid = self.pgid()
+        if pgid is None:
+            command = 'ps -fu ' + qpysys.sys_user
+        else:
+            command = _alive_command(self.ID, pgid)
+        (std_out, std_err) = qpycomm.node_exec(
+            self.node.address,
+            command,
+            pKey_file=config.ssh_p_key_file,
+            localhost_popen_shell=(self.node.address == 'localhost'))
+        if pgid is not None:
+            return self.ID in _extract_alive_jobIDs(std_out)
         re_res = re.search('export QPY_JOB_ID=' + str(self.ID) + ';', std_out)
         if (re_res):
             return True
@@ -404,16 +775,17 @@ class Job(object):
         self.end_time = datetime.today()
         self.run_duration_()
         self.node.remove_job()
+        try:
+            os.remove(self.pgid_file())
+        except OSError:
+            pass
         if (self.cp_script_to_replace is not None):
             if (os.path.isfile(self.cp_script_to_replace[1])):
                 os.remove(self.cp_script_to_replace[1])
         try:
-            msg_back = qpycomm.message_transfer(
+            msg_back = qpycomm.multiuser_channel.request(
                 (qpyconst.MULTIUSER_REMOVE_JOB,
-                 (qpysys.user, self.ID, queue_size)),
-                qpycomm.multiuser_address,
-                qpycomm.multiuser_port,
-                qpycomm.multiuser_key)
+                 (qpysys.user, self.ID, queue_size)))
         except:
             multiuser_down = True
             config.logger.error(
@@ -486,6 +858,152 @@ class Job(object):
         return req
 
 
+def _write_snapshot(jobs, file_name):
+    """Write the jobs in the binary snapshot file file_name.
+    
+    Arguments:
+    jobs (iterable of Job)   The jobs to be written
+    file_name (str)          The file name
+    
+    Behaviour:
+    The file has a header (see _SNAPSHOT_HEADER), followed by one
+    fixed size record for each job (see _SNAPSHOT_JOB) and by the
+    table of strings. All strings of the jobs (commands, directories,
+    nodes, etc) are stored only once in the table, and the records
+    have their indices. Times are stored as epoch floats.
+    """
+    strings = {}
+
+    def str_index(x):
+        if x is None:
+            return -1
+        try:
+            return strings[x]
+        except KeyError:
+            strings[x] = len(strings)
+            return strings[x]
+
+    def epoch(t):
+        return math.nan if t is None else t.timestamp()
+
+    records = []
+    for job in jobs:
+        cp_script = (job.cp_script_to_replace
+                     if job.cp_script_to_replace is not None else
+                     (None, None))
+        records.append(_SNAPSHOT_JOB.pack(
+            job.ID,
+            job.status,
+            job.n_cores,
+            job.mem,
+            job.use_script_copy,
+            epoch(job.queue_time),
+            epoch(job.start_time),
+            epoch(job.end_time),
+            str_index(job.info[0]),
+            str_index(job.info[1]),
+            str_index(None if job.node is None else repr(job.node)),
+            str_index(' '.join(job.node_attr) if job.node_attr else None),
+            str_index(cp_script[0]),
+            str_index(cp_script[1])))
+    with open(file_name, 'wb') as f:
+        f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC,
+                                      _SNAPSHOT_VERSION,
+                                      len(records),
+                                      len(strings)))
+        f.write(b''.join(records))
+        for x in strings:
+            x = x.encode('utf-8')
+            f.write(_SNAPSHOT_STR_LEN.pack(len(x)))
+            f.write(x)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_snapshot(file_name, config):
+    """Read the jobs from the binary snapshot file file_name.
+    
+    Arguments:
+    file_name (str)            The file name
+    config (Configurations)    qpy configurations
+    
+    Return:
+    A list of Job. As in Job.from_string, the attribute node of
+    these jobs is the string that describes the node, or None.
+    
+    Raise:
+    ValueError if the file is not a valid snapshot
+    
+    See also:
+    _write_snapshot
+    """
+    with open(file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError('Empty snapshot file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, n_jobs, n_strings = _SNAPSHOT_HEADER.unpack_from(
+                mm, 0)
+            if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+                raise ValueError('Unknown format of snapshot file')
+            pos = _SNAPSHOT_HEADER.size
+            records_end = pos + n_jobs * _SNAPSHOT_JOB.size
+            records = list(_SNAPSHOT_JOB.iter_unpack(mm[pos:records_end]))
+            pos = records_end
+            strings = []
+            for i in range(n_strings):
+                str_len, = _SNAPSHOT_STR_LEN.unpack_from(mm, pos)
+                pos += _SNAPSHOT_STR_LEN.size
+                strings.append(mm[pos:pos + str_len].decode('utf-8'))
+                pos += str_len
+
+    def from_epoch(t):
+        return None if math.isnan(t) else datetime.fromtimestamp(t)
+
+    jobs = []
+    for (jobID, status, n_cores, mem, use_script_copy,
+         queue_time, start_time, end_time,
+         i_command, i_dir, i_node, i_node_attr,
+         i_cp_from, i_cp_to) in records:
+        new_job = Job(jobID, [strings[i_command], strings[i_dir]], config)
+        new_job.status = status
+        new_job.n_cores = n_cores
+        new_job.mem = mem
+        new_job.use_script_copy = bool(use_script_copy)
+        new_job.cp_script_to_replace = (None
+                                        if i_cp_from < 0 else
+                                        (strings[i_cp_from],
+                                         strings[i_cp_to]))
+        new_job.queue_time = from_epoch(queue_time)
+        new_job.start_time = from_epoch(start_time)
+        new_job.end_time = from_epoch(end_time)
+        if new_job.end_time is not None:
+            new_job.run_duration_()
+        new_job.node = None if i_node < 0 else strings[i_node]
+        new_job.node_attr = ([]
+                             if i_node_attr < 0 else
+                             strings[i_node_attr].split())
+        jobs.append(new_job)
+    return jobs
+
+
+def _alive_command(jobID, pgid):
+    """The shell command that tells if the process group pgid is alive
+    
+    It writes "QPY_ALIVE <jobID>" if the process group exists.
+    """
+    return 'kill -0 -{0} 2> /dev/null && echo QPY_ALIVE {1}'.format(pgid,
+                                                                  jobID)
+
+
+def _extract_alive_jobIDs(out):
+    """Find all jobID in the output of _alive_command"""
+    jobs = []
+    for line in out.split('\n'):
+        if line.startswith('QPY_ALIVE '):
+            jobs.append(int(line.split()[1]))
+    return jobs
+
+
 def _extract_jobID_from_ps(ps_out):
     """Find all jobID in the output of a ps command"""
     jobs = []
@@ -497,6 +1015,79 @@ def _extract_jobID_from_ps(ps_out):
     return jobs
 
 
+class JobList(object):
+    """An ordered collection of jobs, indexed by their ID.
+    
+    Behaviour:
+    The jobs are kept in the order they are added (see append) or in
+    the order given to reorder. Adding, removing and finding a job by
+    its ID are O(1) operations.
+    
+    Data Model:
+    If jl is a JobList and job a Job:
+    
+    len(jl)          the number of jobs
+    job in jl        True if a job with the ID of job is in jl
+    for j in jl:     Iterates over the jobs, in order. This is done over
+                     a copy, so jl can be changed within the loop
+    """
+    __slots__ = ('_jobs',)
+
+    def __init__(self, jobs=()):
+        self._jobs = {job.ID: job for job in jobs}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __iter__(self):
+        return iter(list(self._jobs.values()))
+
+    def __contains__(self, job):
+        return job.ID in self._jobs
+
+    def __repr__(self):
+        return 'JobList(' + repr(list(self._jobs)) + ')'
+
+    def get(self, jobID, default=None):
+        """Return the job with ID jobID, or default if not present."""
+        return self._jobs.get(jobID, default)
+
+    def append(self, job):
+        """Add job at the end."""
+        self._jobs[job.ID] = job
+
+    def remove(self, job):
+        """Remove job.
+        
+        Raise:
+        ValueError if job is not present (as list.remove)
+        """
+        try:
+            del self._jobs[job.ID]
+        except KeyError:
+            raise ValueError(f'Job {job.ID} is not in the list')
+
+    def popleft(self):
+        """Remove and return the first job.
+        
+        Raise:
+        IndexError if empty
+        """
+        try:
+            jobID = next(iter(self._jobs))
+        except StopIteration:
+            raise IndexError('pop from an empty JobList')
+        return self._jobs.pop(jobID)
+
+    def head(self, start, n):
+        """Return a list with up to n jobs, skipping the first start."""
+        return list(islice(self._jobs.values(), start, start + n))
+
+    def reorder(self, jobs):
+        """Replace the content by jobs (an iterable), in that order."""
+        self._jobs = {job.ID: job for job in jobs}
+
+
 class JobCollection(object):
     """Store information about the jobs.
     
@@ -505,14 +1096,21 @@ class JobCollection(object):
     nodes (list of qpynodes.UsersNode)
                                 All the nodes that have been used (since
                                 last restart)
-    all (list)                  All jobs
-    queue (list)                Jobs in queue
-    running (list)              Running jobs
-    done (list)                 Jobs that are done
-    killed (list)               Killed jobs
-    undone (list)               Undone jobs
-    Q (deque)                   The queue
+    all (JobList)               All jobs
+    queue (JobList)             Jobs in queue
+    running (JobList)           Running jobs
+    done (JobList)              Jobs that are done
+    killed (JobList)            Killed jobs
+    undone (JobList)            Undone jobs
+    Q (JobList)                 The queue, in the order that the jobs
+                                should be submitted
     lock (RLock)                To use when dealing with the above lists
+    
+    Behaviour:
+    The jobs are stored in the snapshot file (global)
+    all_jobs_snapshot_file, and every change is appended to the journal (global)
+    all_jobs_journal_file (see record and record_removal). The journal
+    is compacted into a new snapshot when it gets too long.
     """
 
     __slots__ = (
@@ -525,43 +1123,68 @@ class JobCollection(object):
         'killed',
         'undone',
         'Q',
-        'lock')
+        'lock',
+        '_ending',
+        '_journal',
+        '_n_journal')
     
-    def __init__(self, config):
+    def __init__(self, config, load_old_jobs=True):
         """Initiate the class.
         
         Arguments:
         config (Configurations)      qpy configurations
+        load_old_jobs (bool)         (optional, default = True) If False,
+                                     the collection starts empty, without
+                                     reading the files (for tests)
         """
         self.config = config
         self.nodes = []
-        self.all = []
-        self.queue = []
-        self.running = []
-        self.done = []
-        self.killed = []
-        self.undone = []
-        self.Q = deque()
+        self.all = JobList()
+        self.queue = JobList()
+        self.running = JobList()
+        self.done = JobList()
+        self.killed = JobList()
+        self.undone = JobList()
+        self.Q = JobList()
         self.lock = threading.RLock()
-        self.initialize_old_jobs()
+        self._ending = set()
+        self._journal = None
+        self._n_journal = 0
+        if load_old_jobs:
+            self.initialize_old_jobs()
 
-    def Q_pop(self, i=-1):
-        """Pop job of Q, and return it."""
+    def Q_pop(self):
+        """Pop the next job to be submitted of Q, and return it."""
         with self.lock:
-            if i == -1:
-                job = self.Q.pop()
-            else:
-                job = self.Q[i]
-                del self.Q[i]
-        return job
+            return self.Q.popleft()
+
+    def Q_head(self, start, n):
+        """Return up to n jobs from the head of Q, skipping the first start.
+        
+        The jobs are returned in the order they should be submitted.
+        """
+        with self.lock:
+            return self.Q.head(start, n)
 
-    def Q_appendleft(self, job):
-        """Append 'job' to the left of Q."""
+    def Q_append(self, job):
+        """Append 'job' to Q, to be submitted after the jobs already there."""
         with self.lock:
-            self.Q.appendleft(job)
+            self.Q.append(job)
+
+    def get(self, jobID):
+        """Return the job with ID jobID, or None if there is no such job."""
+        return self.all.get(jobID)
+
+    def status_list(self, status):
+        """Return the JobList of the jobs with status."""
+        return {qpyconst.JOB_ST_QUEUE: self.queue,
+                qpyconst.JOB_ST_RUNNING: self.running,
+                qpyconst.JOB_ST_DONE: self.done,
+                qpyconst.JOB_ST_KILLED: self.killed,
+                qpyconst.JOB_ST_UNDONE: self.undone}[status]
 
     def append(self, job, to_list):
-        """Append 'job' to the Q."""
+        """Append 'job' to the list 'to_list'."""
         with self.lock:
             to_list.append(job)
 
@@ -570,6 +1193,60 @@ class JobCollection(object):
         with self.lock:
             from_list.remove(job)
 
+    def unqueue(self, jobIDs=None):
+        """Remove jobs from the queue, as undone
+        
+        Arguments:
+        jobIDs (list)     (optional, default = None) The IDs of the
+                          jobs to remove. If None, all queued jobs
+                          are removed.
+        
+        Behaviour:
+        The jobs are selected and moved under the lock, thus a job
+        that Submission moves to running meanwhile is not touched, and
+        Submission finds out a job removed while it was being started
+        (see Submission._start_jobs).
+        
+        Return:
+        The list of removed jobs.
+        """
+        with self.lock:
+            to_remove = (list(self.queue)
+                         if jobIDs is None else
+                         [job for job in map(self.queue.get, jobIDs)
+                          if job is not None])
+            for job in to_remove:
+                job.status = qpyconst.JOB_ST_UNDONE
+                self.Q.remove(job)
+                self.queue.remove(job)
+                self.undone.append(job)
+        return to_remove
+
+    def claim_running(self, job):
+        """Claim a running job, to end it (as done or killed)
+        
+        Behaviour:
+        A job can be ended by CheckRun or by JobsKiller, that run in
+        different threads, and only one of them should do it. Each
+        should claim the job first, and end it only if this returns
+        True. Call release when finished.
+        
+        Return:
+        True if the job is running and was not claimed yet.
+        """
+        with self.lock:
+            if (job.status != qpyconst.JOB_ST_RUNNING
+                or job not in self.running
+                    or job.ID in self._ending):
+                return False
+            self._ending.add(job.ID)
+            return True
+
+    def release(self, job):
+        """Release a job claimed by claim_running."""
+        with self.lock:
+            self._ending.discard(job.ID)
+
     def mv(self, job, from_list, to_list):
         """Move the 'job' from 'from_list' to 'to_list'."""
         with self.lock:
@@ -604,22 +1281,73 @@ class JobCollection(object):
             for job in self.all:
                 if (job.asked(pattern)):
                     asked_jobs.append(job)
-        req_jobs = ''
-        for job in asked_jobs:
-            j_str = job.fmt(config.job_fmt_pattern)
-            if (config.use_colour):
-                j_str = termcolour.colored(j_str,
-                                           config.colour_scheme[job.status])
-            req_jobs += j_str
-        return req_jobs
+        job_fmt = compile_job_fmt(config.job_fmt_pattern)
+        req_jobs = []
+        if (config.use_colour):
+            # The colour codes before and after the text, for each status
+            colours = [termcolour.colored('\0', colour).split('\0')
+                       for colour in config.colour_scheme]
+            for job in asked_jobs:
+                colour = colours[job.status]
+                req_jobs.append(colour[0])
+                req_jobs.append(job_fmt(job))
+                req_jobs.append(colour[1])
+        else:
+            req_jobs = [job_fmt(job) for job in asked_jobs]
+        return ''.join(req_jobs)
 
     def write_all_jobs(self):
-        """Write jobs in file (global) all_jobs_file."""
+        """Write jobs in file (global) all_jobs_snapshot_file and clean
+        the journal.
+        
+        Behaviour:
+        The snapshot is written in a temporary file that replaces
+        all_jobs_snapshot_file only when complete, such that a crash
+        does not leave a partially written snapshot. The journal is
+        emptied afterwards, since all its records are in the snapshot.
+        """
+        with self.lock, qpymetrics.metrics.timer('write_all_jobs'):
+            tmp_file = qpysys.all_jobs_snapshot_file + '.tmp'
+            _write_snapshot(self.all, tmp_file)
+            os.replace(tmp_file, qpysys.all_jobs_snapshot_file)
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(qpysys.all_jobs_journal_file, 'w')
+            self._n_journal = 0
+
+    def _write_journal(self, records, n_records):
+        """Append records to the journal, and compact it if too large."""
         with self.lock:
-            f = open(qpysys.all_jobs_file, 'w')
-            for job in self.all:
-                f.write(str(job))
-            f.close()
+            if self._journal is None:
+                self._journal = open(qpysys.all_jobs_journal_file, 'a')
+            self._journal.write(records)
+            self._journal.flush()
+            self._n_journal += n_records
+            if self._n_journal > max(qpyconst.JOURNAL_MIN_COMPACTION,
+                                     len(self.all)):
+                self.write_all_jobs()
+
+    def record(self, *jobs):
+        """Record the current state of jobs in the journal.
+        
+        Behaviour:
+        Each job is written as a line "+ <jobID>" followed by str(job).
+        This should be called after every change of the jobs, instead
+        of rewriting the whole snapshot. See write_all_jobs.
+        """
+        self._write_journal(''.join('+ ' + str(job.ID) + '\n' + str(job)
+                                    for job in jobs),
+                            len(jobs))
+
+    def record_removal(self, *jobs):
+        """Record in the journal that jobs have been removed.
+        
+        Behaviour:
+        Each job is written as a line "- <jobID>".
+        """
+        self._write_journal(''.join('- ' + str(job.ID) + '\n'
+                                    for job in jobs),
+                            len(jobs))
 
     def multiuser_cur_jobs(self):
         """Return a list of the running jobs as MultiuserJob."""
@@ -635,96 +1363,88 @@ class JobCollection(object):
         return cur_jobs
 
     def initialize_old_jobs(self):
-        """Initialize jobs from file (global) all_jobs_file."""
+        """Initialize jobs from the snapshot and journal files.
+        
+        Behaviour:
+        The jobs are read from the binary snapshot file (global)
+        all_jobs_snapshot_file, or, if it does not exist yet, from
+        the text file of older qpy versions, all_jobs_file. Then the
+        records of the journal, all_jobs_journal_file, are replayed
+        on top of them. An incomplete record at the end of the journal
+        (e.g., from a crash during the writing) is ignored. At the end,
+        the journal is compacted into a new snapshot.
+        """
         self.config.logger.info('Inilialising old jobs')
         with self.lock:
-            if os.path.isfile(qpysys.all_jobs_file):
+            old_jobs = {}
+            if os.path.isfile(qpysys.all_jobs_snapshot_file):
+                for new_job in _read_snapshot(qpysys.all_jobs_snapshot_file,
+                                              self.config):
+                    old_jobs[new_job.ID] = new_job
+            elif os.path.isfile(qpysys.all_jobs_file):
+                self.config.logger.info('Reading jobs from the old format')
                 with open(qpysys.all_jobs_file, 'r') as f:
-                    i = 0
-                    for line in f:
-                        i += 1
-                        if i % 4 == 1:
-                            line_spl = line.split()
-                            new_id = line_spl[0]
-                            new_status = line_spl[1]
-                            new_n_cores = line_spl[2]
-                            new_mem = line_spl[3]
-                            # old way.
-                            # Remove as soon as everybody has new version working
-                            if len(line_spl) == 4:
-                                new_use_script_copy = False
-                                new_cp_script_to_replace = None
-                            else:
-                                new_use_script_copy = (
-                                    True
-                                    if (line_spl[4] == 'true') else
-                                    False)
-                                if len(line_spl) == 5:
-                                    new_cp_script_to_replace = None
-                                else:
-                                    new_cp_script_to_replace = (line_spl[5],
-                                                                line_spl[6])
-                        elif i % 4 == 2:
-                            new_node_and_times = line.strip().split('---')
-                            new_node = new_node_and_times[0]
-                            if len(new_node_and_times) == 1:
-                                new_times = ['None', 'None', 'None']
-                            else:
-                                new_times = new_node_and_times[1:]
-                        elif i % 4 == 3:
-                            new_command = line.strip()
-                        else:
-                            lspl = line.split()
-                            new_wd = lspl[0]
-                            new_node_attr = [] if len(lspl) == 1 else lspl[1:]
-                            new_job = Job(int(new_id),
-                                          [new_command, new_wd],
-                                          self.config)
-                            new_job.n_cores = int(new_n_cores)
-                            new_job.mem = float(new_mem)
-                            if new_times[0] == 'None':
-                                new_job.queue_time = None
-                            else:
-                                new_job.queue_time = datetime.strptime(
-                                    new_times[0],
-                                    "%Y-%m-%d %H:%M:%S.%f")
-                            if new_times[1] == 'None':
-                                new_job.start_time = None
-                            else:
-                                new_job.start_time = datetime.strptime(
-                                    new_times[1],
-                                    "%Y-%m-%d %H:%M:%S.%f")
-                            if new_times[2] == 'None':
-                                new_job.end_time = None
-                            else:
-                                new_job.end_time = datetime.strptime(
-                                    new_times[2],
-                                    "%Y-%m-%d %H:%M:%S.%f")
-                                new_job.run_duration_()
-                            if new_node == 'None':
-                                new_job.node = None
-                            else:
-                                new_job.node = self.add_node(new_node)
-                            new_job.status = int(new_status)
-                            new_job.node_attr = new_node_attr
-                            self.all.append(new_job)
-                            if new_job.status == qpyconst.JOB_ST_QUEUE:
-                                self.queue.append(new_job)
-                                self.Q.appendleft(new_job)
-                            elif new_job.status == qpyconst.JOB_ST_RUNNING:
-                                self.running.append(new_job)
-                                new_job.node.add_job()
-                                new_job.re_run = True
-                            elif new_job.status == qpyconst.JOB_ST_DONE:
-                                self.done.append(new_job)
-                            elif new_job.status == qpyconst.JOB_ST_KILLED:
-                                self.killed.append(new_job)
-                            elif new_job.status == qpyconst.JOB_ST_UNDONE:
-                                self.undone.append(new_job)
-                            self.config.logger.debug('Added old job:\n%s',
-                                                     new_job)
+                    lines = f.readlines()
+                for i in range(0, len(lines) - 3, 4):
+                    new_job = Job.from_string(''.join(lines[i:i+4]),
+                                              self.config)
+                    old_jobs[new_job.ID] = new_job
+            self._replay_journal(old_jobs)
+            for new_job in old_jobs.values():
+                if new_job.node is not None:
+                    new_job.node = self.add_node(new_job.node)
+                self.all.append(new_job)
+                if new_job.status == qpyconst.JOB_ST_QUEUE:
+                    self.queue.append(new_job)
+                    self.Q.append(new_job)
+                elif new_job.status == qpyconst.JOB_ST_RUNNING:
+                    self.running.append(new_job)
+                    new_job.node.add_job()
+                    new_job.re_run = True
+                elif new_job.status == qpyconst.JOB_ST_DONE:
+                    self.done.append(new_job)
+                elif new_job.status == qpyconst.JOB_ST_KILLED:
+                    self.killed.append(new_job)
+                elif new_job.status == qpyconst.JOB_ST_UNDONE:
+                    self.undone.append(new_job)
+                self.config.logger.debug('Added old job:\n%s',
+                                         new_job)
+            self.write_all_jobs()
         self.config.logger.info('Old jobs have been initialized!')
 
+    def _replay_journal(self, old_jobs):
+        """Apply the records of the journal to the dictionary old_jobs.
+        
+        See record and record_removal for the format of the records.
+        """
+        if not os.path.isfile(qpysys.all_jobs_journal_file):
+            return
+        with open(qpysys.all_jobs_journal_file, 'r') as f:
+            lines = f.readlines()
+        i = 0
+        while i < len(lines):
+            header = lines[i].split()
+            try:
+                if not lines[i].endswith('\n') or len(header) != 2:
+                    raise ValueError('Invalid journal record header')
+                jobID = int(header[1])
+                if header[0] == '-':
+                    old_jobs.pop(jobID, None)
+                    i += 1
+                elif header[0] == '+':
+                    if i + 5 > len(lines) or not lines[i+4].endswith('\n'):
+                        raise ValueError('Incomplete journal record')
+                    old_jobs[jobID] = Job.from_string(
+                        ''.join(lines[i+1:i+5]), self.config)
+                    i += 5
+                else:
+                    raise ValueError('Unknown journal record')
+            except (ValueError, IndexError):
+                self.config.logger.warning(
+                    'Ignoring the journal after line %d', i + 1,
+                    exc_info=True)
+                break
+
     def jump_Q(self, job_list, pos):
         """Reorganize the queue.
         
@@ -733,74 +1453,43 @@ class JobCollection(object):
         pos         their final position
         
         Behaviour:
-        Put the jobs in job_list to be submited just before pos
+        Put the jobs in job_list to be submited just after pos
         if pos =  0: put them in the beginning of queue
                  -1: put them in the end of queue
+        The jobs that are moved keep their relative order.
         
         Return:
         A string with an informative message.
         """
+        job_list = set(job_list)
         with self.lock:
             if pos in job_list:
                 return 'Position is part of list: queue not reordered.\n'
-            found_pos = False
-            if pos > 0:
-                for j in self.Q:
-                    if j.ID == pos:
-                        found_pos = True
-                        break
-                if not(found_pos):
-                    return 'Position not found: queue not reordered.\n'
-            jobs_to_jump = []
-            for j in self.Q:
-                if j.ID in job_list:
-                    jobs_to_jump.append(j)
-            for j in jobs_to_jump:
-                self.Q.remove(j)
+            if pos > 0 and self.Q.get(pos) is None:
+                return 'Position not found: queue not reordered.\n'
+            jobs_to_jump = [j for j in self.Q if j.ID in job_list]
             if not(jobs_to_jump):
                 return ('List does not have jobs in queue:'
                         + ' queue not reordered.\n')
-            jobs_in_front = []
-            lenQ = len(self.Q)
-            for i in range(0, lenQ):
-                if self.Q[0].ID == pos:
-                    break
-                jobs_in_front.append(self.Q.popleft())
-            first_remain_Q = self.Q[0] if len(self.Q) > 0 else None
-            # last_remain_Q = self.Q[-1] if len(self.Q) > 0 else None
-            first_in_front = (jobs_in_front[0]
-                              if len(jobs_in_front) > 0 else
-                              None)
-            last_in_front = (jobs_in_front[-1]
-                             if len(jobs_in_front) > 0 else
-                             None)
-            if pos == -1:
-                for j in jobs_in_front[::-1]:
-                    self.Q.appendleft(j)
-            for j in jobs_to_jump[::-1]:
-                self.Q.appendleft(j)
-            if pos != -1:
-                for j in jobs_in_front[::-1]:
-                    self.Q.appendleft(j)
-            # reorder self.queue and self.all if needed
-            if last_in_front is None and first_remain_Q is None:
+            remain_Q = [j for j in self.Q if j.ID not in job_list]
+            if not(remain_Q):
                 return ('Queue is completely contained in list:'
                         + ' queue not reordered.\n')
-            if last_in_front is not None or first_remain_Q is not None:
-                for j in jobs_to_jump:
-                    self.all.remove(j)
-                    self.queue.remove(j)
-                if pos == 0:
-                    iq = 0
-                    ia = self.all.index(last_in_front)
-                elif pos == -1:
-                    iq = len(self.queue)
-                    ia = self.all.index(first_in_front) + 1
-                else:
-                    iq = self.queue.index(first_remain_Q) + 1
-                    ia = self.all.index(first_remain_Q) + 1
-                self.queue[iq:iq] = jobs_to_jump[::-1]
-                self.all[ia:ia] = jobs_to_jump[::-1]
+            if pos == -1:
+                iq = len(remain_Q)
+                anchor = remain_Q[-1]
+            elif pos > 0:
+                anchor = self.Q.get(pos)
+                iq = remain_Q.index(anchor) + 1
+            else:
+                iq = 0
+                anchor = remain_Q[0]
+            self.Q.reorder(remain_Q[:iq] + jobs_to_jump + remain_Q[iq:])
+            self.queue.reorder(self.Q)
+            # In all, the jobs go just before/after the same queued job
+            remain_all = [j for j in self.all if j.ID not in job_list]
+            ia = remain_all.index(anchor) + (0 if iq == 0 else 1)
+            self.all.reorder(remain_all[:ia] + jobs_to_jump + remain_all[ia:])
             return 'Queue reordered.\n'
 
     def fetch_running_jobs(self):
@@ -812,20 +1501,42 @@ class JobCollection(object):
         where nodes_down is a list with all nodes from which the job
         information could not be read, and jobs is a list with all job IDs.
         
+        Behaviour:
+        A single command is executed in each node with running jobs.
+        It checks the process group of each job with kill -0 (see
+        Job.is_running), and only if some job has no known process
+        group, the output of ps is also searched.
         """
-        command = 'ps -fu ' + qpysys.sys_user
+        per_node = {}
+        for job in self.running:
+            if job.node is not None:
+                per_node.setdefault(job.node.name, (job.node, []))[1].append(
+                    job)
         nodes_down = []
         jobs = []
-        for node in self.nodes:
-            if node.n_jobs > 0:
-                try:
-                    (std_out,
-                     std_err) = qpycomm.node_exec(node.address,
-                                                  command,
-                                                  pKey_file=self.config.ssh_p_key_file)
-                except Exception as e:
-                    self.config.logger.warning('Exception when fetching running jobs: %s', e)
-                    nodes_down.append(node)
+        for node, node_jobs in per_node.values():
+            command = []
+            use_ps = False
+            for job in node_jobs:
+                pgid = job.pgid()
+                if pgid is None:
+                    use_ps = True
                 else:
+                    command.append(_alive_command(job.ID, pgid))
+            if use_ps:
+                command.append('ps -fu ' + qpysys.sys_user)
+            try:
+                (std_out,
+                 std_err) = qpycomm.node_exec(node.address,
+                                              '; '.join(command),
+                                              pKey_file=self.config.ssh_p_key_file,
+                                              localhost_popen_shell=(
+                                                  node.address == 'localhost'))
+            except Exception as e:
+                self.config.logger.warning('Exception when fetching running jobs: %s', e)
+                nodes_down.append(node)
+            else:
+                jobs.extend(_extract_alive_jobIDs(std_out))
+                if use_ps:
                     jobs.extend(_extract_jobID_from_ps(std_out))
         return nodes_down, jobs
@@ -1,32 +1,60 @@
 """ qpy - Kills jobs. This is to be called from qpy_control_job.JobKiller
 
-USAGE: qpy_job_killer.py <process_id 1> <process_id 2> ...
+USAGE: qpy_job_killer.py <job_id 1>[:<pgid 1>] <job_id 2>[:<pgid 2>] ...
+
+Jobs whose process group is given (see Job.pgid) are killed with
+a single killpg. For the other jobs (started by older versions of qpy)
+all processes are found from a single snapshot of the process table.
+For each job, the line "<job_id>: <pid 1> <pid 2> ..." is written
+with the killed processes, where a process group is written as -<pgid>.
 """
 import sys
+import os
+import signal
 import subprocess
 import re
 
 import qpy_system as qpysys
-import qpy_useful_cosmetics as qpyutil
 
-for job_id in sys.argv:
+job_ids = []
+killed = {}
+jobs_to_kill = set()
+for arg in sys.argv[1:]:
+    job_id, _, pgid = arg.partition(':')
+    job_ids.append(job_id)
+    if not pgid:
+        jobs_to_kill.add(job_id)
+        continue
+    try:
+        os.killpg(int(pgid), signal.SIGKILL)
+    except OSError:
+        killed[job_id] = []
+    else:
+        killed[job_id] = ['-' + pgid]
+if jobs_to_kill:
     command = 'ps -fu ' + qpysys.sys_user
     ps = subprocess.Popen(command,
                           shell=True,
                           stdout=subprocess.PIPE,
                           stderr=subprocess.PIPE)
     ps_out = ps.stdout.readlines()
-    grand_PID = ''
-    parents = {}
+    job_pattern = re.compile(r'export QPY_JOB_ID=(\d+);')
+    grand_PIDs = {}
+    children = {}
     for line in ps_out:
         line = line.decode('utf-8')
         new_pid = line.split()
-        parents[new_pid[1]] = new_pid[2]
-        re_res = re.search('export QPY_JOB_ID=' + job_id + ';', line)
-        if (re_res):
-            grand_PID = new_pid[1]
-    pid_kill = qpyutil.get_all_children(grand_PID, parents)
-    pid_kill.reverse()
-    for i in pid_kill:
-        kill_job = subprocess.call(['kill', '-9', i])
-        sys.stdout.write(i + ' ')
+        children.setdefault(new_pid[2], []).append(new_pid[1])
+        re_res = job_pattern.search(line)
+        if re_res and re_res.group(1) in jobs_to_kill:
+            grand_PIDs[re_res.group(1)] = new_pid[1]
+    for job_id in jobs_to_kill:
+        # All descendants, parents before children
+        pid_kill = list(children.get(grand_PIDs.get(job_id), []))
+        for pid in pid_kill:
+            pid_kill.extend(children.get(pid, []))
+        if pid_kill:
+            subprocess.call(['kill', '-9'] + pid_kill)
+        killed[job_id] = pid_kill
+for job_id in job_ids:
+    sys.stdout.write(job_id + ': ' + ' '.join(killed[job_id]) + '\n')
@@ -3,10 +3,67 @@
 """
 import os
 import sys
+import atexit
+import queue
+import threading
 import traceback
+import random
+from collections import deque
+from time import time
+from datetime import datetime
 import logging
 import logging.handlers
 
+# The handler of each log file: base_file -> (QueueHandler, QueueListener)
+_queue_handlers = {}
+_queue_handlers_lock = threading.Lock()
+
+
+def _queue_handler(base_file):
+    """Return the handler that sends the records to the file base_file
+    
+    Behaviour:
+    For each file there is a single TimedRotatingFileHandler, that runs
+    in the thread of a QueueListener. The loggers have a QueueHandler,
+    that just puts the records in the queue, thus logging does not
+    wait for the file. The handler is created in the first call for
+    base_file, and the same handler is returned afterwards.
+    """
+    with _queue_handlers_lock:
+        try:
+            return _queue_handlers[base_file][0]
+        except KeyError:
+            pass
+        formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(name)s'
+            ' - %(funcName)s: %(message)s')
+        ch = logging.handlers.TimedRotatingFileHandler(
+            filename=str(base_file),
+            when='midnight',
+            interval=1,
+            backupCount=7,
+            delay=False
+        )
+        ch.setFormatter(formatter)
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, ch)
+        listener.start()
+        handler = logging.handlers.QueueHandler(records)
+        _queue_handlers[base_file] = (handler, listener)
+        return handler
+
+
+@atexit.register
+def stop_logging():
+    """Write all pending records and stop the writer threads"""
+    with _queue_handlers_lock:
+        handlers = list(_queue_handlers.values())
+        _queue_handlers.clear()
+    for handler, listener in handlers:
+        listener.stop()
+        for h in listener.handlers:
+            h.close()
+
 
 def configure_logger(base_file,
                      level=logging.WARNING,
@@ -24,6 +81,13 @@ def configure_logger(base_file,
     mylog.log-> mylog.log.2017-12-...
     change every day at midnight; one week should be enough
     
+    All loggers of the same file share a single handler, that
+    writes in a separate thread (see _queue_handler). Calling this
+    again for the same logger does not add another handler.
+    Other loggers need no configuration: their records propagate
+    to this one if logger_name is an ancestor of them (None for
+    the root logger).
+    
     Return:
     A logging.Logger
     
@@ -32,24 +96,32 @@ def configure_logger(base_file,
     """
     the_logger = logging.getLogger(logger_name)
     the_logger.setLevel(level)
-    formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(name)s - %(funcName)s: %(message)s')
-    ch = logging.handlers.TimedRotatingFileHandler(
-        filename=str(base_file),
-        when='midnight',
-        interval=1,
-        backupCount=7,
-        delay=False
-    )
-    ch.setFormatter(formatter)
-    the_logger.addHandler(ch)
+    handler = _queue_handler(base_file)
+    if handler not in the_logger.handlers:
+        the_logger.addHandler(handler)
     the_logger.propagate = False
-    # ch2 = logging.StreamHandler(sys.stdout)
-    # ch2.setFormatter(formatter)
-    # the_ogger.addHandler(ch2)
     return the_logger
 
 
+def parse_level(level):
+    """Return the logging level given by level
+    
+    Arguments:
+    level (str, int)   A level name (as 'debug' or 'DEBUG') or number
+    
+    Raise:
+    ValueError if level is not a valid level
+    """
+    try:
+        return int(level)
+    except (TypeError, ValueError):
+        pass
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError('Unknown logging level: ' + str(level))
+    return value
+
+
 def traceback_exception(msg):
     """Return a string with 'msg' and the exception traceback."""
     exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -132,3 +204,85 @@ class Messages(object):
                 self.messages[-1][1] += 1
             if (len(self) > self.max_len):
                 self.messages.pop(0)
+
+
+class Traces(object):
+    """The debug traces of the requests, sampled
+    
+    Attributes:
+    sample (float)    (default = 1.0) The fraction of requests
+                      that are traced
+    buffer (deque)    (default = None) If not None, the traces are kept
+                      here, in memory, instead of being logged. This is
+                      a ring buffer with the last traces
+    
+    Behaviour:
+    The traces are detailed messages about each decision of the
+    scheduler. They are written only for the requests selected in
+    start_request: a fraction sample of them, and only if the traces
+    would be kept (buffer is not None, or the logger is enabled for
+    DEBUG). The code in the hot paths should check active before
+    building the arguments of trace:
+    
+        if qpylog.traces.active:
+            qpylog.traces.trace(logger, 'message %s', expensive())
+    
+    The traces in the buffer are formatted only by dump.
+    """
+    __slots__ = (
+        'sample',
+        'buffer',
+        '_local')
+
+    def __init__(self):
+        """Initialise the class."""
+        self.sample = 1.0
+        self.buffer = None
+        self._local = threading.local()
+
+    def __repr__(self):
+        """Returns important informations about the traces."""
+        return ("Traces<sample=" + str(self.sample)
+                + ";buffer=" + ('None' if self.buffer is None else
+                                str(self.buffer.maxlen))
+                + ">")
+
+    def set_buffer(self, size):
+        """Keep the last size traces in memory; size=0 logs them"""
+        if size > 0:
+            self.buffer = deque(self.buffer or (), maxlen=size)
+        else:
+            self.buffer = None
+
+    def start_request(self, logger):
+        """Decide if the current request, of this thread, is traced"""
+        self._local.active = (
+            (self.buffer is not None or logger.isEnabledFor(logging.DEBUG))
+            and (self.sample >= 1.0 or random.random() < self.sample))
+
+    @property
+    def active(self):
+        """If the current request, of this thread, is traced"""
+        return getattr(self._local, 'active', False)
+
+    def trace(self, logger, msg, *args):
+        """Trace msg % args, from logger"""
+        buffer = self.buffer
+        if buffer is None:
+            logger.debug(msg, *args, stacklevel=2)
+        else:
+            buffer.append((time(), logger.name, msg, args))
+
+    def dump(self):
+        """Return a string with the traces in the buffer"""
+        if self.buffer is None:
+            return 'Traces are not kept in memory.\n'
+        x = ''
+        for t, name, msg, args in list(self.buffer):
+            x += (datetime.fromtimestamp(t).isoformat(sep=' ')
+                  + ' - ' + name + ': ' + (msg % args if args else msg)
+                  + '\n')
+        return x or 'No traces.\n'
+
+
+traces = Traces()
@@ -5,6 +5,8 @@ import os
 import sys
 import traceback
 import threading
+from multiprocessing import AuthenticationError, TimeoutError
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 import datetime
 
@@ -12,8 +14,9 @@ import qpy_system as qpysys
 import qpy_constants as qpyconst
 import qpy_useful_cosmetics as qpyutil
 import qpy_communication as qpycomm
-from qpy_parser import JobOptParser, ParseError
-from qpy_job import JobId, Job
+import qpy_metrics as qpymetrics
+from qpy_parser import ParseError
+from qpy_job import JobId, Job, JobOptParser
 from qpy_exceptions import qpyKeyError, qpyValueError
 
 
@@ -100,15 +103,13 @@ class MultiuserHandler(threading.Thread):
         """Contact qpy-multiuser to tell connection details and jobs."""
         multiuser_cur_jobs = self.jobs.multiuser_cur_jobs()
         try:
-            msg_back = qpycomm.message_transfer((qpyconst.MULTIUSER_USER,
-                                                 (qpysys.user,
-                                                  self.address,
-                                                  self.port,
-                                                  self.conn_key,
-                                                  multiuser_cur_jobs)),
-                                                qpycomm.multiuser_address,
-                                                qpycomm.multiuser_port,
-                                                qpycomm.multiuser_key)
+            msg_back = qpycomm.multiuser_channel.request(
+                (qpyconst.MULTIUSER_USER,
+                 (qpysys.user,
+                  self.address,
+                  self.port,
+                  self.conn_key,
+                  multiuser_cur_jobs)))
         except:
             self.multiuser_alive.clear()
             self.config.logger.error('MultiuserHandler: '
@@ -124,6 +125,331 @@ class MultiuserHandler(threading.Thread):
                                     msg_back)
 
 
+_READ_ONLY_JOBTYPES = (qpyconst.JOBTYPE_CHECK,
+                       qpyconst.JOBTYPE_STATUS,
+                       qpyconst.JOBTYPE_STATS)
+
+_JOBTYPE_NAMES = {job_type: keyword
+                  for keyword, (job_type, description)
+                  in qpyconst.KEYWORDS.items()}
+
+
+def _process_request(job_type,
+                     arguments,
+                     jobs,
+                     sub_ctrl,
+                     jobs_killer,
+                     config,
+                     multiuser_alive,
+                     job_id,
+                     job_options_parser):
+    """Process a request from qpy, returning the message for qpy
+    
+    See handle_qpy for the arguments and the possible requests.
+    """
+    # Send a job
+    # arguments = the job info (see JOB.info)
+    if job_type == qpyconst.JOBTYPE_SUB:
+        new_job = Job(int(job_id), arguments, config, job_options_parser)
+        try:
+            new_job.parse_options()
+        except ParseError as e:
+            msg = ('qpy: Job rejected due to its options:\n'
+                               + e.message + '\n')
+        except:
+            msg = (
+                'qpy: Job rejected:\n'
+                + 'Unexpected exception after parsing options:\n'
+                + traceback.format_exc() + '\n'
+                + 'Please, contact the qpy team.\n')
+        else:
+            if config.default_attr and not new_job.node_attr:
+                new_job.node_attr = config.default_attr
+            if config.or_attr:
+                if new_job.node_attr:
+                    new_job.node_attr = (['('] + config.or_attr +
+                                         [')', 'or', '(']
+                                         + new_job.node_attr + [')'])
+                else:
+                    new_job.node_attr = config.or_attr
+            if config.and_attr:
+                if new_job.node_attr:
+                    new_job.node_attr = (['('] + config.and_attr +
+                                         [')', 'and', '('] +
+                                         new_job.node_attr + [')'])
+                else:
+                    new_job.node_attr = config.and_attr
+            if (new_job.use_script_copy):
+                first_arg = new_job.info[0].split()[0]
+                script_name = new_job._expand_script_name(first_arg)
+                if (script_name is not None):
+                    copied_script_name = (
+                        qpysys.scripts_dir + 'job_script.'
+                        + str(new_job.ID))
+                    copyfile(script_name, copied_script_name)
+                    new_job.cp_script_to_replace = (first_arg,
+                                                    copied_script_name)
+            jobs.append(new_job, jobs.all)
+            jobs.append(new_job, jobs.queue)
+            jobs.Q_append(new_job)
+            msg = 'Job ' + str(job_id) + ' received.\n'
+            job_id += 1
+            qpymetrics.metrics.count('jobs submitted')
+            sub_ctrl.wake.set()
+            jobs.record(new_job)
+    
+    # Check jobs
+    # arguments: a dictionary, indicating patterns (see JOB.asked)
+    elif job_type == qpyconst.JOBTYPE_CHECK:
+        if (config.sub_paused):
+            msg_pause = 'Job submission is paused.\n'
+        else:
+            msg_pause = ''
+        msg = jobs.check(arguments, config) + msg_pause
+
+    # Kill a job
+    # arguments = a list of jobIDs and status (all, queue, running)
+    elif job_type == qpyconst.JOBTYPE_KILL:
+        orig_sub_jobs = sub_ctrl.submit_jobs
+        sub_ctrl.submit_jobs = False
+        kill_q = ('all' in arguments) or ('queue' in arguments)
+        kill_r = ('all' in arguments) or ('running' in arguments)
+        for st in ['all', 'queue', 'running']:
+            while (st in arguments):
+                arguments.remove(st)
+        to_remove = jobs.unqueue(None if kill_q else arguments)
+        n_kill_q = len(to_remove)
+        if to_remove:
+            jobs.record(*to_remove)
+        sub_ctrl.submit_jobs = orig_sub_jobs
+        n_kill_r = 0
+        with jobs.lock:
+            to_remove = (list(jobs.running)
+                         if kill_r else
+                         [job for job in map(jobs.running.get, arguments)
+                          if job is not None])
+        for job in to_remove:
+            jobs_killer.to_kill.put(job)
+            n_kill_r += 1
+        if n_kill_q + n_kill_r:
+            sub_ctrl.resume()
+        msg = ''
+        if n_kill_q:
+            plural = qpyutil.get_plural(('job', 'jobs'), n_kill_q)
+            msg += (plural[1] + ' '
+                    + plural[0] + ' removed from the queue.\n')
+        if n_kill_r:
+            plural = qpyutil.get_plural(('job', 'jobs'), n_kill_r)
+            msg += plural[1] + ' ' + plural[0] + ' will be killed.\n'
+        if not msg:
+            msg = 'qpy: Nothing to do: required jobs not found.\n'
+
+    # Show status
+    # No arguments (yet)
+    elif job_type == qpyconst.JOBTYPE_STATUS:
+        try:
+            msg_back = qpycomm.multiuser_channel.request(
+                (qpyconst.MULTIUSER_STATUS, ()))
+        except:
+            msg = ('qpy: qpy-multiuser seems not to be running.'
+                   + ' Contact the qpy-team.\n')
+            multiuser_alive.clear()
+        else:
+            msg = msg_back[1]
+            multiuser_alive.set()
+
+    # Control queue
+    # arguments: a list: [<type>, <arguments>].
+    elif job_type == qpyconst.JOBTYPE_CTRLQUEUE:
+        ctrl_type = arguments[0]
+        if ctrl_type == 'pause' or ctrl_type == 'continue':
+            if ctrl_type == 'pause':
+                config.sub_paused = True
+                msg = 'Job submission paused.\n'
+            else:
+                config.sub_paused = False
+                msg = 'Job submission continued.\n'
+            config.write_on_file()
+            sub_ctrl.submit_jobs = not config.sub_paused
+            if sub_ctrl.submit_jobs:
+                sub_ctrl.resume()
+
+        elif ctrl_type == 'jump':
+            if not config.sub_paused:
+                msg = 'Pause the queue before trying to control it.\n'
+            else:
+                msg = jobs.jump_Q(arguments[1], arguments[2])
+                jobs.write_all_jobs()
+        else:
+            msg = 'qpy: Unknown ctrlQueue type: ' + ctrl_type + '.\n'
+
+    # Show current configuration
+    # arguments:
+    # optionally, a pair to change the configuration: (<key>, <value>)
+    elif job_type == qpyconst.JOBTYPE_CONFIG:
+        if arguments:
+            try:
+                msg = config.set_key(arguments[0], arguments[1])
+            except (qpyKeyError, qpyValueError) as e:
+                msg = 'qpy: ' + str(e)
+            msg = msg + '\n'
+            config.write_on_file()
+        else:
+            msg = str(config)
+
+    # Clean finished jobs
+    # arguments = a list of jobIDs and status (all, done, killed, undone)
+    elif job_type == qpyconst.JOBTYPE_CLEAN:
+        removed_jobs = []
+        finished_status = (qpyconst.JOB_ST_DONE,
+                           qpyconst.JOB_ST_KILLED,
+                           qpyconst.JOB_ST_UNDONE)
+        with jobs.lock:
+            for i in arguments:
+                if isinstance(i, int):
+                    job = jobs.get(i)
+                    candidates = [] if job is None else [job]
+                elif isinstance(i, str) and os.path.isdir(i):
+                    candidates = [job for job in jobs.all
+                                  if job.info[1] == i]
+                elif i == 'all':
+                    candidates = [job for st in finished_status
+                                  for job in jobs.status_list(st)]
+                elif i in qpyconst.JOB_STATUS:
+                    candidates = jobs.status_list(
+                        qpyconst.JOB_STATUS.index(i))
+                else:
+                    candidates = []
+                for job in candidates:
+                    if (job.status not in finished_status
+                            or job not in jobs.all):
+                        continue
+                    jobs.remove(job, jobs.status_list(job.status))
+                    jobs.remove(job, jobs.all)
+                    removed_jobs.append(job)
+                    if os.path.isfile(qpysys.notes_dir + 'notes.'
+                                      + str(job.ID)):
+                        os.remove(qpysys.notes_dir + 'notes.'
+                                  + str(job.ID))
+        if removed_jobs:
+            jobs.record_removal(*removed_jobs)
+            plural = qpyutil.get_plural(('job', 'jobs'), len(removed_jobs))
+            msg = plural[1] + ' finished ' + plural[0] + ' removed.\n'
+        else:
+            msg = 'qpy: Nothing to do: required jobs not found.\n'
+
+    # Add and read notes
+    # arguments = (jobID[, note])
+    elif job_type == qpyconst.JOBTYPE_NOTE:
+        if len(arguments) == 0:
+            all_notes = os.listdir(qpysys.notes_dir)
+            msg = ''
+            for n in all_notes:
+                if n[0:6] == 'notes.':
+                    msg += n[6:] + ' '
+            if msg:
+                msg = ('You have notes for the following jobs:\n'
+                       + msg + '\n')
+            else:
+                msg = 'You have no notes.\n'
+        else:
+            notes_file = qpysys.notes_dir + 'notes.' + str(arguments[0])
+            if (os.path.isfile(notes_file)):
+                f = open(notes_file, 'r')
+                notes = f.read()
+                f.close()
+            else:
+                notes = ''
+            if len(arguments) == 1:
+                if not notes:
+                    msg = 'No notes for ' + arguments[0] + '\n'
+                else:
+                    msg = notes + '\n'
+            else:
+                notes += ('----- Note added at '
+                          + str(datetime.datetime.today()) + ':\n'
+                          + arguments[1] + '\n\n')
+                f = open(notes_file, 'w')
+                f.write(notes)
+                f.close()
+                msg = 'Note stored.\n'
+
+    # Show counters and latencies
+    # No arguments
+    elif job_type == qpyconst.JOBTYPE_STATS:
+        msg = qpymetrics.metrics.report()
+
+    else:
+        msg = 'qpy: Unknown option: ' + str(job_type) + '\n'
+    return msg
+
+
+def _serve_qpy(client_master,
+               conn_key,
+               jobs,
+               sub_ctrl,
+               jobs_killer,
+               config,
+               multiuser_alive,
+               job_id,
+               job_options_parser,
+               state_lock,
+               finish):
+    """Receive a message from qpy, process it and send the answer
+    
+    This runs in the worker threads of handle_qpy, and the
+    connection is authenticated here (see qpycomm.authenticate_client),
+    thus a client that does not answer holds only one worker, for a
+    limited time.
+    
+    Return:
+    True if qpy-master should finish, False otherwise.
+    """
+    try:
+        qpycomm.authenticate_client(client_master, conn_key,
+                                    qpyconst.MASTER_RECV_TIMEOUT)
+        if not client_master.poll(qpyconst.MASTER_RECV_TIMEOUT):
+            config.logger.warning('handle_qpy: no message received.')
+            client_master.close()
+            return False
+        (job_type, arguments) = client_master.recv()
+    except (EOFError, OSError, TimeoutError, AuthenticationError) as exc:
+        config.logger.warning('handle_qpy: connection failed: %s', exc)
+        client_master.close()
+        return False
+    except:
+        config.logger.error('handle_qpy: connection failed', exc_info=True)
+        client_master.close()
+        return False
+    config.messages.add("handle_qpy: Received: "
+                        + str(job_type) + " -> " + str(arguments))
+    try:
+        # Finish the execution
+        # argumets: no arguments
+        if job_type == qpyconst.JOBTYPE_FINISH:
+            finish.set()
+            client_master.send('Stopping qpy-master driver.\n')
+            return True
+        with qpymetrics.metrics.timer(
+                'qpy ' + _JOBTYPE_NAMES.get(job_type, str(job_type))):
+            if job_type in _READ_ONLY_JOBTYPES:
+                msg = _process_request(job_type, arguments, jobs, sub_ctrl,
+                                       jobs_killer, config, multiuser_alive,
+                                       job_id, job_options_parser)
+            else:
+                with state_lock:
+                    msg = _process_request(job_type, arguments, jobs,
+                                           sub_ctrl, jobs_killer, config,
+                                           multiuser_alive, job_id,
+                                           job_options_parser)
+        client_master.send(msg)
+    except:
+        config.logger.error('Exception at handle_qpy', exc_info=True)
+    finally:
+        client_master.close()
+    return False
+
+
 def handle_qpy(jobs,
                sub_ctrl,
                jobs_killer,
@@ -139,8 +465,13 @@ def handle_qpy(jobs,
     Behaviour:
     It opens a new connection, share the port and key with qpy
     by te corresponding files and waits for messages from qpy.
-    When a message is received, it analyzes it, does whatever
-    is needed and returns a message back.
+    Each accepted connection is handed to a pool of
+    qpyconst.MASTER_N_WORKERS threads, that receive the message,
+    analyze it, do whatever is needed and return a message back.
+    Requests that change the jobs or the configuration are serialized
+    by a lock, whereas checking the jobs and the status (see
+    _READ_ONLY_JOBTYPES) run in parallel: these are answered without
+    waiting for slower requests.
     
     The message from qpy must be a tuple (job_type, arguments)
     where job_type is
@@ -150,6 +481,7 @@ def handle_qpy(jobs,
        qpyconst.JOBTYPE_FINISH  - kill the master       (finish)
        qpyconst.JOBTYPE_CONFIG  - show config           (config)
        qpyconst.JOBTYPE_CLEAN   - clean finished jobs   (clean)
+       qpyconst.JOBTYPE_STATS   - counters and latencies (stats)
     """
     address = qpycomm.read_address_file(qpysys.master_conn_file)
     (Listener_master,
@@ -157,264 +489,37 @@ def handle_qpy(jobs,
      conn_key) = qpycomm.establish_Listener_connection(
          address,
          qpyconst.PORT_MIN_MASTER,
-         qpyconst.PORT_MAX_MASTER
-     )
+         qpyconst.PORT_MAX_MASTER,
+         authenticate=False)
     qpycomm.write_conn_files(qpysys.master_conn_file,
                              address, port, conn_key)
     job_id = JobId(qpysys.jobID_file)
     job_options_parser = JobOptParser.set_parser()
-    while True:
-        client_master = Listener_master.accept()
-        (job_type, arguments) = client_master.recv()
-        config.messages.add("handle_qpy: Received: "
-                            + str(job_type) + " -> " + str(arguments))
-        # Send a job
-        # arguments = the job info (see JOB.info)
-        if job_type == qpyconst.JOBTYPE_SUB:
-            new_job = Job(int(job_id), arguments, config, job_options_parser)
+    state_lock = threading.Lock()
+    finish = threading.Event()
+
+    def serve(client_master):
+        if _serve_qpy(client_master, conn_key, jobs, sub_ctrl, jobs_killer, config,
+                      multiuser_alive, job_id, job_options_parser,
+                      state_lock, finish):
+            # Wake up the main loop, that might be waiting in accept
             try:
-                new_job.parse_options()
-            except ParseError as e:
-                client_master.send('qpy: Job rejected due to its options:\n'
-                                   + e.message + '\n')
+                qpycomm.wake_up_listener(address, port)
             except:
-                client_master.send(
-                    'qpy: Job rejected:\n'
-                    + 'Unexpected exception after parsing options:\n'
-                    + traceback.format_exc() + '\n'
-                    + 'Please, contact the qpy team.\n')
-            else:
-                if config.default_attr and not new_job.node_attr:
-                    new_job.node_attr = config.default_attr
-                if config.or_attr:
-                    if new_job.node_attr:
-                        new_job.node_attr = (['('] + config.or_attr +
-                                             [')', 'or', '(']
-                                             + new_job.node_attr + [')'])
-                    else:
-                        new_job.node_attr = config.or_attr
-                if config.and_attr:
-                    if new_job.node_attr:
-                        new_job.node_attr = (['('] + config.and_attr +
-                                             [')', 'and', '('] +
-                                             new_job.node_attr + [')'])
-                    else:
-                        new_job.node_attr = config.and_attr
-                if (new_job.use_script_copy):
-                    first_arg = new_job.info[0].split()[0]
-                    script_name = new_job._expand_script_name(first_arg)
-                    if (script_name is not None):
-                        copied_script_name = (
-                            qpysys.scripts_dir + 'job_script.'
-                            + str(new_job.ID))
-                        copyfile(script_name, copied_script_name)
-                        new_job.cp_script_to_replace = (first_arg,
-                                                        copied_script_name)
-                jobs.append(new_job, jobs.all)
-                jobs.append(new_job, jobs.queue)
-                jobs.Q_appendleft(new_job)
-                client_master.send('Job ' + str(job_id) + ' received.\n')
-                job_id += 1
-                jobs.write_all_jobs()
-        
-        # Check jobs
-        # arguments: a dictionary, indicating patterns (see JOB.asked)
-        elif job_type == qpyconst.JOBTYPE_CHECK:
-            if (config.sub_paused):
-                msg_pause = 'Job submission is paused.\n'
-            else:
-                msg_pause = ''
-            client_master.send(jobs.check(arguments, config) + msg_pause)
+                config.logger.error('handle_qpy: failed to wake up '
+                                    'the main loop', exc_info=True)
 
-        # Kill a job
-        # arguments = a list of jobIDs and status (all, queue, running)
-        elif job_type == qpyconst.JOBTYPE_KILL:
-            orig_sub_jobs = sub_ctrl.submit_jobs
-            sub_ctrl.submit_jobs = False
-            kill_q = ('all' in arguments) or ('queue' in arguments)
-            kill_r = ('all' in arguments) or ('running' in arguments)
-            for st in ['all', 'queue', 'running']:
-                while (st in arguments):
-                    arguments.remove(st)
-            n_kill_q = 0
-            to_remove = []
-            for job in jobs.queue:
-                if job.ID in arguments or kill_q:
-                    to_remove.append(job)
-            for job in to_remove:
-                job.status = qpyconst.JOB_ST_UNDONE
-                jobs.remove(job, jobs.Q)
-                jobs.remove(job, jobs.queue)
-                jobs.append(job, jobs.undone)
-                n_kill_q += 1
-            sub_ctrl.submit_jobs = orig_sub_jobs
-            n_kill_r = 0
-            to_remove = []
-            with jobs.lock:
-                for job in jobs.running:
-                    if job.ID in arguments or kill_r:
-                        to_remove.append(job)
-            for job in to_remove:
-                jobs_killer.to_kill.put(job)
-                n_kill_r += 1
-            if n_kill_q + n_kill_r:
-                sub_ctrl.skip_job_sub = 0
-            msg = ''
-            if n_kill_q:
-                plural = qpyutil.get_plural(('job', 'jobs'), n_kill_q)
-                msg += (plural[1] + ' '
-                        + plural[0] + ' removed from the queue.\n')
-            if n_kill_r:
-                plural = qpyutil.get_plural(('job', 'jobs'), n_kill_r)
-                msg += plural[1] + ' ' + plural[0] + ' will be killed.\n'
-            if not msg:
-                msg = 'qpy: Nothing to do: required jobs not found.\n'
-            else:
-                jobs.write_all_jobs()
-            client_master.send(msg)
-
-        # Finish the execution
-        # argumets: no arguments
-        if job_type == qpyconst.JOBTYPE_FINISH:
-            client_master.send('Stopping qpy-master driver.\n')
-            Listener_master.close()
-            break
-
-        # Show status
-        # No arguments (yet)
-        elif job_type == qpyconst.JOBTYPE_STATUS:
+    with ThreadPoolExecutor(max_workers=qpyconst.MASTER_N_WORKERS,
+                            thread_name_prefix='handle_qpy') as executor:
+        while not finish.is_set():
             try:
-                msg_back = qpycomm.message_transfer(
-                    (qpyconst.MULTIUSER_STATUS, ()),
-                    qpycomm.multiuser_address,
-                    qpycomm.multiuser_port,
-                    qpycomm.multiuser_key
-                )
+                client_master = Listener_master.accept()
             except:
-                msg = ('qpy: qpy-multiuser seems not to be running.'
-                       + ' Contact the qpy-team.\n')
-                multiuser_alive.clear()
-            else:
-                msg = msg_back[1]
-                multiuser_alive.set()
-            client_master.send(msg)
-
-        # Control queue
-        # arguments: a list: [<type>, <arguments>].
-        elif job_type == qpyconst.JOBTYPE_CTRLQUEUE:
-            ctrl_type = arguments[0]
-            if ctrl_type == 'pause' or ctrl_type == 'continue':
-                if ctrl_type == 'pause':
-                    config.sub_paused = True
-                    msg = 'Job submission paused.\n'
-                else:
-                    config.sub_paused = False
-                    msg = 'Job submission continued.\n'
-                config.write_on_file()
-                sub_ctrl.submit_jobs = not config.sub_paused
-
-            elif ctrl_type == 'jump':
-                if not config.sub_paused:
-                    msg = 'Pause the queue before trying to control it.\n'
-                else:
-                    msg = jobs.jump_Q(arguments[1], arguments[2])
-            else:
-                msg = 'qpy: Unknown ctrlQueue type: ' + ctrl_type + '.\n'
-            client_master.send(msg)
-
-        # Show current configuration
-        # arguments:
-        # optionally, a pair to change the configuration: (<key>, <value>)
-        elif job_type == qpyconst.JOBTYPE_CONFIG:
-            if arguments:
-                try:
-                    msg = config.set_key(arguments[0], arguments[1])
-                except (qpyKeyError, qpyValueError) as e:
-                    msg = 'qpy: ' + str(e)
-                msg = msg + '\n'
-                config.write_on_file()
-            else:
-                msg = str(config)
-            client_master.send(msg)
-
-        # Clean finished jobs
-        # arguments = a list of jobIDs and status (all, done, killed, undone)
-        elif job_type == qpyconst.JOBTYPE_CLEAN:
-            n_jobs = 0
-            for i in arguments:
-                arg_is_id = isinstance(i, int)
-                arg_is_dir = isinstance(i, str) and os.path.isdir(i)
-                ij = 0
-                with jobs.lock:
-                    while ij < len(jobs.all):
-                        job = jobs.all[ij]
-                        remove = False
-                        if job.status > 1:
-                            remove = arg_is_id and i == job.ID
-                            remove = remove or (arg_is_dir
-                                                and i == job.info[1])
-                            remove = remove or (not arg_is_id) and i == 'all'
-                            remove = (remove or (not arg_is_id)
-                                      and i == qpyconst.JOB_STATUS[job.status])
-                            if remove:
-                                if job.status == qpyconst.JOB_ST_DONE:
-                                    jobs.remove(job, jobs.done)
-                                elif job.status == qpyconst.JOB_ST_KILLED:
-                                    jobs.remove(job, jobs.killed)
-                                elif job.status == qpyconst.JOB_ST_UNDONE:
-                                    jobs.remove(job, jobs.undone)
-                                jobs.remove(job, jobs.all)
-                                n_jobs += 1
-                                if os.path.isfile(qpysys.notes_dir + 'notes.'
-                                                  + str(job.ID)):
-                                    os.remove(qpysys.notes_dir + 'notes.'
-                                              + str(job.ID))
-                        if not remove:
-                            ij += 1
-            if n_jobs:
-                jobs.write_all_jobs()
-                plural = qpyutil.get_plural(('job', 'jobs'), n_jobs)
-                msg = plural[1] + ' finished ' + plural[0] + ' removed.\n'
-            else:
-                msg = 'qpy: Nothing to do: required jobs not found.\n'
-            client_master.send(msg)
-
-        # Add and read notes
-        # arguments = (jobID[, note])
-        elif job_type == qpyconst.JOBTYPE_NOTE:
-            if len(arguments) == 0:
-                all_notes = os.listdir(qpysys.notes_dir)
-                msg = ''
-                for n in all_notes:
-                    if n[0:6] == 'notes.':
-                        msg += n[6:] + ' '
-                if msg:
-                    msg = ('You have notes for the following jobs:\n'
-                           + msg + '\n')
-                else:
-                    msg = 'You have no notes.\n'
-            else:
-                notes_file = qpysys.notes_dir + 'notes.' + str(arguments[0])
-                if (os.path.isfile(notes_file)):
-                    f = open(notes_file, 'r')
-                    notes = f.read()
-                    f.close()
-                else:
-                    notes = ''
-                if len(arguments) == 1:
-                    if not notes:
-                        msg = 'No notes for ' + arguments[0] + '\n'
-                    else:
-                        msg = notes + '\n'
-                else:
-                    notes += ('----- Note added at '
-                              + str(datetime.datetime.today()) + ':\n'
-                              + arguments[1] + '\n\n')
-                    f = open(notes_file, 'w')
-                    f.write(notes)
-                    f.close()
-                    msg = 'Note stored.\n'
-            client_master.send(msg)
-
-        else:
-            client_master.send('qpy: Unknown option: ' + str(job_type) + '\n')
+                config.logger.error('handle_qpy: connection failed',
+                                    exc_info=True)
+                continue
+            if finish.is_set():
+                client_master.close()
+                break
+            executor.submit(serve, client_master)
+    Listener_master.close()
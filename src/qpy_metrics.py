@@ -0,0 +1,307 @@
+""" qpy - Counters and durations, kept in memory
+
+"""
+import os
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic
+
+MAX_SAMPLES = 1000
+
+
+class Metrics(object):
+    """Counters and samples of durations
+
+    Attributes:
+    max_samples (int)   The number of samples kept for each duration
+    counters (dict)     The counters: name -> value
+    samples (dict)      The durations: name -> [n, total, deque of samples]
+                        where n and total are the number and sum of all
+                        recorded samples, and the deque has the last
+                        max_samples of them (a ring buffer)
+    gauges (dict)       The current values: name -> value
+    start (float)       When the metrics started (time.monotonic)
+    lock (Lock)         To access counters, samples and gauges
+
+    Behaviour:
+    Recording a counter or a duration is cheap (an O(1) update,
+    in memory), so it can be done at any place. The percentiles
+    are calculated only when the report is made, over the samples
+    in the ring buffer.
+    
+    Names can have labels, in the Prometheus format:
+    'requests_total{user="alice"}' (see prometheus).
+    """
+    __slots__ = (
+        'max_samples',
+        'counters',
+        'samples',
+        'gauges',
+        'start',
+        'lock')
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        """Initialise the class."""
+        self.max_samples = max_samples
+        self.counters = {}
+        self.samples = {}
+        self.gauges = {}
+        self.start = monotonic()
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        """Increment the counter name by n"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        """Set the gauge name to value"""
+        with self.lock:
+            self.gauges[name] = value
+
+    def set_gauges(self, base, values):
+        """Replace all gauges base{...} by values
+        
+        Arguments:
+        base (str)      The name of the gauges, without labels
+        values (dict)   labels -> value, where labels is a string
+                        as 'node="node1"'
+        """
+        with self.lock:
+            for name in [name for name in self.gauges
+                         if name.startswith(base + '{')]:
+                del self.gauges[name]
+            for labels, value in values.items():
+                self.gauges[base + '{' + labels + '}'] = value
+
+    def add(self, name, value):
+        """Record a sample of the duration name, in seconds"""
+        with self.lock:
+            try:
+                sample = self.samples[name]
+            except KeyError:
+                sample = self.samples[name] = [
+                    0, 0.0, deque(maxlen=self.max_samples)]
+            sample[0] += 1
+            sample[1] += value
+            sample[2].append(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Record the time spent in the with block as a sample of name"""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic() - start)
+
+    def summary(self, name):
+        """Return a summary of the duration name
+
+        Return:
+        The tuple (n, mean, p50, p90, p99, max), where n and mean
+        are over all samples, and the others are over the
+        samples of the ring buffer. None if there is no such duration.
+        """
+        with self.lock:
+            try:
+                n, total, last = self.samples[name]
+            except KeyError:
+                return None
+            last = sorted(last)
+        def percentile(p):
+            return last[min(int(p * len(last)), len(last) - 1)]
+        return (n, total / n,
+                percentile(0.5), percentile(0.9), percentile(0.99),
+                last[-1])
+
+    def report(self):
+        """Return a string with all counters, gauges and durations"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            names = sorted(self.samples)
+        minutes = (monotonic() - self.start) / 60
+        width = max([30] + [len(name) for name, value in counters]
+                    + [len(name) for name, value in gauges]
+                    + [len(name) for name in names])
+        name_fmt = '  {0:<' + str(width) + 's}'
+        msg = ''
+        if counters:
+            msg += ('Counters:\n'
+                    + name_fmt.format('')
+                    + ' {0:>8s} {1:>9s}\n'.format('n', 'per min'))
+            for name, value in counters:
+                msg += (name_fmt.format(name)
+                        + ' {0:>8d} {1:>9.2f}\n'.format(value,
+                                                       value / minutes))
+        if gauges:
+            msg += 'Values:\n'
+            for name, value in gauges:
+                msg += name_fmt.format(name) + ' {0:>8.1f}\n'.format(value)
+        if names:
+            msg += ('Durations (ms):\n'
+                    + name_fmt.format('')
+                    + ' {0:>8s} {1:>9s} {2:>9s} {3:>9s} {4:>9s} {5:>9s}\n'
+                    .format('n', 'mean', 'p50', 'p90', 'p99', 'max'))
+            for name in names:
+                n, mean, p50, p90, p99, p_max = self.summary(name)
+                msg += (name_fmt.format(name)
+                        + ' {0:>8d}'.format(n)
+                        + ''.join(' {0:>9.1f}'.format(1000 * x)
+                                  for x in (mean, p50, p90, p99, p_max))
+                        + '\n')
+        if not msg:
+            msg = 'No metrics recorded yet.\n'
+        return msg
+
+    def prometheus(self, prefix='qpy_'):
+        """Return the metrics in the Prometheus text format
+        
+        Counters and gauges are written as such, and the durations as
+        summaries, with the quantiles over the samples in the ring buffer.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            names = sorted(self.samples)
+        lines = []
+        types = set()
+
+        def add_line(metric_type, name, value, suffix='', label=''):
+            base, labels = _prometheus_name(prefix, name)
+            if base not in types:
+                types.add(base)
+                lines.append('# TYPE {0} {1}'.format(base, metric_type))
+            if label:
+                labels = labels + ',' + label if labels else label
+            lines.append('{0}{1}{2} {3!r}'.format(
+                base, suffix, '{' + labels + '}' if labels else '',
+                float(value)))
+
+        for name, value in counters:
+            add_line('counter', name, value)
+        for name, value in gauges:
+            add_line('gauge', name, value)
+        for name in names:
+            summary = self.summary(name)
+            if summary is None:
+                continue
+            n, mean, p50, p90, p99, p_max = summary
+            for q, value in (('0.5', p50), ('0.9', p90), ('0.99', p99)):
+                add_line('summary', name, value, label=f'quantile="{q}"')
+            add_line('summary', name, n * mean, suffix='_sum')
+            add_line('summary', name, n, suffix='_count')
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_name(prefix, name):
+    """Return the pair (metric name, labels) of a name of Metrics"""
+    base, _, labels = name.partition('{')
+    return (prefix + re.sub('[^a-zA-Z0-9_]', '_', base.strip()),
+            labels.rstrip('}'))
+
+
+class TimedLock(object):
+    """A lock that records how long it is waited for and held
+    
+    Attributes:
+    lock (Lock or RLock)   The lock
+    name (str)             The durations are recorded as
+                           name + '_wait_seconds' and name + '_hold_seconds'
+    metrics (Metrics)      Where the durations are recorded
+    
+    Behaviour:
+    This is used as the lock itself, in with statements. For a
+    reentrant lock, only the outermost with block is recorded.
+    """
+    __slots__ = (
+        'lock',
+        'name',
+        'metrics',
+        '_local')
+
+    def __init__(self, lock, name, metrics=None):
+        """Initialise the class."""
+        self.lock = lock
+        self.name = name
+        self.metrics = metrics
+        self._local = threading.local()
+
+    def __enter__(self):
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            start = monotonic()
+            self.lock.acquire()
+            self._local.acquired = monotonic()
+            (self.metrics or metrics).add(self.name + '_wait_seconds',
+                                          self._local.acquired - start)
+        else:
+            self.lock.acquire()
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.depth -= 1
+        outermost = self._local.depth == 0
+        if outermost:
+            held = monotonic() - self._local.acquired
+        self.lock.release()
+        if outermost:
+            (self.metrics or metrics).add(self.name + '_hold_seconds', held)
+        return False
+
+
+class PrometheusExporter(threading.Thread):
+    """Write the metrics in a file, in the Prometheus text format
+    
+    Attributes:
+    metrics (Metrics)     The metrics to be written
+    file_name (str)       The file
+    interval (float)      The file is written at each interval seconds
+    update (callable)     If not None, called before each writing,
+                          to update the gauges
+    finish (Event)        Set this Event to terminate this Thread
+    
+    Behaviour:
+    The file is written in a temporary file that replaces file_name
+    when complete, thus it can be read at any time (for example, by
+    the textfile collector of the Prometheus node exporter).
+    """
+    __slots__ = (
+        'metrics',
+        'file_name',
+        'interval',
+        'update',
+        'finish')
+
+    def __init__(self, metrics, file_name, interval, update=None):
+        """Initiate the class"""
+        threading.Thread.__init__(self, daemon=True)
+        self.metrics = metrics
+        self.file_name = file_name
+        self.interval = interval
+        self.update = update
+        self.finish = threading.Event()
+
+    def write(self):
+        """Write the metrics in the file"""
+        if self.update is not None:
+            self.update()
+        tmp_file = self.file_name + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(self.metrics.prometheus())
+        os.replace(tmp_file, self.file_name)
+
+    def run(self):
+        """Write the metrics regularly, see class documentation."""
+        while not self.finish.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                pass
+
+
+metrics = Metrics()
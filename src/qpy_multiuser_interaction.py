@@ -1,9 +1,17 @@
 """ qpy - Funtions for interaction with qpy-multiuser
 
 """
+import threading
+import logging
+from time import time
+from multiprocessing import AuthenticationError, TimeoutError
+from concurrent.futures import ThreadPoolExecutor
+
 import qpy_system as qpysys
 import qpy_constants as qpyconst
+import qpy_logging as qpylog
 import qpy_communication as qpycomm
+import qpy_metrics as qpymetrics
 import qpy_users_management as qpyusers
 from qpy_parser import ParseError
 
@@ -62,6 +70,30 @@ def _handle_show_status(args, users, nodes):
     return 0, f"{users}\n{nodes}\n"
 
 
+def update_metrics(users, nodes):
+    """Update the gauges of qpymetrics.metrics about the nodes
+    
+    The age, in seconds, of the last successful check of each node
+    (NaN if it was never checked successfully).
+    """
+    now = time()
+    qpymetrics.metrics.set_gauges(
+        'node_last_check_age_seconds',
+        {f'node="{node.name}"': (float('nan')
+                                 if node.last_check is None else
+                                 now - node.last_check)
+         for node in nodes})
+
+
+def _handle_show_metrics(args, users, nodes):
+    """Handle a request for the metrics
+    
+    args: ()
+    """
+    update_metrics(users, nodes)
+    return 0, qpymetrics.metrics.report()
+
+
 def _handle_save_messages(args, users, nodes):
     """Handle a request to start saving messages
     
@@ -75,41 +107,104 @@ def _handle_save_messages(args, users, nodes):
     return 0, 'Save messages set to {0}.\n'.format(args[0])
 
 
-def _handle_sync_user_info(args, users, nodes):
-    """Handle a request to synchronize user info
+def _handle_logging(args, users, nodes):
+    """Handle a request to set the log level and the debug traces
+    
+    args: a list of pairs (key, value), with key 'level', 'sample'
+          or 'buffer' (see qpylog.Traces). Without arguments, just
+          the current values are returned.
     
-    args: user_name, address, port, conn_key, cur_jobs
+    All values are checked before any of them is applied: the
+    request is refused (-1) if any is not valid.
     """
-    username, address, port, conn_key, new_cur_jobs = args
-    try:
-        if username in users:
-            user = users[username]
-            user.address = address
-            user.port = port
-            user.conn_key = conn_key
-            same_list = (len(new_cur_jobs) == len(user.cur_jobs)
-                         and all(new_job == old_job
-                                 for new_job, old_job in zip(
-                                         new_cur_jobs,
-                                         user.cur_jobs)))
-            return ((0, 'User exists')
-                    if same_list else
-                    (1, 'User exists but with a different job list.'))
+    new_values = []
+    for key, value in args:
+        try:
+            if key == 'level':
+                value = qpylog.parse_level(value)
+            elif key == 'sample':
+                value = float(value)
+                if not 0.0 <= value <= 1.0:
+                    raise ValueError
+            elif key == 'buffer':
+                if isinstance(value, float):
+                    raise ValueError
+                value = int(value)
+                if value < 0:
+                    raise ValueError
+            else:
+                return -1, 'Unknown logging option: ' + str(key)
+        except (TypeError, ValueError):
+            return -1, ('Invalid value for the logging option '
+                        + str(key) + ': ' + str(value))
+        new_values.append((key, value))
+    for key, value in new_values:
+        if key == 'level':
+            logging.getLogger().setLevel(value)
+        elif key == 'sample':
+            qpylog.traces.sample = value
         else:
-            if username in qpyusers.get_allowed_users():
-                users.add_user(username, nodes,
-                               address, port, conn_key, new_cur_jobs)
-                return ((0, 'User added')
-                        if users.distribute_cores(nodes) == 0 else
-                        (0, 'User added. Cores distribution failed.'))
+            qpylog.traces.set_buffer(value)
+    return 0, ('Log level: {0}\nTraces sample: {1}\nTraces buffer: {2}\n'
+               .format(logging.getLevelName(logging.getLogger().level),
+                       qpylog.traces.sample,
+                       0 if qpylog.traces.buffer is None else
+                       qpylog.traces.buffer.maxlen))
+
+
+def _handle_show_traces(args, users, nodes):
+    """Handle a request for the debug traces kept in memory
+    
+    args: ()
+    """
+    return 0, qpylog.traces.dump()
+
+
+def _handle_sync_user_info(args, users, nodes, state_lock):
+    """Handle a request to synchronize user info
+    
+    args: user_name, address, port, conn_key[, cur_jobs]
+    
+    Without cur_jobs, the running jobs of a new user are asked to
+    the user's master, before taking state_lock.
+    """
+    username, address, port, conn_key = args[:4]
+    new_cur_jobs = args[4] if len(args) > 4 else None
+    if new_cur_jobs is None and username not in users:
+        new_cur_jobs = users.request_running_jobs(username, address,
+                                                  port, conn_key)
+    with state_lock:
+        try:
+            if username in users:
+                user = users[username]
+                user.address = address
+                user.port = port
+                user.conn_key = conn_key
+                if new_cur_jobs is None:
+                    return 0, 'User exists'
+                same_list = (len(new_cur_jobs) == len(user.cur_jobs)
+                             and all(new_job == old_job
+                                     for new_job, old_job in zip(
+                                             new_cur_jobs,
+                                             user.cur_jobs)))
+                return ((0, 'User exists')
+                        if same_list else
+                        (1, 'User exists but with a different job list.'))
             else:
-                return 2, 'Not allowed user'
-    finally:
-        for user in users:
-            qpycomm.write_conn_files(qpysys.user_conn_file + user.name,
-                                     user.address,
-                                     user.port,
-                                     user.conn_key)
+                if username in qpyusers.get_allowed_users():
+                    users.add_user(username, nodes,
+                                   address, port, conn_key, new_cur_jobs)
+                    return ((0, 'User added')
+                            if users.distribute_cores(nodes) == 0 else
+                            (0, 'User added. Cores distribution failed.'))
+                else:
+                    return 2, 'Not allowed user'
+        finally:
+            for user in users:
+                qpycomm.write_conn_files(qpysys.user_conn_file + user.name,
+                                         user.address,
+                                         user.port,
+                                         user.conn_key)
 
 
 def _handle_add_job(args, users, nodes):
@@ -152,6 +247,37 @@ def _handle_add_job(args, users, nodes):
         return 0, allocated_node
 
 
+def _handle_add_jobs(args, users, nodes):
+    """Handle a request to add several jobs
+    
+    args: (user_name, queue_size, [(jobID, n_cores, mem, node_attr), ...])
+    
+    The jobs are tried in the given order, as if each one was
+    requested by _handle_add_job. The message back is a list with
+    the pairs (status, node or message) of each job.
+    """
+    user, queue_size, jobs = args
+    assert isinstance(user, str)
+    assert isinstance(queue_size, int)
+    assert isinstance(jobs, list)
+    if user not in users:
+        return -1, 'User does not exists.'
+    n_allocated = 0
+    results = []
+    for jobID, n_cores, mem, node_attr in jobs:
+        status, msg = _handle_add_job((user,
+                                       jobID,
+                                       n_cores,
+                                       mem,
+                                       queue_size - n_allocated,
+                                       node_attr),
+                                      users, nodes)
+        if status == 0:
+            n_allocated += 1
+        results.append((status, msg))
+    return 0, results
+
+
 def _handle_remove_job(args, users, nodes):
     """Handle  a request to remove a job
     
@@ -177,18 +303,221 @@ def _handle_remove_job(args, users, nodes):
                                               ex.args)
 
 
+_READ_ONLY_REQUESTS = (qpyconst.MULTIUSER_STATUS,
+                       qpyconst.MULTIUSER_SHOW_VARIABLES,
+                       qpyconst.MULTIUSER_METRICS,
+                       qpyconst.MULTIUSER_TRACES)
+
+
+def _process_request(action_type, arguments, users, nodes, state_lock):
+    """Process a request, returning the pair (status, msg)
+    
+    The handling time is recorded in qpymetrics.metrics.
+    See _dispatch_request.
+    """
+    try:
+        name = qpyconst.MULTIUSER_REQUEST_NAMES[action_type]
+    except (IndexError, TypeError):
+        name = str(action_type)
+    with qpymetrics.metrics.timer(f'request_seconds{{action="{name}"}}'):
+        return _dispatch_request(action_type, arguments,
+                                 users, nodes, state_lock)
+
+
+def _dispatch_request(action_type, arguments, users, nodes, state_lock):
+    """Process a request, returning the pair (status, msg)
+    
+    Requests that change users or nodes are serialized by state_lock,
+    whereas read-only requests (see _READ_ONLY_REQUESTS) run directly.
+    """
+    if action_type in _READ_ONLY_REQUESTS:
+        if (action_type == qpyconst.MULTIUSER_SHOW_VARIABLES):
+            return _handle_show_variables(arguments, users, nodes)
+        if (action_type == qpyconst.MULTIUSER_METRICS):
+            return _handle_show_metrics(arguments, users, nodes)
+        if (action_type == qpyconst.MULTIUSER_TRACES):
+            return _handle_show_traces(arguments, users, nodes)
+        return _handle_show_status(arguments, users, nodes)
+    if (action_type == qpyconst.MULTIUSER_USER):
+        # It takes state_lock only after asking the user's master
+        return _handle_sync_user_info(arguments, users, nodes, state_lock)
+    with state_lock:
+        if (action_type == qpyconst.MULTIUSER_NODES):
+            return _handle_reload_nodes(arguments, nodes)
+
+        elif (action_type == qpyconst.MULTIUSER_DISTRIBUTE):
+            return _handle_redistribute_cores(arguments, users, nodes)
+
+        elif (action_type == qpyconst.MULTIUSER_SAVE_MESSAGES):
+            return _handle_save_messages(arguments, users, nodes)
+
+        elif (action_type == qpyconst.MULTIUSER_LOGGING):
+            return _handle_logging(arguments, users, nodes)
+
+        elif (action_type == qpyconst.MULTIUSER_REQ_CORE):
+            return _handle_add_job(arguments, users, nodes)
+
+        elif (action_type == qpyconst.MULTIUSER_REQ_CORES):
+            return _handle_add_jobs(arguments, users, nodes)
+
+        elif (action_type == qpyconst.MULTIUSER_REMOVE_JOB):
+            return _handle_remove_job(arguments, users, nodes)
+
+        else:
+            return -1, 'Unknown option: ' + str(action_type)
+
+
+def _log_request(action_type, arguments, logger):
+    """Log a received request, and trace its arguments
+    
+    The arguments go only to the traces, see qpylog.Traces.
+    """
+    logger.info('Received request: %s, internal code %s.',
+                qpyconst.MULTIUSER_REQUEST_NAMES[action_type],
+                action_type)
+    qpylog.traces.start_request(logger)
+    if qpylog.traces.active:
+        qpylog.traces.trace(
+            logger,
+            'Arguments:\n'
+            '  %s\n',
+            arguments
+            if action_type != qpyconst.MULTIUSER_USER else
+            '(´･_･`) users connection are not logged!')
+
+
+def _serve_channel(client, users, nodes, state_lock, logger):
+    """Serve the requests from a persistent connection
+    
+    This runs in a dedicated thread, until the connection is closed
+    by the other side. See qpycomm.MultiuserChannel.
+    
+    Each message is (request_id, (action_type, arguments)) and the
+    answer is sent back as (request_id, (status, msg)).
+    """
+    logger.info('Opening a persistent connection.')
+    while True:
+        try:
+            request_id, (action_type, arguments) = client.recv()
+        except (OSError, EOFError):
+            break
+        except:
+            logger.exception("Persistent connection failed")
+            break
+        _log_request(action_type, arguments, logger)
+        try:
+            status, msg = _process_request(action_type, arguments,
+                                           users, nodes, state_lock)
+        except Exception as ex:
+            logger.exception("An error occured")
+            template = ('WARNING: an exception of type {0} occured.\n'
+                        + 'Arguments:\n{1!r}'
+                        + '\nContact the qpy-team.')
+            status, msg = -10, template.format(type(ex).__name__, ex.args)
+        try:
+            client.send((request_id, (status, msg)))
+        except:
+            logger.exception("An error occured while returning a message.")
+            break
+    client.close()
+    logger.info('Persistent connection closed.')
+
+
+def _serve_client(client, conn_key, users, nodes, state_lock, finish,
+                  logger):
+    """Receive a message from client, process it and send the answer
+    
+    This runs in the worker threads of handle_client, and the
+    connection is authenticated here (see
+    qpycomm.authenticate_client), thus a client that does not
+    answer holds only one worker, for a limited time.
+    
+    Return:
+    True if qpy-multiuser should finish, False otherwise.
+    """
+    try:
+        qpycomm.authenticate_client(client, conn_key,
+                                    qpyconst.MULTIUSER_RECV_TIMEOUT)
+        if not client.poll(qpyconst.MULTIUSER_RECV_TIMEOUT):
+            logger.warning('No message received from client.')
+            client.close()
+            return False
+        (action_type, arguments) = client.recv()
+    except (EOFError, OSError, TimeoutError, AuthenticationError) as exc:
+        logger.warning('Connection failed: %s', exc)
+        client.close()
+        return False
+    except:
+        logger.exception("Connection failed")
+        client.close()
+        return False
+    else:
+        _log_request(action_type, arguments, logger)
+    if (action_type == qpyconst.MULTIUSER_CHANNEL):
+        threading.Thread(target=_serve_channel,
+                         args=(client, users, nodes, state_lock, logger),
+                         name='multiuser_channel',
+                         daemon=True).start()
+        return False
+    try:
+        if (action_type == qpyconst.MULTIUSER_FINISH):
+            finish.set()
+            client.send((0, 'Finishing qpy-multiuser.'))
+            return True
+        status, msg = _process_request(action_type, arguments,
+                                       users, nodes, state_lock)
+    except Exception as ex:
+        logger.exception("An error occured")
+        template = ('WARNING: an exception of type {0} occured.\n'
+                    + 'Arguments:\n{1!r}'
+                    + '\nContact the qpy-team.')
+        try:
+            client.send((-10, template.format(type(ex).__name__, ex.args)))
+        except Exception:
+            logger.exception("An error occured while returning a message.")
+            pass
+    except BaseException as ex:
+        logger.exception("An error occured")
+        template = ('WARNING: an exception of type {0} occured.\n'
+                    + 'Arguments:\n{1!r}\n'
+                    + 'Contact the qpy-team.'
+                    + ' qpy-multiuser is shutting down.')
+        finish.set()
+        try:
+            client.send((-10, template.format(type(ex).__name__, ex.args)))
+        except Exception:
+            logger.exception("An error occured while returning a message.")
+            pass
+        return True
+    else:
+        try:
+            client.send((status, msg))
+        except:
+            logger.exception("An error occured while returning a message.")
+    finally:
+        client.close()
+    return False
+
+
 def handle_client(users, nodes, logger):
     """Handle the user messages sent from the client
     
     Behaviour:
     It opens a new connection using the multiuser connection
     parameters and waits for messages.
-    When a message is received, it analyzes it, does whatever
-    is needed and returns a message back.
+    Each accepted connection is handed to a pool of
+    qpyconst.MULTIUSER_N_WORKERS threads, that receive the message,
+    analyze it, do whatever is needed and return a message back.
+    Requests that change the state of users and nodes are serialized
+    by a lock, and read-only requests run in parallel. See
+    _process_request.
     
     The message from qpy must be a tuple (action_type, arguments)
     where action_type is one of qpyconst.MULTIUSER_<something>
     
+    A message (qpyconst.MULTIUSER_CHANNEL, ()) turns the connection
+    into a persistent one, served by its own thread (see _serve_channel).
+    
     To terminate, send a qpyconst.MULTIUSER_FINISH
     """
     (conn,
@@ -198,91 +527,36 @@ def handle_client(users, nodes, logger):
          qpyconst.PORT_MIN_MULTI,
          qpyconst.PORT_MAX_MULTI,
          port=qpycomm.multiuser_port,
-         conn_key=qpycomm.multiuser_key)
+         conn_key=qpycomm.multiuser_key,
+         authenticate=False)
     qpycomm.write_conn_files(qpysys.multiuser_conn_file,
                              qpycomm.multiuser_address,
                              multiuser_port,
                              multiuser_key)
-    while True:
-        logger.info("Waiting for a message.")
-        try:
-            client = conn.accept()
-            (action_type, arguments) = client.recv()
-        except:
-            logger.exception("Connection failed")
-        else:
-            logger.info('Received request:\n'
-                        '%s, internal code %s.\n'
-                        'Arguments:\n'
-                        '  %s\n',
-                        qpyconst.MULTIUSER_REQUEST_NAMES[action_type],
-                        action_type,
-                        arguments
-                        if action_type != qpyconst.MULTIUSER_USER else
-                        '(´･_･`) users connection are not logged!')
-        try:
-            if (action_type == qpyconst.MULTIUSER_NODES):
-                status, msg = _handle_reload_nodes(
-                    arguments, nodes)
-
-            elif (action_type == qpyconst.MULTIUSER_DISTRIBUTE):
-                status, msg = _handle_redistribute_cores(
-                    arguments, users, nodes)
-
-            elif (action_type == qpyconst.MULTIUSER_SHOW_VARIABLES):
-                status, msg = _handle_show_variables(
-                    arguments, users, nodes)
-
-            elif (action_type == qpyconst.MULTIUSER_STATUS):
-                status, msg = _handle_show_status(
-                    arguments, users, nodes)
-
-            elif (action_type == qpyconst.MULTIUSER_SAVE_MESSAGES):
-                status, msg = _handle_save_messages(
-                    arguments, users, nodes)
-
-            elif (action_type == qpyconst.MULTIUSER_FINISH):
-                client.send((0, 'Finishing qpy-multiuser.'))
-                conn.close()
-                break
-
-            elif (action_type == qpyconst.MULTIUSER_USER):
-                status, msg = _handle_sync_user_info(arguments, users, nodes)
-
-            elif (action_type == qpyconst.MULTIUSER_REQ_CORE):
-                status, msg = _handle_add_job(arguments, users, nodes)
+    state_lock = threading.RLock()
+    finish = threading.Event()
 
-            elif (action_type == qpyconst.MULTIUSER_REMOVE_JOB):
-                status, msg = _handle_remove_job(arguments, users, nodes)
-
-            else:
-                status, msg = -1, 'Unknown option: ' + str(action_type)
-        except Exception as ex:
-            logger.exception("An error occured")
-            template = ('WARNING: an exception of type {0} occured.\n'
-                        + 'Arguments:\n{1!r}'
-                        + '\nContact the qpy-team.')
+    def serve(client):
+        if _serve_client(client, multiuser_key, users, nodes, state_lock,
+                         finish, logger):
+            # Wake up the main loop, that might be waiting in accept
             try:
-                client.send((-10, template.format(type(ex).__name__, ex.args)))
-            except Exception:
-                logger.exception("An error occured while returning a message.")
-                pass
-        except BaseException as ex:
-            logger.exception("An error occured")
-            template = ('WARNING: an exception of type {0} occured.\n'
-                        + 'Arguments:\n{1!r}\n'
-                        + 'Contact the qpy-team.'
-                        + ' qpy-multiuser is shutting down.')
-            try:
-                client.send((-10, template.format(type(ex).__name__, ex.args)))
-            except Exception:
-                logger.exception("An error occured while returning a message.")
-                pass
-            finally:
-                break
-        else:
+                qpycomm.wake_up_listener(qpycomm.multiuser_address,
+                                         multiuser_port)
+            except:
+                logger.exception("Failed to wake up the main loop")
+
+    with ThreadPoolExecutor(max_workers=qpyconst.MULTIUSER_N_WORKERS,
+                            thread_name_prefix='handle_client') as executor:
+        while not finish.is_set():
+            logger.debug("Waiting for a message.")
             try:
-                client.send((status, msg))
+                client = conn.accept()
             except:
-                logger.exception("An error occured while returning a message.")
+                logger.exception("Connection failed")
                 continue
+            if finish.is_set():
+                client.close()
+                break
+            executor.submit(serve, client)
+    conn.close()
@@ -0,0 +1,83 @@
+""" qpy - Probes a node. This is to be called from qpy_nodes_management.Node.check
+
+USAGE: qpy_node_probe.py [<disk path>]
+
+Writes to stdout, as a single JSON object, the node information:
+
+n_cpus       number of cpus
+load         load average of the last 5 minutes
+n_busy       number of busy cpus, from the cpu usage of a short interval
+total_mem    total memory, in GB
+used_mem     used memory (total - available), in GB
+total_disk   total size of the disk, in GB (-1 if no disk path is given)
+used_disk    used space of the disk, in GB (-1 if no disk path is given)
+
+Only /proc and os.statvfs are used, so this is cheap and does not depend
+on the other qpy modules.
+"""
+import os
+import sys
+import json
+import time
+
+SAMPLE_INTERVAL = 0.25
+GB = 1024**3
+
+
+def cpu_times():
+    """Return (busy, total) jiffies of all cpus, from /proc/stat"""
+    with open('/proc/stat', 'r') as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return total - idle, total
+
+
+def memory():
+    """Return (total, used) memory in GB, from /proc/meminfo"""
+    info = {}
+    with open('/proc/meminfo', 'r') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) * 1024
+    total = info['MemTotal']
+    available = info.get('MemAvailable',
+                         info['MemFree']
+                         + info.get('Buffers', 0)
+                         + info.get('Cached', 0))
+    return total / GB, (total - available) / GB
+
+
+def disk(path):
+    """Return (total, used) space of the disk at path, in GB"""
+    st = os.statvfs(path)
+    return (st.f_blocks * st.f_frsize / GB,
+            (st.f_blocks - st.f_bfree) * st.f_frsize / GB)
+
+
+busy_0, total_0 = cpu_times()
+time.sleep(SAMPLE_INTERVAL)
+busy_1, total_1 = cpu_times()
+n_cpus = os.cpu_count()
+with open('/proc/loadavg', 'r') as f:
+    load = float(f.read().split()[1])
+total_mem, used_mem = memory()
+if len(sys.argv) > 1:
+    try:
+        total_disk, used_disk = disk(sys.argv[1])
+    except OSError:
+        total_disk = used_disk = -1.0
+else:
+    total_disk = used_disk = -1.0
+busy_fraction = ((busy_1 - busy_0) / (total_1 - total_0)
+                 if total_1 > total_0 else
+                 0.0)
+json.dump({'n_cpus': n_cpus,
+           'load': load,
+           'n_busy': int(round(busy_fraction * n_cpus)),
+           'total_mem': total_mem,
+           'used_mem': used_mem,
+           'total_disk': total_disk,
+           'used_disk': used_disk},
+          sys.stdout)
+sys.stdout.write('\n')
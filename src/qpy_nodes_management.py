@@ -2,13 +2,20 @@
 
 """
 import sys
+import json
+import shlex
+from time import time
+from bisect import bisect_right, insort
 from collections import namedtuple
+from functools import lru_cache
 import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import qpy_system as qpysys
 import qpy_logging as qpylog
 import qpy_communication as qpycomm
+import qpy_metrics as qpymetrics
 from qpy_exceptions import qpyConnectionError
 
 
@@ -74,138 +81,175 @@ class UsersNode:
         return self._n_jobs
 
 
-def _check_n_cpu(node_address):
-    """Get the number of cpus in the node"""
-    command = "nproc"
-    msg = ''
+_ATTRIBUTES_KEYWORDS = ('not', 'and', 'or', '(', ')')
+
+_attribute_bits = {}
+_attribute_bits_lock = threading.Lock()
+
+
+def _attribute_bit(attribute):
+    """Return the bit (an int with a single bit set) of attribute
+    
+    Each attribute (or node name) of a node gets its own bit the
+    first time it is seen (see attributes_mask), such that a set of
+    attributes is represented by an int. Only the attributes of nodes
+    get bits, not whatever is requested for a job (see _parse_attributes).
+    """
     try:
-        std_out, std_err = qpycomm.node_exec(node_address, command)
-    except Exception as e:
-        msg = str(e)
-        conn_success = False
-        n_cpus = 0
-    else:
-        conn_success = True
-        n_cpus = int(std_out)
-    return msg, conn_success, n_cpus
+        return _attribute_bits[attribute]
+    except KeyError:
+        with _attribute_bits_lock:
+            if attribute not in _attribute_bits:
+                _attribute_bits[attribute] = 1 << len(_attribute_bits)
+                # Expressions compiled before might have this attribute
+                # as unknown (see _parse_attributes)
+                compile_attributes.cache_clear()
+            return _attribute_bits[attribute]
 
 
-def _check_node_top(node_address, thr_cpu_usage=50):
-    """Check some information from "top" on a node
+@lru_cache(maxsize=None)
+def attributes_mask(name, attributes):
+    """Return the bitmask of a node with name and attributes (a tuple)
     
-    Parameters:
-    -----------
-    node_address (str)
-        The address of the node
-    thr_cpu_usage (float)
-        The threshold for considering a running proccess
-        A proccess is considered when the %CPU is larger
-        than this value
+    Call this before compile_attributes, for the attributes of the node
+    to be known by the compiled expression.
+    """
+    mask = _attribute_bit(name)
+    for attr in attributes:
+        mask |= _attribute_bit(attr)
+    return mask
+
+
+def _always_true(mask):
+    return True
+
+
+def _always_false(mask):
+    return False
+
+
+def _parse_attributes(tokens):
+    """Parse the tokens of a logical expression about attributes
     
-    Return:
-    -------
-    The following tuple:
+    The grammar, with the precedence of Python, is:
     
-    msg, conn_success, load, n_proc
+    expr     := and_expr ('or' and_expr)*
+    and_expr := not_expr ('and' not_expr)*
+    not_expr := 'not' not_expr | '(' expr ')' | <attribute>
     
-    That are, respectivelly, a messege; True or False indicating if
-    the connection was successful; the load, and the number of
-    processes;
+    Return:
+    -------
+    A function that receives the bitmask of a node
+    (see attributes_mask) and returns True or False
     
+    Raise:
+    ------
+    ValueError if the tokens do not form a valid expression
     """
-    command = "top -b -n1"  # | sed -n '8,50p'"
-    msg = ''
-    n_jobs = 0
-    load = 0
-    conn_success = False
-    try:
-        std_out, std_err = qpycomm.node_exec(node_address, command)
-    except Exception as e:
-        msg = str(e)
-    else:
-        conn_success = True
-        std_out = std_out.split("\n")
-        start_count = 0
-        for line in std_out:
-            line_spl = line.split()
-            if start_count == 0:
-                if len(line_spl) > 9:
-                    try:
-                        load_index = line_spl.index('load')
-                    except ValueError:
-                        pass
-                    else:
-                        load = float(line_spl[load_index+3].replace(',', ''))
-                if (len(line_spl) > 2
-                    and line_spl[0] == 'PID'
-                        and line_spl[1] == 'USER'):
-                    start_count = 1
-            else:
-                if float(line_spl[8].replace(',', '.')) > 50:
-                    n_jobs += 1
-                else:
-                    break
-    return msg, conn_success, load, n_jobs
+    pos = 0
+
+    def next_token():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def parse_or():
+        nonlocal pos
+        left = parse_and()
+        while next_token() == 'or':
+            pos += 1
+            right = parse_and()
+            left = (lambda l, r: lambda mask: l(mask) or r(mask))(left, right)
+        return left
+
+    def parse_and():
+        nonlocal pos
+        left = parse_not()
+        while next_token() == 'and':
+            pos += 1
+            right = parse_not()
+            left = (lambda l, r: lambda mask: l(mask) and r(mask))(left, right)
+        return left
 
+    def parse_not():
+        nonlocal pos
+        token = next_token()
+        if token == 'not':
+            pos += 1
+            operand = parse_not()
+            return lambda mask: not operand(mask)
+        if token == '(':
+            pos += 1
+            expr = parse_or()
+            if next_token() != ')':
+                raise ValueError('Missing ")"')
+            pos += 1
+            return expr
+        if token is None or token in _ATTRIBUTES_KEYWORDS:
+            raise ValueError(f'Unexpected {token}')
+        pos += 1
+        bit = _attribute_bits.get(token)
+        if bit is None:
+            # No node has this attribute
+            return _always_false
+        return lambda mask: mask & bit != 0
 
-def _check_node_disk(node_address, disk_path):
-    """Check the disk usage of a node
+    expr = parse_or()
+    if pos != len(tokens):
+        raise ValueError(f'Unexpected {tokens[pos]}')
+    return expr
+
+
+@lru_cache(maxsize=1024)
+def compile_attributes(req_attr):
+    """Compile a logical expression about attributes
     
-    Parameters:
-    -----------
-    node_address (str)  The address of the node
-    disk_path (str)     The disk to be checked
+    Arguments:
+    ----------
+    req_attr (tuple of str)
+        The expression, as in Node.has_attributes
     
     Return:
     -------
-    The following tuple:
-    
-    msg, conn_success, load, n_proc
-    
-    That are, respectivelly, a messege; True or False indicating if
-    the connection was successful; the total disk size; and its free space
-    
+    A function that receives the bitmask of a node
+    (see attributes_mask) and returns True if the node
+    satisfies the expression.
+    If req_attr is empty or is not a valid expression, this
+    function always returns True.
     """
-    command = f'df -BG {disk_path}'
-    msg = ''
+    tokens = (' '.join(req_attr)).replace('(', ' ( ').replace(')',
+                                                             ' ) ').split()
+    if not tokens:
+        return _always_true
     try:
-        std_out, std_err = qpycomm.node_exec(node_address, command)
-    except Exception as e:
-        msg = str(e)
-        conn_success = False
-        used_disk = -1.0
-        total_disk = -1.0
-    else:
-        std_out_spl = std_out.split("\n")
-        conn_success = True
-        if len(std_out_spl) > 1:
-            std_out_spl = std_out_spl[1].split()
-            total_disk = float(std_out_spl[1].replace('G', ''))
-            used_disk = float(std_out_spl[2].replace('G', ''))
-        else:
-            msg= f"Parsing the df command failed:\n{std_out}"
-            total_disk = -1.0
-            used_disk = -1.0
-    return msg, conn_success, total_disk, used_disk
+        return _parse_attributes(tokens)
+    except ValueError:
+        return _always_true
 
 
-def _check_node_memory(node_address):
-    """Check the memory information of a node"""
-    command = "free -g"
-    conn_success = True
-    msg = ''
-    try:
-        std_out, std_err = qpycomm.node_exec(node_address, command)
-    except Exception as e:
-        msg = str(e)
-        conn_success = False
-        used_mem = 0.0
-        total_mem = 0.0
-    else:
-        std_out = std_out.split("\n")[1].split()
-        total_mem = float(std_out[1])
-        used_mem = float(std_out[2])
-    return msg, conn_success, used_mem, total_mem
+NodeInfo = namedtuple('NodeInfo',
+                      ['is_up',
+                       'n_cores',
+                       'n_outsiders',
+                       'total_mem',
+                       'used_mem',
+                       'load',
+                       'total_disk',
+                       'used_disk'])
+
+def _probe_command(disk_path):
+    """The command that collects all node information at once
+    
+    Parameters:
+    -----------
+    disk_path (str or None)
+        The disk to be checked. If None, the disk is not checked
+    
+    See qpy_node_probe.py
+    """
+    command = 'python3 ' + shlex.quote(qpysys.source_dir
+                                       + 'qpy_node_probe.py')
+    if disk_path is not None:
+        command += ' ' + shlex.quote(disk_path)
+    return command
 
 
 class Node:
@@ -300,6 +344,7 @@ class Node:
                  'check_dir',
                  'total_disk',
                  'used_disk',
+                 'last_check',
                  'messages',
                  'logger')
     
@@ -321,9 +366,8 @@ class Node:
         self.load = 0.0
         self.total_disk = 0.0
         self.used_disk = 0.0
-        self.logger = qpylog.configure_logger(qpysys.multiuser_log_file,
-                                              level=logging.DEBUG,
-                                              logger_name=f'node {name}')
+        self.last_check = None
+        self.logger = logging.getLogger(f'node {name}')
 
     def __str__(self):
         """String version of node"""
@@ -462,10 +506,20 @@ class Node:
     def free_mem(self):
         return self.total_mem - self.used_mem
 
-    def check(self):
+    def check(self, timeout=None):
         """Check several things in the node.
         
-        Returns a named tuple with the information:
+        Everything is obtained from a single execution of
+        qpy_node_probe.py in the node.
+        
+        Arguments:
+        ----------
+        timeout (float)
+            (optional, default = None) If not None, the node is considered
+            down if the information is not obtained within this amount
+            of seconds
+        
+        Returns a NodeInfo named tuple with the information:
         
         is_up           True if the node is up
         n_cores         The number of cores in the node
@@ -479,64 +533,47 @@ class Node:
         This function DOES NOT change the attributes of
         the node (except for adding messages), what should
         be done by the caller if desired.
-        
-        TODO:
-        -----
-        Better if this is done with one connection, instead of one for each property
         """
-        info = namedtuple('NodeInfo',
-                          ['is_up',
-                           'n_cores',
-                           'n_outsiders',
-                           'total_mem',
-                           'used_real',
-                           'load',
-                           'total_disk',
-                           'used_disk'])
-        info.is_up = True
-        if self.max_cores == 0:
-            (msg,
-             info.is_up,
-             info.n_cores) = _check_n_cpu(self.address)
-        (msg,
-         info.is_up,
-         info.load,
-         n_jobs) = _check_node_top(self.address)
-        if info.is_up:
-            self.logger.info('Load and untracked jobs checked')
-        else:
-            self.logger.warning('After load and untracked jobs:\n%s', msg)
-        info.n_outsiders = max(n_jobs - self.n_used_cores, 0)
-        (msg,
-         info.is_up,
-         info.used_mem,
-         info.total_mem) = _check_node_memory(self.address)
-        if info.is_up:
-            self.logger.info('Memory checked')
-        else:
-            self.logger.warning('After memory:\n%s', msg)
-        if self.check_dir is None:
-            info.total_disk = -1.0
-            info.used_disk = -1.0
-        else:
-            (msg,
-             info.is_up,
-             info.total_disk,
-             info.used_disk) = _check_node_disk(self.address, self.check_dir)
-            if info.is_up:
-                self.logger.info('Disk usage checked')
-            else:
-                self.logger.warning('After disk usage:\n%s', msg)
+        try:
+            std_out, std_err = qpycomm.node_exec(
+                self.address,
+                _probe_command(self.check_dir),
+                localhost_popen_shell=True,
+                timeout=timeout)
+        except Exception as e:
+            self.logger.warning('Node could not be checked:\n%s', str(e))
+            return self.down_info()
+        try:
+            probe = json.loads(std_out)
+            info = NodeInfo(True,
+                            (int(probe['n_cpus'])
+                             if self.max_cores == 0 else
+                             self.max_cores),
+                            max(int(probe['n_busy']) - self.n_used_cores, 0),
+                            float(probe['total_mem']),
+                            float(probe['used_mem']),
+                            float(probe['load']),
+                            float(probe['total_disk']),
+                            float(probe['used_disk']))
+        except (ValueError, KeyError, TypeError):
+            self.logger.warning('Failed parsing the node information:\n'
+                                '%s\n%s', std_out, std_err)
+            return self.down_info()
+        self.logger.info('Node checked')
         return info
 
+    def down_info(self):
+        """The NodeInfo of a node that could not be checked"""
+        return NodeInfo(False, self.max_cores, 0, 0.0, 0.0, 0.0, -1.0, -1.0)
+
     def has_attributes(self, req_attr):
         """Check if the node satisfy the attributes requirement
         
         Return True if the node has the attributes described by
         the list req_attr. It should be a list of strings, such
-        that after joining each entry with space and replacing the
-        attributes by True or False, a valid python logical expression
-        is obtained.
+        that after joining each entry with space, a logical expression
+        with "not", "and", "or" and parentheses about attributes
+        is obtained. The name of the node is also an attribute.
         
         Arguments:
         ----------
@@ -548,36 +585,17 @@ class Node:
         The final evaluation of the expression.
         If is not a valid expression, returns True!
         
+        See also:
+        ---------
+        compile_attributes
+        
         TODO:
         -----
         Perhaps raise an Exception if the expression is not valid,
         and the caller decide if the job is used??
         """
-        keywords = ['not', 'and', 'or', '(', ')']
-        if len(req_attr) == 0:
-            return True
-        expression = (' '.join(req_attr)).replace('(',
-                                                  ' ( ').replace(')',
-                                                                 ' ) ')
-        expression = expression.split()
-        expression = [x
-                      if x in keywords else
-                      str(x in self.attributes or x == self.name)
-                      for x in expression]
-        try:
-            res = eval(' '.join(expression))
-        except:
-            res = True
-        self.logger.debug('\n'
-                          'nodes attributes      %s\n'
-                          'original expression   %s\n'
-                          'parsed expression     %s\n'
-                          'evaluated expression  %s\n',
-                          self.attributes,
-                          req_attr,
-                          expression,
-                          res)
-        return res
+        mask = attributes_mask(self.name, tuple(self.attributes))
+        return compile_attributes(tuple(req_attr))(mask)
 
     def free_resource(self, n_cores, mem):
         """Free n_cores of cores and mem of memory"""
@@ -611,6 +629,20 @@ class NodesCollection:
     n_outsiders (int)
         Total number of outsieders in all nodes
     
+    The nodes are also kept in an index, sorted by their number of
+    free cores, that is used by best_node. It is updated by
+    allocate_resource, free_resource and check.
+    
+    check_time (float)
+        Time, in seconds, between two checks of the nodes (see CheckNodes)
+    
+    check_max_workers (int)
+        Maximum number of nodes checked at the same time
+    
+    check_node_timeout (float)
+        Time, in seconds, to wait for the information of a node.
+        After that, the node is considered down
+    
     
     Data Model:
     -----------
@@ -643,7 +675,6 @@ class NodesCollection:
     
     __slots__ = (
         '_the_nodes',
-        '_the_names',
         '_n_cores',
         '_n_min_cores',
         '_n_used_cores',
@@ -652,22 +683,32 @@ class NodesCollection:
         'check_lock',
         'check_alive',
         'check_time',
+        'check_max_workers',
+        'check_node_timeout',
+        '_attr_matches',
+        '_free_index',
+        '_index_keys',
+        '_next_position',
         'logger')
 
     def __init__(self):
         """Initilise the class
         """
-        self.check_lock = threading.RLock()
+        self.check_lock = qpymetrics.TimedLock(threading.RLock(),
+                                               'check_lock')
         self.check_alive = True
-        self.logger = qpylog.configure_logger(qpysys.multiuser_log_file,
-                                              level=logging.DEBUG,
-                                              logger_name='nodes')
+        self.logger = logging.getLogger('nodes')
         self.empty_nodes()
         self.check_time = 300
+        self.check_max_workers = 16
+        self.check_node_timeout = 60
 
     def empty_nodes(self):
-        self._the_nodes = []
-        self._the_names = []
+        self._the_nodes = {}
+        self._attr_matches = {}
+        self._free_index = []
+        self._index_keys = {}
+        self._next_position = 0
         self._n_cores = 0
         self._n_min_cores = 0
         self._n_used_cores = 0
@@ -686,7 +727,8 @@ class NodesCollection:
                     + '     used     req   total  used  total\n'
                     + sep1 )
         with self.check_lock:
-            x = (headerN + '\n'.join(list(map(str, self._the_nodes))) + '\n' + sep2
+            x = (headerN + '\n'.join(list(map(str, self._the_nodes.values())))
+                 + '\n' + sep2
                  if self._the_nodes else
                  'No nodes.')
             x += (f'There are {self.n_used_cores + self.n_outsiders}'
@@ -712,19 +754,19 @@ class NodesCollection:
 
     def __getitem__(self, k):
         try:
-            i = self._the_names.index(k)
-        except ValueError:
+            return self._the_nodes[k]
+        except KeyError:
             raise KeyError(f'Node {k} is ont in the collection')
-        return self._the_nodes[i]
 
     def __contains__(self, x):
-        return x in self._the_names
+        return x in self._the_nodes
 
     def __iter__(self):
-        return iter(self._the_nodes)
+        # over a copy: nodes might be removed in the meantime
+        return iter(list(self._the_nodes.values()))
 
     def items(self):
-        return iter(zip(self._the_names, self._the_nodes))
+        return iter(list(self._the_nodes.items()))
 
     @property
     def n_cores(self):
@@ -749,11 +791,19 @@ class NodesCollection:
     def add_node(self, n):
         """Add a new node, n.
         
+        If there is already a node with the same name, it is replaced.
+        
         This is NOT thread safe, see class documentation.
         """
-        self._the_nodes.append(n)
-        self._the_names.append(n.name)
+        if n.name in self._the_nodes:
+            self.logger.warning('Replacing node %s', n.name)
+            self.remove_node(n.name)
+        self._the_nodes[n.name] = n
         self._n_cores += n.max_cores
+        self._attr_matches = {}
+        self._index_keys[n.name] = None
+        self._update_index(n, self._next_position)
+        self._next_position += 1
 
     def remove_node(self, name):
         """Remove a node by its name
@@ -761,10 +811,15 @@ class NodesCollection:
         This IS thread safe, see class documentation.
         """
         with self.check_lock:
-            i = self._the_names.index(name)
-            self._n_cores -= self._the_nodes[i].max_cores
-            del self._the_names[i]
-            del self._the_nodes[i]
+            try:
+                node = self._the_nodes.pop(name)
+            except KeyError:
+                raise ValueError(f'Node {name} is not in the collection')
+            self._n_cores -= node.max_cores
+            del self._free_index[bisect_right(self._free_index,
+                                              self._index_keys[name]) - 1]
+            del self._index_keys[name]
+            self._attr_matches = {}
 
     def load_from_file(self, filename):
         """Load the nodes fro file filename
@@ -784,16 +839,54 @@ class NodesCollection:
                 for line in f:
                     self.add_node(Node.from_string(line))
 
+    def _check_node(self, node):
+        """Check a single node, returning the pair (node, info)"""
+        self.logger.info("Checking %s", node.name)
+        info = node.check(timeout=self.check_node_timeout)
+        self.logger.info("Done checking %s", node.name)
+        return node, info
+
     def check(self):
-        """Check all nodes and update their status"""
+        """Check all nodes and update their status
+        
+        The nodes are checked concurrently, by at most check_max_workers
+        threads. Nodes that do not answer within check_node_timeout
+        seconds are marked as down. The attributes of the nodes are
+        updated at the end, all at once within check_lock.
+        """
+        with self.check_lock:
+            nodes = list(self._the_nodes.values())
+        if not nodes:
+            return
+        n_workers = min(self.check_max_workers, len(nodes))
+        deadline = self.check_node_timeout * (1 + (len(nodes) - 1)//n_workers)
         nodes_info = []
         try:
-            for node in self:
-                self.logger.info("Checking %s", node.name)
-                nodes_info.append(node.check())
-                self.logger.info("Done checking %s", node.name)
+            executor = ThreadPoolExecutor(max_workers=n_workers,
+                                          thread_name_prefix='check_node')
+            futures = {executor.submit(self._check_node, node): node
+                       for node in nodes}
+            done, not_done = wait(futures, timeout=deadline + 5)
+            for future in not_done:
+                future.cancel()
+            executor.shutdown(wait=False)
+            for future, node in futures.items():
+                if future in done and future.exception() is None:
+                    nodes_info.append(future.result())
+                else:
+                    if future in done:
+                        self.logger.error("Error when checking %s",
+                                          node.name,
+                                          exc_info=future.exception())
+                    else:
+                        self.logger.warning("Timeout when checking %s",
+                                            node.name)
+                    nodes_info.append((node, node.down_info()))
             with self.check_lock:
-                for node, info in zip(self._the_nodes, nodes_info):
+                for node, info in nodes_info:
+                    if node.name not in self or self[node.name] is not node:
+                        # the nodes were reloaded in the meantime
+                        continue
                     self._n_outsiders += (info.n_outsiders - node.n_outsiders)
                     node.is_up = info.is_up
                     if node.max_cores == 0:
@@ -805,21 +898,143 @@ class NodesCollection:
                     node.load = info.load
                     node.total_disk = info.total_disk
                     node.used_disk = info.used_disk
+                    if info.is_up:
+                        node.last_check = time()
+                    self._update_index(node)
         except:
             self.logger.exception("Error when checking nodes")
 
+    def nodes_with_attributes(self, req_attr):
+        """Return the names of the nodes that satisfy req_attr
+        
+        Arguments:
+        ----------
+        req_attr (list)
+            A logical expression about attributes, see Node.has_attributes
+        
+        Return:
+        -------
+        A frozenset with the names of the nodes.
+        The result is cached for each expression, until the nodes
+        are changed (add_node, remove_node, load_from_file).
+        """
+        req_attr = tuple(req_attr)
+        attr_matches = self._attr_matches
+        try:
+            return attr_matches[req_attr]
+        except KeyError:
+            pass
+        masks = [(node.name, attributes_mask(node.name,
+                                             tuple(node.attributes)))
+                 for node in list(self._the_nodes.values())]
+        expr = compile_attributes(req_attr)
+        matches = frozenset(name for name, mask in masks if expr(mask))
+        if qpylog.traces.active:
+            qpylog.traces.trace(self.logger, 'Nodes with attributes %s: %s',
+                                req_attr, sorted(matches))
+        attr_matches[req_attr] = matches
+        return matches
+
     def free_resource(self, node, n_cores, mem, n_min_cores):
         """Free n_cores and mem on node"""
-        self[node].free_resource(n_cores, mem)
+        node = self[node]
+        node.free_resource(n_cores, mem)
+        self._update_index(node)
         self._n_used_cores -= n_cores
         self._n_used_min_cores -= n_min_cores
 
     def allocate_resource(self, node, n_cores, mem, n_min_cores):
         """Allocate n_cores and mem on node"""
-        self[node].allocate_resource(n_cores, mem)
+        node = self[node]
+        node.allocate_resource(n_cores, mem)
+        self._update_index(node)
         self._n_used_cores += n_cores
         self._n_used_min_cores += n_min_cores
 
+    def _update_index(self, node, position=None):
+        """Put node in the right place of the free cores index
+        
+        The entries of the index are (-n_free_cores, position, name),
+        where position gives the order in which the nodes were added.
+        """
+        old_key = self._index_keys[node.name]
+        if old_key is not None:
+            if old_key[0] == -node.n_free_cores:
+                return
+            position = old_key[1]
+            del self._free_index[bisect_right(self._free_index, old_key) - 1]
+        new_key = (-node.n_free_cores, position, node.name)
+        insort(self._free_index, new_key)
+        self._index_keys[node.name] = new_key
+
+    def best_node(self, num_cores, mem, node_attr):
+        """Return the best node for a job, or None if there is none
+        
+        Arguments:
+        ----------
+        num_cores (int)
+            Number of cores of the job
+        mem (float)
+            Memory of the job
+        node_attr (list)
+            Attributes that the node must fulfil (see Node.has_attributes)
+        
+        Behaviour:
+        ----------
+        For single core jobs, the node that is not preferred for
+        multicore jobs with the largest number of free cores, and
+        enough available and free memory, is selected.
+        Otherwise, or if there is no such node, the first node (in the
+        order they were added) that is up and has enough free cores and
+        available memory is selected.
+        For single core jobs, the nodes are visited from the free cores
+        index, that is sorted by the number of free cores. Otherwise,
+        the nodes are visited in the order they were added (that is the
+        order of _the_nodes), stopping at the first suitable node, and
+        the index just tells if there is any node with enough free cores.
+        
+        This is NOT thread safe, see class documentation.
+        """
+        with_attr = self.nodes_with_attributes(node_attr)
+        if num_cores == 1:
+            for minus_free, position, name in self._free_index:
+                if minus_free >= 0:
+                    break
+                node = self[name]
+                if (name in with_attr
+                    and not(node.pref_multicores)
+                    and node.avail_mem > mem
+                        and node.free_mem > mem):
+                    return node
+        if not self._free_index or self._free_index[0][0] > -num_cores:
+            return None
+        for name, node in self._the_nodes.items():
+            if (node.n_free_cores >= num_cores
+                and node.is_up
+                and name in with_attr
+                    and node.avail_mem > mem):
+                return node
+        return None
+
+    def rejection_reason(self, num_cores, mem, node_attr):
+        """Return why best_node did not find a node for a job
+        
+        Return:
+        -------
+        'attributes' if there is no node up with the attributes,
+        'memory' if some of these nodes have enough free cores
+        but not enough memory, and 'cores' otherwise.
+        
+        This is NOT thread safe, see class documentation.
+        """
+        nodes = [self[name] for name in self.nodes_with_attributes(node_attr)
+                 if self[name].is_up]
+        if not nodes:
+            return 'attributes'
+        if any(node.n_free_cores >= num_cores for node in nodes):
+            return 'memory'
+        return 'cores'
+
 
 class CheckNodes(threading.Thread):
     """Check the nodes regularly.
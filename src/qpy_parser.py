@@ -3,13 +3,10 @@
 """
 import os
 import sys
-import subprocess
-from optparse import OptionParser
 
 import qpy_system as qpysys
 import qpy_useful_cosmetics as qpyutil
 import qpy_constants as qpyconst
-from qpy_exceptions import qpyHelpException
 
 
 class ParseError(Exception):
@@ -149,6 +146,7 @@ def parse_qpy_cmd_line():
         elif pattern:
             pattern = '--pattern "' + pattern + '"'
         command = 'less ' + pattern + ' ' + qpysys.tutorial_file
+        import subprocess
         try:
             subprocess.call(command, shell=True)
         except:
@@ -218,6 +216,32 @@ def parse_qpy_multiuser_cmd_line():
             usage_msg = 'Usage: ' + sys.argv[0] + ' [true,false].'
             sys.exit(usage_msg)
 
+    if (option == qpyconst.MULTIUSER_LOGGING):
+        usage_msg = ('Usage: ' + sys.argv[0]
+                     + ' logging [level <level>] [sample <fraction>]'
+                     + ' [buffer <size>].')
+        if len(sys.argv) % 2 != 0:
+            sys.exit(usage_msg)
+        import qpy_logging as qpylog
+        arguments = []
+        for key, value in zip(sys.argv[2::2], sys.argv[3::2]):
+            try:
+                if key == 'level':
+                    qpylog.parse_level(value)
+                elif key == 'sample':
+                    value = float(value)
+                    if not 0.0 <= value <= 1.0:
+                        raise ValueError
+                elif key == 'buffer':
+                    value = int(value)
+                    if value < 0:
+                        raise ValueError
+                else:
+                    raise ValueError
+            except ValueError:
+                sys.exit(usage_msg)
+            arguments.append((key, value))
+
     if (option == qpyconst.MULTIUSER_START):
         start_qpy_multiuser = True
 
@@ -234,6 +258,7 @@ def parse_qpy_multiuser_cmd_line():
             pattern = '--pattern "' + pattern + '"'
 
         command = 'less ' + pattern + ' ' + qpysys.tutorial_file
+        import subprocess
         try:
             subprocess.call(command, shell=True)
         except:
@@ -241,210 +266,3 @@ def parse_qpy_multiuser_cmd_line():
         exit()
 
     return option, arguments, start_qpy_multiuser
-
-
-class JobOptParser(OptionParser):
-    """A parser for the job options
-    
-    Behaviour:
-    
-    A Job in qpy can be submitted with several options,
-    and the purpose of this class is to handle these options.
-    These options can be passed by command line:
-    
-    $ qpy sub -m 0.1 date
-    
-    where the options are flagged with the -<letter> and --<word>
-    conventions. If the command to be submitted is a script (with its
-    full path), options can be given inside the script, for example:
-    
-    $ cat ./script.sh
-    #QPY mem=0.1
-    sleep
-    $ qpy sub ./script.sh
-    
-    The options inside the script should follow the convention:
-
-    #QPY <key>=<value>; <key>  = <value>
-    #QPY <key> = <value>
-
-    That is: each line has several pairs <key> <value>,
-    separated by semicolon: ";".
-    The pairs <key> <value> should be separated
-    by the equal sign: "=".
-    The number of spaces around the equal and semicolon signs
-    is arbitrary.
-    There are, in general, several possible keys with the same effect
-    
-    The possible options are:
-    
-    ## Number of cores (integer) requested for this job:
-    
-    command line flags:  -n, --cores
-    keys for script:     n_cores, number of cores
-    
-    ## Memory (float) in GB requested for this job:
-    
-    command line flags:  -m, --mem, --memory
-    keys for script:     mem, memory
-    
-    ## Attributes of the nodes for this job. It can be any logical expression
-    of Python, that can have node attributes that will be replaced by a boolean
-    (indicating whether the node has that attribute). If passed by command
-    line, this logical expression can not have spaces.
-
-    command line flags:  -a, --node_attr, --attributes
-    keys for script:     node_attr, node attributes
-
-    ## If flagged (in command line) or set to true in the script,
-    copies the script, such that the original version is submitted
-
-    command line flags: -c, --copyScript
-    keys for script:    copy script, cpScript, cp_script
-    
-    NOTE:
-    Optparse is deprecated.
-    The overwritten
-    functions are somewhat mentioned in the documentation.
-    
-    TODO:
-    replace it by argparse
-    """
-    def exit(self, prog='', message=''):
-        raise ParseError(message)
-    
-    def error(self, message):
-        raise ParseError(message)
-    
-    def print_usage(self):
-        pass
-    
-    def print_version(self):
-        pass
-    
-    def print_help(self):
-        raise qpyHelpException(self.format_help())
-
-    @classmethod
-    def set_parser(cls):
-        """Instantiate a parser and set flags for command line."""
-        parser = cls()
-        parser.add_option("-n", "--cores", dest="cores",
-                          help="set the number of cores", default="1")
-        parser.add_option("-m", "--mem", "--memory", dest="memory",
-                          help="set the memory in GB", default="5")
-        parser.add_option("-a", "--node_attr", "--attributes",
-                          dest="node_attr",
-                          help="set the attributes for node", default='')
-        parser.add_option("-c", "--copyScript", dest="cpScript",
-                          help="script should be copied",
-                          action='store_false')
-        parser.add_option("-o", "--originalScript", dest="orScript",
-                          help="use original script",
-                          action='store_false')
-        parser.disable_interspersed_args()
-        return parser
-
-    def _scanline(self, line, options):
-        """Parse the line for qpy options.
-        
-        Arguments:
-        line (str)       The line to be parsed
-        options (dict)   A dictionary with the options
-        
-        Behaviour:
-        If the line sets some qpy option, put it in options
-        
-        Raise:
-        ParseError   In case there is an error in the syntax
-        """
-        if line[0:5] == '#QPY ':
-            line_split = line[5:].split(';')
-            for kv in line_split:
-                if kv:
-                    try:
-                        k, v = [x.strip() for x in kv.split('=')]
-                    except ValueError:
-                        raise ParseError(
-                            'Invalid syntax for options inside script: ' + kv)
-                    try:
-                        if k in ['number of cores',
-                                 'n_cores']:
-                            options['n_cores'] = int(v)
-                        elif k in ['memory',
-                                   'mem']:
-                            options['mem'] = float(v)
-                        elif k in ['node attributes',
-                                   'node_attr']:
-                            options['node_attr'] = v.split()
-                        elif k in ['copy script',
-                                   'cpScript',
-                                   'cp_script']:
-                            options['use_script_copy'] = (
-                                qpyutil.true_or_false(v))
-                        else:
-                            raise ParseError('Unknown script option: ' + k)
-                    except ValueError:
-                        raise ParseError(
-                            "Invalid value for {0}: {1}.".format(k, v))
-
-    def parse_file(self, file_name, options):
-        """Parse a submission script file for options set in the script.
-        
-        Arguments::
-        file_name (str)     The file name
-        options (dict)      A dictionary with the options that can be set
-        
-        Raise:
-        ParseError   In case there is an error in the syntax
-        
-        See also:
-        _scanline
-        """
-        try:
-            with open(file_name, 'r') as f:
-                for line in f:
-                    self._scanline(line, options)
-        except IOError:
-            pass
-
-    def parse_cmd_line(self, command, options):
-        """Parse the command for options.
-        
-        Arguments:
-        command (str)     The command to be parsed
-        options (dict)    The options to be set
-        
-        Behaviour:
-        Set the options found in the command and return the
-        command free of these options.
-        
-        Return:
-        The command, without the parsed options.
-        
-        Raise:
-        ParseError    if the parse was not successful
-        """
-        try:
-            parsed_opt, command = self.parse_args(command.split())
-            options['n_cores'] = int(parsed_opt.cores)
-            options['mem'] = float(parsed_opt.memory)
-            if parsed_opt.node_attr:
-                options['node_attr'] = parsed_opt.node_attr.split('##')
-            else:
-                options['node_attr'] = []
-            if parsed_opt.cpScript is None and parsed_opt.orScript is None:
-                pass
-            elif (parsed_opt.cpScript is not None
-                  and parsed_opt.orScript is not None):
-                raise ParseError(
-                    "Please, do not supply both cpScript and orScript")
-            elif parsed_opt.cpScript is not None:
-                options['use_script_copy'] = True
-            else:
-                options['use_script_copy'] = False
-        except ValueError:
-            raise ParseError(
-                "Please supply only numbers for memory or"
-                + " number of cores, true or false for cpScript")
-        return ' '.join(command)
@@ -23,8 +23,12 @@ if qpy_instance == 'qpy' or qpy_instance == 'qpy-master.py':
         qpy_dir = os.path.expanduser('~/.qpy/')
     scripts_dir = qpy_dir + '/scripts/'
     notes_dir = qpy_dir + '/notes/'
+    job_status_dir = qpy_dir + '/job_status/'
+    job_pgid_dir = qpy_dir + '/job_pgid/'
     jobID_file = qpy_dir + '/next_jobID'
     all_jobs_file = qpy_dir + '/all_jobs'
+    all_jobs_snapshot_file = qpy_dir + '/all_jobs.snapshot'
+    all_jobs_journal_file = qpy_dir + '/all_jobs.journal'
     config_file = qpy_dir + '/config'
     multiuser_conn_file = qpy_dir + 'multiuser_connection'
     master_conn_file = qpy_dir + 'master_connection'
@@ -43,6 +47,7 @@ else:
     user_conn_file = qpy_multiuser_dir + 'connection_'
     multiuser_conn_file = qpy_multiuser_dir + 'multiuser_connection'
     multiuser_log_file = qpy_multiuser_dir + 'multiuser.log'
+    multiuser_metrics_file = qpy_multiuser_dir + 'metrics.prom'
     tutorial_file = source_dir + '../doc/adm_tutorial'
     qpy_multiuser_command = ['python3',
                              source_dir + 'qpy-multiuser.py',
@@ -1,12 +1,13 @@
 """ qpy - Functions and classes related to users
 
 """
-from math import copysign
+import os
 import logging
 
 import qpy_system as qpysys
 import qpy_logging as qpylog
 import qpy_communication as qpycomm
+import qpy_metrics as qpymetrics
 from qpy_job import MultiuserJob
 import qpy_constants as qpyconst
 from qpy_parser import ParseError
@@ -47,6 +48,10 @@ class User:
     cur_jobs      Current jobs
     
     messages      Debugging messages
+    
+    When n_used_cores or n_queue change, the function _on_change
+    (if not None) is called with the user. UsersCollection uses this
+    to keep its fairness aggregates up to date.
     """
     
     __slots__ = (
@@ -57,8 +62,9 @@ class User:
         'min_cores',
         'extra_cores',
         'max_cores',
-        'n_used_cores',
-        'n_queue',
+        '_n_used_cores',
+        '_n_queue',
+        '_on_change',
         'cur_jobs',
         'logger',
         'messages')
@@ -77,6 +83,7 @@ class User:
         self.port = port
         self.conn_key = conn_key
         
+        self._on_change = None
         self.min_cores = 0
         self.extra_cores = 0
         self.max_cores = 0
@@ -84,9 +91,7 @@ class User:
         self.n_queue = 0
         self.cur_jobs = []
         
-        self.logger = qpylog.configure_logger(qpysys.multiuser_log_file,
-                                              level=logging.DEBUG,
-                                              logger_name=f'user {name}')
+        self.logger = logging.getLogger(f'user {name}')
         
         self.messages = qpylog.Messages()
         self.messages.save = True
@@ -117,6 +122,45 @@ class User:
                           infos,
                           current_jobs]) + messages
 
+    @property
+    def n_used_cores(self):
+        return self._n_used_cores
+
+    @n_used_cores.setter
+    def n_used_cores(self, value):
+        self._n_used_cores = value
+        if self._on_change is not None:
+            self._on_change(self)
+
+    @property
+    def n_queue(self):
+        return self._n_queue
+
+    @n_queue.setter
+    def n_queue(self, value):
+        self._n_queue = value
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def fairness_contribution(self):
+        """Return the contribution of this user to the fairness aggregates
+        
+        Return:
+        The pair (with_queue, n_extra): with_queue is 1 if the user
+        has jobs in the queue and uses all its min and extra cores
+        (0 otherwise); n_extra is the number of its extra cores that
+        can be lent to other users, if the user has no jobs in the queue.
+        See request_node.
+        """
+        if (self.n_queue > 0
+                and self.n_used_cores >= self.min_cores + self.extra_cores):
+            return 1, 0
+        if self.n_queue == 0:
+            return 0, min(self.extra_cores + self.min_cores
+                          - self.n_used_cores,
+                          self.extra_cores)
+        return 0, 0
+
     def remove_job(self, jobID, nodes):
         """Remove a job from the user and from the nodes.
         
@@ -219,45 +263,35 @@ class User:
         n_free_cores = ((nodes.n_cores - nodes.n_used_cores)
                         - (nodes.n_min_cores - nodes.n_used_min_cores))
         free_cores = n_free_cores >= num_cores
-        self.logger.debug('Requesting resource:\n'
-                          '  jobID = %s\n'
-                          '  requested cores = %d\n'
-                          '  requested memory = %.2f\n'
-                          '  attribute = %s\n'
-                          'Nodes info:\n'
-                          '  n_cores = %d\n'
-                          '  n_used_cores = %d\n'
-                          '  n_min_cores = %d\n'
-                          '  n_used_min_cores = %d\n'
-                          '  n_free_cores = %d\n',
-                          jobID,
-                          num_cores,
-                          mem,
-                          node_attr,
-                          nodes.n_cores,
-                          nodes.n_used_cores,
-                          nodes.n_min_cores,
-                          nodes.n_used_min_cores,
-                          n_free_cores)
+        if qpylog.traces.active:
+            qpylog.traces.trace(self.logger,
+                                'Requesting resource:\n'
+                                '  jobID = %s\n'
+                                '  requested cores = %d\n'
+                                '  requested memory = %.2f\n'
+                                '  attribute = %s\n'
+                                'Nodes info:\n'
+                                '  n_cores = %d\n'
+                                '  n_used_cores = %d\n'
+                                '  n_min_cores = %d\n'
+                                '  n_used_min_cores = %d\n'
+                                '  n_free_cores = %d\n',
+                                jobID,
+                                num_cores,
+                                mem,
+                                node_attr,
+                                nodes.n_cores,
+                                nodes.n_used_cores,
+                                nodes.n_min_cores,
+                                nodes.n_used_min_cores,
+                                n_free_cores)
         if self.n_used_cores + num_cores <= self.min_cores:
             space_available = True
         else:
             use_others_resource = (self.n_used_cores + num_cores
                                    > self.min_cores + self.extra_cores)
             if use_others_resource:
-                n_users_with_queue = 1
-                n_extra = 0
-                for user in users:
-                    if user.name == self.name:
-                        continue
-                    if (user.n_queue > 0
-                        and (user.n_used_cores >=
-                             user.min_cores + user.extra_cores)):
-                        n_users_with_queue += 1
-                    elif user.n_queue == 0:
-                        n_extra += min(user.extra_cores + user.min_cores
-                                       - user.n_used_cores,
-                                       user.extra_cores)
+                n_users_with_queue, n_extra = users.fairness(self)
                 n_extra_per_user = n_extra // n_users_with_queue
                 if (self.n_used_cores + num_cores <=
                     self.min_cores + self.extra_cores + n_extra_per_user
@@ -265,41 +299,37 @@ class User:
                     space_available = True
             else:
                 space_available = free_cores
-        self.logger.debug('Space available? %s', space_available)
+        if qpylog.traces.active:
+            qpylog.traces.trace(self.logger,
+                                'Space available? %s', space_available)
         if space_available:
-            best_node = None
-            best_free_cores = 0
             with nodes.check_lock:
-                if num_cores == 1:
-                    for node in nodes:
-                        if (node.has_attributes(node_attr)
-                            and not(node.pref_multicores)
-                            and node.n_free_cores > best_free_cores
-                            and node.avail_mem > mem
-                                and node.free_mem > mem):
-                            best_node = node
-                            best_free_cores = node.n_free_cores
+                best_node = nodes.best_node(num_cores, mem, node_attr)
                 if best_node is None:
-                    for node in nodes:
-                        if (node.is_up
-                            and node.has_attributes(node_attr)
-                            and (node.max_cores
-                                 - node.n_outsiders
-                                 - node.n_used_cores >= num_cores)
-                            and node.avail_mem > mem):
-                            best_node = node
-                            break
+                    reason = nodes.rejection_reason(num_cores, mem, node_attr)
             if best_node is None:
-                self.logger.debug("No node with the requirement.")
+                if qpylog.traces.active:
+                    qpylog.traces.trace(self.logger,
+                                        'No node with the requirement.')
+                qpymetrics.metrics.count(
+                    f'node_requests_total{{user="{self.name}",'
+                    f'result="rejected",reason="{reason}"}}')
                 raise NoNodeAvailableError('No node with this requirement.')
-            self.logger.debug('Best node: %s', best_node.name)
+            if qpylog.traces.active:
+                qpylog.traces.trace(self.logger,
+                                    'Best node: %s', best_node.name)
             self.add_job(MultiuserJob(self.name,
                                       jobID,
                                       mem,
                                       num_cores,
                                       best_node.name),
                          nodes)
+            qpymetrics.metrics.count(
+                f'node_requests_total{{user="{self.name}",result="accepted"}}')
             return best_node.name + '=' + best_node.address
+        qpymetrics.metrics.count(
+            f'node_requests_total{{user="{self.name}",'
+            f'result="rejected",reason="cores"}}')
         raise NoNodeAvailableError('No free cores.')
 
 
@@ -308,14 +338,23 @@ class UsersCollection:
     
     
     """
-    __slots__ = ('_the_users', 'logger')
+    __slots__ = ('_the_users',
+                 '_dist_rules',
+                 '_dist_rules_stat',
+                 '_fairness',
+                 '_n_users_with_queue',
+                 '_n_extra',
+                 'logger')
 
     def __init__(self):
         """ Initialise the class"""
         self._the_users = {}
-        self.logger = qpylog.configure_logger(qpysys.multiuser_log_file,
-                                              level=logging.DEBUG,
-                                              logger_name=f'users')
+        self._fairness = {}
+        self._n_users_with_queue = 0
+        self._n_extra = 0
+        self._dist_rules = None
+        self._dist_rules_stat = None
+        self.logger = logging.getLogger('users')
 
     def __str__(self):
         """String version of a group os users"""
@@ -342,7 +381,8 @@ class UsersCollection:
         return x in self._the_users
 
     def __iter__(self):
-        return iter(self._the_users.values())
+        # over a copy: other threads might add users in the meantime
+        return iter(list(self._the_users.values()))
     
     def names(self):
         return iter(self._the_users)
@@ -383,21 +423,36 @@ class UsersCollection:
         new_user = User(username, address, port, conn_key)
         self.logger.info('A user for %s has been created.', username)
         if running_jobs is None:
-            try:
-                self.logger.debug('Requesting jobs from %s', username)
-                running_jobs = qpycomm.message_transfer(
-                    (qpyconst.FROM_MULTI_CUR_JOBS, ()),
-                    new_user.address,
-                    new_user.port,
-                    new_user.conn_key, timeout=2.0)
-                self.logger.debug('Jobs from %s obtained!', username)
-            except:
-                self.logger.exception('Failed when reading jobs from %s',
-                                      username)
-                running_jobs = []
+            running_jobs = self.request_running_jobs(username,
+                                                     address,
+                                                     port,
+                                                     conn_key)
         for job in running_jobs:
             new_user.add_job(job, nodes)
         self._the_users[username] = new_user
+        new_user._on_change = self._update_fairness
+        self._update_fairness(new_user)
+
+    def request_running_jobs(self, username, address, port, conn_key):
+        """Return the running jobs of a user, asked to the user's master
+        
+        This waits for the answer of the master (at most a few
+        seconds), so better not to call it holding a lock.
+        An empty list is returned if the master does not answer.
+        """
+        try:
+            self.logger.debug('Requesting jobs from %s', username)
+            running_jobs = qpycomm.message_transfer(
+                (qpyconst.FROM_MULTI_CUR_JOBS, ()),
+                address,
+                port,
+                conn_key, timeout=2.0)
+            self.logger.debug('Jobs from %s obtained!', username)
+        except:
+            self.logger.exception('Failed when reading jobs from %s',
+                                  username)
+            running_jobs = []
+        return running_jobs
 
     def load_users(self, nodes):
         """Load the users.
@@ -462,20 +517,9 @@ class UsersCollection:
         ParseError                 for any syntax error in the file
         NoNodeAvailableError       if exceed the number of cores
         """
-        f = open(qpysys.cores_distribution_file, 'r')
-        line = f.readline()
-        line_spl = line.split()
-        dist_type = line_spl[0]
-        min_cores = 0
+        dist_type, min_cores, explicit_rules = self._distribution_rules()
         users_min = {}
         users_extra = {}
-        if (len(line_spl) > 1):
-            if line_spl[1] != 'minimum':
-                raise ParseError('Not equal "minimum"')
-            try:
-                min_cores = int(line_spl[2])
-            except:
-                raise ParseError('Error to read min_cores')
         # General minimum cores
         left_cores = nodes.n_cores
         for username in self.names():
@@ -493,13 +537,11 @@ class UsersCollection:
                 users_extra[username] = n_per_user
             left_cores = left_cores - n_per_user*len(self)
         # Explicit distribution TODO: there was some bug here...
-        elif (dist_type == 'explicit'):
-            for line in f:
-                line_spl = line.split()
-                user = line_spl[0]
+        else:
+            for user, value in explicit_rules:
                 if user not in self:
                     continue
-                value = line_spl[1].split('+')
+                value = value.split('+')
                 if len(value) > 2 or len(value) == 0:
                     raise ParseError('len(value) not correct')
                 if len(value) == 2:
@@ -528,17 +570,16 @@ class UsersCollection:
                 add_cores = n_per_user
                 left_cores -= add_cores
                 users_extra[username] = add_cores
-        # Unknown type of distribution
-        else:
-            raise ParseError('Unknown type of distribution: ' + dist_type)
-        f.close()
-        # Equally share left cores
-        while (left_cores != 0):
-            for username in users_extra:
-                if (left_cores == 0):
-                    break
-                users_extra[username] += int(copysign(1, left_cores))
-                left_cores += copysign(1, -left_cores)
+        # Equally share left cores (or take the excess back), the first
+        # users receiving one more if they cannot be shared equally
+        if users_extra and left_cores != 0:
+            sign = 1 if left_cores > 0 else -1
+            n_per_user, n_remaining = divmod(abs(left_cores),
+                                             len(users_extra))
+            for i, username in enumerate(users_extra):
+                users_extra[username] += sign * (n_per_user
+                                                 + (1 if i < n_remaining else
+                                                    0))
         # Finally put into the users variable
         nodes._n_min_cores = 0  # BAD! nodes  should change _n_...
         nodes._n_used_min_cores = 0  # BAD! nodes  should change _n_...
@@ -556,4 +597,77 @@ class UsersCollection:
                 user.extra_cores = 0
         for user in self:
             user.max_cores = nodes.n_cores - nodes.n_min_cores + user.min_cores
+            self._update_fairness(user)
         return 0
+
+    def _update_fairness(self, user):
+        """Update the fairness aggregates after a change of user"""
+        old_with_queue, old_extra = self._fairness.get(user.name, (0, 0))
+        with_queue, n_extra = user.fairness_contribution()
+        self._fairness[user.name] = with_queue, n_extra
+        self._n_users_with_queue += with_queue - old_with_queue
+        self._n_extra += n_extra - old_extra
+
+    def fairness(self, user):
+        """Return the fairness aggregates from the point of view of user
+        
+        Return:
+        The pair (n_users_with_queue, n_extra): the number of users
+        that have jobs in the queue and use all their min and extra
+        cores, plus one (for user); and the number of extra cores that
+        are lent by users with no jobs in the queue. user itself is not
+        considered. See User.fairness_contribution.
+        """
+        with_queue, n_extra = self._fairness.get(user.name, (0, 0))
+        return (1 + self._n_users_with_queue - with_queue,
+                self._n_extra - n_extra)
+
+    def _distribution_rules(self):
+        """Return the rules of the file cores_distribution_file.
+        
+        The file is parsed only if it changed since the last call
+        (based on its modification time and size).
+        
+        Return:
+        The tuple (dist_type, min_cores, explicit_rules), where
+        explicit_rules is a list of pairs (user, value), from the
+        lines of explicit distributions. See distribute_cores.
+        
+        Raise:
+        ParseError      for syntax errors in the first line
+        OSError         for problems when accessing the file
+        """
+        stat = os.stat(qpysys.cores_distribution_file)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if self._dist_rules is not None and stat == self._dist_rules_stat:
+            return self._dist_rules
+        with open(qpysys.cores_distribution_file, 'r') as f:
+            line_spl = f.readline().split()
+            if not line_spl:
+                raise ParseError('Missing type of distribution')
+            dist_type = line_spl[0]
+            min_cores = 0
+            if (len(line_spl) > 1):
+                if line_spl[1] != 'minimum':
+                    raise ParseError('Not equal "minimum"')
+                try:
+                    min_cores = int(line_spl[2])
+                except:
+                    raise ParseError('Error to read min_cores')
+            if dist_type == 'even':
+                explicit_rules = []
+            elif dist_type == 'explicit':
+                explicit_rules = []
+                for line in f:
+                    line_spl = line.split()
+                    if not line_spl:
+                        continue
+                    if len(line_spl) < 2:
+                        raise ParseError('Missing value for ' + line_spl[0])
+                    explicit_rules.append((line_spl[0], line_spl[1]))
+            else:
+                raise ParseError('Unknown type of distribution: ' + dist_type)
+        self.logger.info('Distribution rules loaded')
+        self._dist_rules = dist_type, min_cores, explicit_rules
+        self._dist_rules_stat = stat
+        return self._dist_rules
@@ -0,0 +1,44 @@
+"""Tests for communication
+
+"""
+import os
+import unittest
+
+import unit_tests
+import qpy_system
+import qpy_communication
+
+
+class FakeSSHClient():
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SSHSessionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.pool = qpy_communication.SSHSessionPool()
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_discard(self):
+        ssh = FakeSSHClient()
+        self.pool._sessions[('node1', None)] = [ssh, 0.0]
+        self.pool.discard('node1', ssh)
+        self.assertTrue(ssh.closed)
+        self.assertNotIn(('node1', None), self.pool._sessions)
+
+    def test_discard_replaced(self):
+        failed = FakeSSHClient()
+        new = FakeSSHClient()
+        self.pool._sessions[('node1', None)] = [new, 0.0]
+        self.pool.discard('node1', failed)
+        self.assertTrue(failed.closed)
+        self.assertFalse(new.closed)
+        self.assertIs(self.pool._sessions[('node1', None)][0], new)
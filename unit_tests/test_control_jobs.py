@@ -0,0 +1,166 @@
+"""Tests for the threads that control the jobs
+
+"""
+import os
+import unittest
+import logging
+import threading
+
+import unit_tests
+import qpy_system
+import qpy_constants as qpyconst
+import qpy_job
+import qpy_nodes_management
+import qpy_control_jobs
+
+
+class FakeConfig():
+
+    def __init__(self):
+        self.logger = logging.getLogger('test control jobs')
+        self.sleep_time_sub_ctrl = 1
+
+
+class FakeMultiuserHandler():
+
+    def __init__(self):
+        self.multiuser_alive = threading.Event()
+
+
+class FakeJob():
+    """A job that runs nowhere, optionally killed (qpy kill) while starting"""
+
+    def __init__(self, ID, jobs, kill_while_starting=False):
+        self.ID = ID
+        self.jobs = jobs
+        self.kill_while_starting = kill_while_starting
+        self.status = qpyconst.JOB_ST_QUEUE
+        self.node = qpy_nodes_management.UsersNode('node1', 'node1')
+        self.ended_as = None
+
+    def run(self, config):
+        if self.kill_while_starting:
+            self.jobs.unqueue([self.ID])
+        self.status = qpyconst.JOB_ST_RUNNING
+
+    def end_running(self, new_status, queue_size, config):
+        self.status = new_status
+        self.ended_as = new_status
+        return False
+
+
+class JobCollection(qpy_job.JobCollection):
+
+    def record(self, *jobs):
+        self.recorded.extend(jobs)
+
+
+class StartJobsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.jobs = JobCollection(None, load_old_jobs=False)
+        self.jobs.recorded = []
+        self.sub_ctrl = qpy_control_jobs.Submission(self.jobs,
+                                                    FakeMultiuserHandler(),
+                                                    FakeConfig())
+        self.killed = []
+        self.orig_kill_on_node = qpy_control_jobs._kill_on_node
+        qpy_control_jobs._kill_on_node = (
+            lambda node, jobs, config: self.killed.extend(jobs) or True)
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+        qpy_control_jobs._kill_on_node = self.orig_kill_on_node
+
+    def _queue(self, *jobs):
+        for job in jobs:
+            self.jobs.all.append(job)
+            self.jobs.queue.append(job)
+            self.jobs.Q.append(job)
+
+    def test_start(self):
+        job = FakeJob(1, self.jobs)
+        self._queue(job)
+        self.assertEqual(self.sub_ctrl._start_jobs([job]), [job])
+        self.assertIn(job, self.jobs.running)
+        self.assertNotIn(job, self.jobs.queue)
+        self.assertNotIn(job, self.jobs.Q)
+        self.assertEqual(self.killed, [])
+
+    def test_killed_while_starting(self):
+        job_killed = FakeJob(1, self.jobs, kill_while_starting=True)
+        job = FakeJob(2, self.jobs)
+        self._queue(job_killed, job)
+        self.assertEqual(self.sub_ctrl._start_jobs([job_killed, job]), [job])
+        self.assertIn(job, self.jobs.running)
+        self.assertIn(job_killed, self.jobs.undone)
+        self.assertNotIn(job_killed, self.jobs.running)
+        self.assertEqual(self.killed, [job_killed])
+        self.assertEqual(job_killed.ended_as, qpyconst.JOB_ST_UNDONE)
+        self.assertEqual(job_killed.status, qpyconst.JOB_ST_UNDONE)
+        self.assertIsNone(job.ended_as)
+        self.assertCountEqual(self.jobs.recorded, [job, job_killed])
+        self.assertTrue(self.sub_ctrl.muHandler.multiuser_alive.is_set())
+
+
+class KillJobsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.jobs = JobCollection(None, load_old_jobs=False)
+        self.jobs.recorded = []
+        self.sub_ctrl = qpy_control_jobs.Submission(self.jobs,
+                                                    FakeMultiuserHandler(),
+                                                    FakeConfig())
+        self.sub_ctrl._skip()
+        self.killer = qpy_control_jobs.JobsKiller(
+            self.jobs, threading.Event(), FakeConfig(), self.sub_ctrl)
+        self.orig_kill_on_node = qpy_control_jobs._kill_on_node
+        qpy_control_jobs._kill_on_node = lambda node, jobs, config: True
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+        qpy_control_jobs._kill_on_node = self.orig_kill_on_node
+
+    def test_resume_submission(self):
+        job = FakeJob(1, self.jobs)
+        job.status = qpyconst.JOB_ST_RUNNING
+        self.jobs.all.append(job)
+        self.jobs.running.append(job)
+        self.killer.to_kill.put(job)
+        self.killer.to_kill.put('kill')
+        self.killer.run()
+        self.assertIn(job, self.jobs.killed)
+        self.assertEqual(job.ended_as, qpyconst.JOB_ST_KILLED)
+        self.assertFalse(self.sub_ctrl._skipping())
+        self.assertTrue(self.sub_ctrl.wake.is_set())
+
+
+class SkipSubmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.sub_ctrl = qpy_control_jobs.Submission(
+            JobCollection(None, load_old_jobs=False),
+            FakeMultiuserHandler(),
+            FakeConfig())
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_wake_does_not_end_skip(self):
+        self.sub_ctrl._skip()
+        self.sub_ctrl.wake.set()
+        self.assertTrue(self.sub_ctrl._skipping())
+
+    def test_resume(self):
+        self.sub_ctrl._skip()
+        self.sub_ctrl.resume()
+        self.assertFalse(self.sub_ctrl._skipping())
+        self.assertTrue(self.sub_ctrl.wake.is_set())
+
+    def test_resume_during_cycle(self):
+        self.sub_ctrl.resume()
+        self.sub_ctrl._skip()
+        self.assertFalse(self.sub_ctrl._skipping())
@@ -0,0 +1,108 @@
+"""Tests for jobs
+
+"""
+import os
+import unittest
+
+import unit_tests
+import qpy_system
+import qpy_job
+
+
+def _jobs(*IDs):
+    return [qpy_job.MultiuserJob('user1', ID, 1.0, 1, 'node1') for ID in IDs]
+
+
+def _IDs(job_list):
+    return [job.ID for job in job_list]
+
+
+class JobListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.jobs = _jobs(1, 2, 3, 4)
+        self.jl = qpy_job.JobList(self.jobs)
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_order(self):
+        self.assertEqual(_IDs(self.jl), [1, 2, 3, 4])
+        self.jl.append(_jobs(10)[0])
+        self.assertEqual(_IDs(self.jl), [1, 2, 3, 4, 10])
+        self.assertEqual(len(self.jl), 5)
+
+    def test_get_contains(self):
+        self.assertIs(self.jl.get(3), self.jobs[2])
+        self.assertIsNone(self.jl.get(30))
+        self.assertIn(self.jobs[0], self.jl)
+        self.assertNotIn(_jobs(30)[0], self.jl)
+
+    def test_remove(self):
+        self.jl.remove(self.jobs[1])
+        self.assertEqual(_IDs(self.jl), [1, 3, 4])
+        with self.assertRaises(ValueError):
+            self.jl.remove(self.jobs[1])
+
+    def test_remove_while_iterating(self):
+        for job in self.jl:
+            self.jl.remove(job)
+        self.assertEqual(len(self.jl), 0)
+
+    def test_popleft_head(self):
+        self.assertEqual(_IDs(self.jl.head(1, 2)), [2, 3])
+        self.assertEqual(_IDs(self.jl.head(3, 10)), [4])
+        self.assertEqual(self.jl.popleft().ID, 1)
+        self.assertEqual(_IDs(self.jl), [2, 3, 4])
+        with self.assertRaises(IndexError):
+            qpy_job.JobList().popleft()
+
+    def test_reorder(self):
+        self.jl.reorder(self.jobs[::-1])
+        self.assertEqual(_IDs(self.jl), [4, 3, 2, 1])
+
+
+class JumpQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.jobs = qpy_job.JobCollection(None, load_old_jobs=False)
+        for job in _jobs(1, 2, 3, 4, 5, 6):
+            self.jobs.all.append(job)
+        for job in list(self.jobs.all)[2:]:
+            self.jobs.queue.append(job)
+            self.jobs.Q.append(job)
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def assertQueue(self, all_IDs, queue_IDs):
+        self.assertEqual(_IDs(self.jobs.all), all_IDs)
+        self.assertEqual(_IDs(self.jobs.queue), queue_IDs)
+        self.assertEqual(_IDs(self.jobs.Q), queue_IDs)
+
+    def test_begin(self):
+        self.assertEqual(self.jobs.jump_Q([5, 6], 0), 'Queue reordered.\n')
+        self.assertQueue([1, 2, 5, 6, 3, 4], [5, 6, 3, 4])
+
+    def test_end(self):
+        self.assertEqual(self.jobs.jump_Q([3], -1), 'Queue reordered.\n')
+        self.assertQueue([1, 2, 4, 5, 6, 3], [4, 5, 6, 3])
+
+    def test_after_job(self):
+        self.assertEqual(self.jobs.jump_Q([6], 3), 'Queue reordered.\n')
+        self.assertQueue([1, 2, 3, 6, 4, 5], [3, 6, 4, 5])
+
+    def test_not_reordered(self):
+        self.assertEqual(self.jobs.jump_Q([3], 3),
+                         'Position is part of list: queue not reordered.\n')
+        self.assertEqual(self.jobs.jump_Q([3], 1),
+                         'Position not found: queue not reordered.\n')
+        self.assertEqual(self.jobs.jump_Q([1, 2], 0),
+                         'List does not have jobs in queue:'
+                         ' queue not reordered.\n')
+        self.assertEqual(self.jobs.jump_Q([3, 4, 5, 6], 0),
+                         'Queue is completely contained in list:'
+                         ' queue not reordered.\n')
+        self.assertQueue([1, 2, 3, 4, 5, 6], [3, 4, 5, 6])
@@ -0,0 +1,108 @@
+"""Tests for logging
+
+"""
+import os
+import unittest
+import logging
+
+import unit_tests
+import qpy_system
+import qpy_logging
+import qpy_multiuser_interaction
+
+
+class ParseLevelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_levels(self):
+        self.assertEqual(qpy_logging.parse_level('debug'), logging.DEBUG)
+        self.assertEqual(qpy_logging.parse_level('WARNING'), logging.WARNING)
+        self.assertEqual(qpy_logging.parse_level('15'), 15)
+        with self.assertRaises(ValueError):
+            qpy_logging.parse_level('verbose')
+        with self.assertRaises(ValueError):
+            qpy_logging.parse_level(('debug', 'info'))
+
+
+class TracesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.traces = qpy_logging.Traces()
+        self.logger = logging.getLogger('test traces')
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_not_active_without_debug(self):
+        self.traces.start_request(self.logger)
+        self.assertFalse(self.traces.active)
+        self.logger.setLevel(logging.DEBUG)
+        self.traces.start_request(self.logger)
+        self.assertTrue(self.traces.active)
+
+    def test_sample(self):
+        self.traces.set_buffer(10)
+        self.traces.sample = 0.0
+        self.traces.start_request(self.logger)
+        self.assertFalse(self.traces.active)
+        self.traces.sample = 1.0
+        self.traces.start_request(self.logger)
+        self.assertTrue(self.traces.active)
+
+    def test_buffer(self):
+        self.assertEqual(self.traces.dump(),
+                         'Traces are not kept in memory.\n')
+        self.traces.set_buffer(2)
+        self.assertEqual(self.traces.dump(), 'No traces.\n')
+        for i in range(3):
+            self.traces.trace(self.logger, 'job %d', i)
+        lines = self.traces.dump().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith('test traces: job 1'))
+        self.assertTrue(lines[1].endswith('test traces: job 2'))
+        self.traces.set_buffer(0)
+        self.assertIsNone(self.traces.buffer)
+
+
+class HandleLoggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.level = logging.getLogger().level
+        self.sample = qpy_logging.traces.sample
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+        logging.getLogger().setLevel(self.level)
+        qpy_logging.traces.sample = self.sample
+
+    def test_invalid_values(self):
+        for args in ([('level', 'verbose')],
+                     [('sample', 1.5)],
+                     [('sample', 'half')],
+                     [('buffer', -1)],
+                     [('buffer', 2.5)],
+                     [('colour', 'red')]):
+            status, msg = qpy_multiuser_interaction._handle_logging(
+                args, None, None)
+            self.assertEqual(status, -1, msg=str(args))
+
+    def test_nothing_applied_on_error(self):
+        status, msg = qpy_multiuser_interaction._handle_logging(
+            [('sample', 0.5), ('buffer', -1)], None, None)
+        self.assertEqual(status, -1)
+        self.assertEqual(qpy_logging.traces.sample, self.sample)
+
+    def test_apply(self):
+        status, msg = qpy_multiuser_interaction._handle_logging(
+            [('level', 'warning'), ('sample', 0.25)], None, None)
+        self.assertEqual(status, 0)
+        self.assertEqual(logging.getLogger().level, logging.WARNING)
+        self.assertEqual(qpy_logging.traces.sample, 0.25)
@@ -0,0 +1,68 @@
+"""Tests for metrics
+
+"""
+import os
+import unittest
+import threading
+
+import unit_tests
+import qpy_system
+import qpy_metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.metrics = qpy_metrics.Metrics(max_samples=10)
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_count(self):
+        self.metrics.count('a')
+        self.metrics.count('a', 2)
+        self.assertEqual(self.metrics.counters['a'], 3)
+
+    def test_summary(self):
+        self.assertIsNone(self.metrics.summary('x'))
+        for i in range(20):
+            self.metrics.add('x', float(i))
+        n, mean, p50, p90, p99, p_max = self.metrics.summary('x')
+        self.assertEqual(n, 20)
+        self.assertAlmostEqual(mean, 9.5)
+        # Only the last 10 samples are in the ring buffer
+        self.assertEqual(p50, 15.0)
+        self.assertEqual(p90, 19.0)
+        self.assertEqual(p_max, 19.0)
+
+    def test_report(self):
+        self.assertEqual(self.metrics.report(), 'No metrics recorded yet.\n')
+        self.metrics.count('jobs')
+        with self.metrics.timer('t'):
+            pass
+        report = self.metrics.report()
+        self.assertIn('jobs', report)
+        self.assertIn('Durations (ms)', report)
+
+    def test_prometheus(self):
+        self.metrics.count('requests_total{user="u1"}')
+        self.metrics.set_gauges('age', {'node="n1"': 2.0})
+        self.metrics.set_gauges('age', {'node="n2"': 3.0})
+        self.metrics.add('request seconds', 0.5)
+        lines = self.metrics.prometheus().split('\n')
+        self.assertIn('# TYPE qpy_requests_total counter', lines)
+        self.assertIn('qpy_requests_total{user="u1"} 1.0', lines)
+        self.assertIn('qpy_age{node="n2"} 3.0', lines)
+        self.assertNotIn('qpy_age{node="n1"} 2.0', lines)
+        self.assertIn('qpy_request_seconds{quantile="0.5"} 0.5', lines)
+        self.assertIn('qpy_request_seconds_count 1.0', lines)
+
+    def test_timed_lock(self):
+        lock = qpy_metrics.TimedLock(threading.RLock(), 'lock',
+                                     self.metrics)
+        with lock:
+            with lock:
+                pass
+        self.assertEqual(self.metrics.summary('lock_hold_seconds')[0], 1)
+        self.assertEqual(self.metrics.summary('lock_wait_seconds')[0], 1)
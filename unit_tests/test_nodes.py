@@ -72,6 +72,57 @@ class ConstructNode(unittest.TestCase):
         self.assertEqual(n1.total_mem, 100.0)
 
 
+class NodeAttributes(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.n1 = qpy_nodes_management.Node.from_string(
+            'node1 attributes=big,fast')
+        self.n2 = qpy_nodes_management.Node.from_string(
+            'node2 attributes=small')
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_single(self):
+        self.assertTrue(self.n1.has_attributes(['big']))
+        self.assertFalse(self.n2.has_attributes(['big']))
+        self.assertTrue(self.n2.has_attributes(['node2']))
+        self.assertTrue(self.n1.has_attributes([]))
+
+    def test_logical(self):
+        self.assertTrue(self.n1.has_attributes(['big', 'and', 'fast']))
+        self.assertFalse(self.n1.has_attributes(['big', 'and', 'not', 'fast']))
+        self.assertTrue(self.n2.has_attributes(['big', 'or', 'small']))
+        self.assertTrue(self.n2.has_attributes(['not', 'big', 'and', 'small']))
+        self.assertFalse(self.n1.has_attributes(['not', '(big', 'or', 'small)']))
+        self.assertTrue(self.n1.has_attributes(
+            ['small', 'or', 'big', 'and', 'fast']))
+
+    def test_invalid(self):
+        self.assertTrue(self.n2.has_attributes(['big', 'small']))
+        self.assertTrue(self.n2.has_attributes(['(big', 'and']))
+        self.assertTrue(self.n2.has_attributes(['and']))
+
+    def test_unknown(self):
+        self.assertFalse(self.n1.has_attributes(['no_node_has_it']))
+        self.assertTrue(self.n1.has_attributes(['not', 'no_node_has_it']))
+        self.assertNotIn('no_node_has_it',
+                         qpy_nodes_management._attribute_bits)
+
+    def test_collection(self):
+        nodes = qpy_nodes_management.NodesCollection()
+        nodes.add_node(self.n1)
+        nodes.add_node(self.n2)
+        self.assertEqual(nodes.nodes_with_attributes(['not', 'fast']),
+                         {'node2'})
+        self.assertEqual(nodes.nodes_with_attributes([]),
+                         {'node1', 'node2'})
+        nodes.remove_node('node2')
+        self.assertEqual(nodes.nodes_with_attributes(['not', 'fast']),
+                         set())
+
+
 class NodeResource(unittest.TestCase):
 
     def setUp(self):
@@ -179,13 +230,45 @@ class NodesAddRemoveNode(unittest.TestCase):
         with nodes.check_lock:
             nodes.add_node(n1)
             nodes.add_node(n2)
-        self.assertEqual(nodes._the_names[0], 'node1')
-        self.assertEqual(nodes._the_names[1], 'node2')
-        self.assertEqual(nodes._the_nodes[0].name, 'node1')
-        self.assertEqual(nodes._the_nodes[1].name, 'node2')
+        self.assertEqual([name for name, n in nodes.items()],
+                         ['node1', 'node2'])
+        self.assertEqual([n.name for n in nodes], ['node1', 'node2'])
         nodes.remove_node('node1')
-        self.assertEqual(nodes._the_names[0], 'node2')
-        self.assertEqual(nodes._the_nodes[0].name, 'node2')
+        self.assertEqual([name for name, n in nodes.items()], ['node2'])
+        self.assertEqual([n.name for n in nodes], ['node2'])
+        self.assertFalse('node1' in nodes)
+
+
+class BestNode(unittest.TestCase):
+
+    def setUp(self):
+        os.system(f'touch {qpy_system.source_dir}/test_dir')
+        self.nodes = qpy_nodes_management.NodesCollection()
+        for name, cores in (('node1', 4), ('node2', 8), ('node3', 8)):
+            n = qpy_nodes_management.Node(name)
+            n.max_cores = cores
+            n.total_mem = 50.0
+            n.is_up = True
+            self.nodes.add_node(n)
+
+    def tearDown(self):
+        os.remove(f'{qpy_system.source_dir}/test_dir')
+
+    def test_most_free_cores(self):
+        self.assertEqual(self.nodes.best_node(1, 1.0, []).name, 'node2')
+        self.nodes.allocate_resource('node2', 6, 1.0, 0)
+        self.assertEqual(self.nodes.best_node(1, 1.0, []).name, 'node3')
+        self.nodes.allocate_resource('node3', 6, 1.0, 0)
+        self.assertEqual(self.nodes.best_node(1, 1.0, []).name, 'node1')
+        self.nodes.free_resource('node2', 6, 1.0, 0)
+        self.assertEqual(self.nodes.best_node(1, 1.0, []).name, 'node2')
+
+    def test_multicore(self):
+        self.nodes.allocate_resource('node1', 2, 1.0, 0)
+        self.assertEqual(self.nodes.best_node(2, 1.0, []).name, 'node1')
+        self.assertEqual(self.nodes.best_node(4, 1.0, []).name, 'node2')
+        self.assertIsNone(self.nodes.best_node(10, 1.0, []))
+        self.assertIsNone(self.nodes.best_node(2, 100.0, []))
 
 
 class NodesDataModel(unittest.TestCase):